@@ -50,7 +50,11 @@ class ApiKeyInDB(ApiKeyBase):
     """
     id: Optional[ObjectId] = Field(default_factory=ObjectId, alias="_id")
     # 存储API密钥的哈希值，不存储明文
-    api_key_hash: str = Field(..., description="API密钥的哈希值，用于安全验证")
+    api_key_hash: Optional[str] = Field(default=None, description="旧版API密钥的bcrypt哈希值，首次验证成功后升级为api_key_hmac")
+    # 新版密钥格式 ak_<key_id>_<secret> 中的公开查找前缀（唯一索引）
+    key_id: Optional[str] = Field(default=None, description="API密钥的公开查找ID")
+    # 使用服务端pepper计算的HMAC-SHA256摘要（唯一索引）
+    api_key_hmac: Optional[str] = Field(default=None, description="API密钥的HMAC-SHA256摘要，用于快速验证")
     # 密钥预览，用于在UI中显示（仅显示前8位和后4位）
     key_preview: str = Field(..., description="密钥预览，安全地在UI中展示部分密钥信息")
     # 使用统计
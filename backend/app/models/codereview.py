@@ -192,6 +192,7 @@ class CodeReviewStats(BaseModel):
     most_active_repo: Optional[str] = None  # 最活跃的仓库
     most_active_user: Optional[str] = None  # 最活跃的用户
     top_issues: List[Dict[str, Any]] = []  # 最常见的问题类型统计
+    severity_counts: Dict[str, int] = {}  # 各严重程度的问题数
     agent_performance: Dict[str, Dict[str, Any]] = {}  # 各Agent的性能指标
 
 class CodeReviewListResponse(BaseModel):
@@ -210,6 +211,7 @@ class AsyncTaskResponse(BaseModel):
     task_id: str = Field(..., description="异步任务ID")
     status: ReviewStatus = Field(..., description="任务当前状态")
     message: str = Field(..., description="任务提交成功消息")
+    queue_position: Optional[int] = Field(None, description="任务在队列中的位置（从1开始）")
 
 class TaskStatusResponse(BaseModel):
     """任务状态查询响应模型
@@ -219,6 +221,7 @@ class TaskStatusResponse(BaseModel):
     task_id: str = Field(..., description="异步任务ID")
     status: ReviewStatus = Field(..., description="任务当前状态")
     progress: Optional[float] = Field(None, description="任务进度百分比")
+    queue_position: Optional[int] = Field(None, description="排队中任务的队列位置（从1开始）")
     error: Optional[str] = Field(None, description="错误信息（如果任务失败）")
     result: Optional[Dict] = Field(None, description="任务结果（如果已完成）")
     created_at: datetime = Field(..., description="任务创建时间")
@@ -253,7 +256,8 @@ class SimpleCodeReviewListResponse(BaseModel):
     适用于需要快速加载大量审查记录的场景。
     """
     reviews: List[SimpleCodeReviewResponse]  # 当前页的简化审查记录列表
-    total: int  # 总记录数
+    total: int  # 总记录数（短时间缓存，可能略有滞后）
     page: int  # 当前页码
     size: int  # 每页大小
-    has_next: bool  # 是否有下一页
\ No newline at end of file
+    has_next: bool  # 是否有下一页
+    next_cursor: Optional[str] = None  # 下一页的游标，传入 cursor 参数即可翻页
\ No newline at end of file
@@ -6,11 +6,11 @@ AI助手聊天路由模块
 """
 
 # FastAPI核心模块导入
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query
 from fastapi.responses import StreamingResponse
 
 # 数据类型和模型导入
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from pydantic import BaseModel
 from app.models.user import UserMeResponse
 
@@ -24,6 +24,7 @@ import logging
 
 # AI助手服务导入
 from app.services.aicopilot import aicopilot_service
+from app.services.copilotcontext import copilot_context_manager
 from autogen_core.models import UserMessage, AssistantMessage, SystemMessage
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_core.models import CreateResult, ModelFamily
@@ -76,6 +77,28 @@ async def get_chat_history(
     # 返回格式化的聊天历史数据
     return {"chat_history": chat_history}
 
+
+@router.get("/chathistory/{review_id}/page")
+async def get_chat_history_page(
+    review_id: str,
+    before: Optional[int] = Query(None, ge=1, description="上一页返回的next_before，获取更早的消息"),
+    limit: int = Query(50, ge=1, le=200, description="每页消息数量"),
+    current_user: UserMeResponse = Depends(require_bearer)
+):
+    """
+    从最新消息开始分页获取聊天记录
+    
+    Args:
+        review_id: 代码审查的唯一标识符
+        before: 只返回序号小于该值的消息
+        limit: 每页消息数量
+        current_user: 当前认证用户信息，通过JWT令牌验证获取
+    
+    Returns:
+        dict: {"messages": 按时间正序的消息, "next_before": 更早一页的游标}
+    """
+    return await aicopilot_service.get_chat_page(review_id, before=before, limit=limit)
+
 @router.post("/send/{review_id}")
 async def send_stream_message(
     review_id: str,
@@ -110,13 +133,6 @@ async def send_stream_message(
         # 保存用户消息到聊天记录中
         await aicopilot_service.add_chat_message(review_id, message, role='user')
         
-        # 获取完整的聊天历史（包含新发送的消息）
-        chat_history = await aicopilot_service.get_chat_history(review_id)
-        
-        # 确保chat_history是列表格式，防止后续处理出错
-        if not chat_history:
-            chat_history = []
-        
         # 定义流式生成器函数，用于创建SSE响应
         async def generate_stream():
             """
@@ -126,8 +142,12 @@ async def send_stream_message(
             捕获并处理可能出现的异常，确保客户端能收到错误信息。
             """
             try:
+                # 按token预算组装上下文：相关变更块 + 早期对话摘要 + 最近几轮对话
+                messages = await copilot_context_manager.build_messages(
+                    review_id, aicopilot_service.get_model_client()
+                )
                 # 异步迭代获取AI助手的流式响应
-                async for chunk in aicopilot_service.sendstream_generator(review_id, chat_history):
+                async for chunk in aicopilot_service.sendstream_generator(review_id, messages):
                     yield chunk
             except Exception as e:
                 # 记录错误并向客户端发送错误信息
@@ -1,10 +1,14 @@
 import code
-from fastapi import APIRouter, Depends, Header, HTTPException, status, Query, BackgroundTasks
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, Depends, Header, HTTPException, status, Query, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, Dict, Any, List, Tuple
 import logging
 from datetime import datetime
 import uuid
+import os
+import socket
+from bson import ObjectId
 from app.services.reputation import reputation_service
 from app.services.codereview import AICodeReviewDatabaseService
 from app.models.reputation import ReputationUpdatePayload
@@ -12,24 +16,31 @@ from app.models.user import UserResponse
 from app.models.codereview import (
     CodeReviewCreate, CodeReviewUpdate, CodeReviewResponse, 
     CodeReviewBaseResponse, CodeReviewDetailResponse,
-    SimpleCodeReviewListResponse, AsyncTaskResponse, TaskStatusResponse
+    SimpleCodeReviewListResponse, AsyncTaskResponse, TaskStatusResponse, CodeReviewStats
 )
 from app.utils.apikey import require_api_key
 from app.utils.userauth import require_bearer
+from app.utils.cache import principal_cache
+from app.services.copilotcontext import copilot_context_manager
 from app.utils.codereview import (
     parse_base64_content, parse_comments_from_base64, parse_ai_output,
     calculate_reputation_delta, build_final_result, log_review_request,
     calculate_review_summary, build_event_description, build_ai_chat_message
 )
-from app.utils.database import get_database
+from app.utils.database import get_database, mongo_transaction
 from app.services.codereview import get_ai_code_review_service
 from app.services.aicopilot import aicopilot_service
 from app.services.jira import create_issue
+from app.services.webhook import webhook_service, check_callback_url, resolve_callback_target
+from app.utils.encryption import token_encryption
 
-import pickle
-import os
-import threading
-import platform
+from app.services.taskstore import (
+    task_store, REVIEW_EXECUTION_MODE, REVIEW_MAX_INFLIGHT, REVIEW_QUEUE_MAX_BACKLOG,
+    REVIEW_EVENTS_POLL_INTERVAL, REVIEW_EVENTS_FINAL_GRACE, REVIEW_STREAM_MAX_SECONDS, FINISHED_STATUSES
+)
+import asyncio
+import json
+import time
 
 
 # 配置日志
@@ -66,6 +77,18 @@ class CodeReviewPayload(BaseModel):
     repo_owner: str = Field(..., description="仓库所有者")
     repo_name: str = Field(..., description="仓库名称")
     author: str = Field(..., description="PR作者")
+
+    # 可选的完成回调：任务结束后向该地址POST结果，使用callback_secret做HMAC-SHA256签名
+    callback_url: Optional[str] = Field(None, description="审查完成后的回调地址（http/https）")
+    callback_secret: Optional[str] = Field(None, description="回调签名密钥")
+
+    @field_validator("callback_url")
+    @classmethod
+    def validate_callback_url(cls, value: Optional[str]) -> Optional[str]:
+        # 这里只做不需要DNS解析的检查，解析后的IP在提交接口和每次投递前检查
+        if value:
+            check_callback_url(value)
+        return value or None
     
     @property
     def diff_content(self) -> str:
@@ -96,90 +119,159 @@ class CodeReviewPayload(BaseModel):
 # ⭐ 异步任务处理
 # ==============================
 
-# 任务存储文件路径
-TASK_STORE_FILE = "task_store.pkl"
-# 线程锁，确保进程内的文件操作原子性
-task_store_lock = threading.Lock()
+# 任务存储（可插拔后端，见 app/services/taskstore.py）
+# 每次状态变更与轮询都只读写单个任务记录
 
-# 全局任务存储（生产环境应使用Redis或数据库）
-task_store = {}
+# inline模式下API进程内同时执行的审查任务上限，超出的任务保持pending排队
+inline_review_semaphore = asyncio.Semaphore(REVIEW_MAX_INFLIGHT)
+# inline模式下任务的执行方标识（记录在任务的worker_id上）
+INLINE_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:inline"
 
-# 根据操作系统选择文件锁定方式
-if platform.system() == "Windows":
-    import msvcrt
-    
-    def lock_file(f, exclusive=True):
-        """Windows平台的文件锁定"""
-        if exclusive:
-            # 锁定整个文件用于写入（独占锁）
-            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, os.path.getsize(f.name) or 1)
-        else:
-            # 锁定整个文件用于读取（共享锁）
-            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, os.path.getsize(f.name) or 1)
-    
-    def unlock_file(f):
-        """Windows平台的文件解锁"""
-        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, os.path.getsize(f.name) or 1)
-else:
-    import fcntl
-    
-    def lock_file(f, exclusive=True):
-        """Unix/Linux平台的文件锁定"""
-        if exclusive:
-            # 获取独占锁（写入时使用）
-            fcntl.flock(f, fcntl.LOCK_EX)
-        else:
-            # 获取共享锁（读取时使用）
-            fcntl.flock(f, fcntl.LOCK_SH)
-    
-    def unlock_file(f):
-        """Unix/Linux平台的文件解锁"""
-        fcntl.flock(f, fcntl.LOCK_UN)
+# 未启用事务时，审查结果提交后信誉更新的尝试次数
+REPUTATION_UPDATE_ATTEMPTS = 3
 
-def load_task_store():
-    """从文件加载任务存储"""
-    global task_store
-    if os.path.exists(TASK_STORE_FILE):
+
+async def apply_reputation_update(review_id: str, author: str, event: str, delta_reputation: int) -> bool:
+    """
+    在审查结果已提交后更新开发者信誉，失败时重试，重试耗尽只记录错误
+
+    Returns:
+        bool: 是否更新成功
+    """
+    for attempt in range(1, REPUTATION_UPDATE_ATTEMPTS + 1):
         try:
-            with open(TASK_STORE_FILE, "rb") as f:
-                # 获取共享锁（读取时使用）
-                lock_file(f, exclusive=False)
-                try:
-                    task_store = pickle.load(f)
-                    print(task_store)
-                finally:
-                    # 释放锁
-                    unlock_file(f)
+            await reputation_service.update_programmer_reputation(
+                author, event, delta_reputation=delta_reputation, event_key=f"review:{review_id}"
+            )
+            return True
         except Exception as e:
-            logger.error(f"Failed to load task store from file: {str(e)}")
-            task_store = {}
+            logger.warning(f"审查 {review_id} 的信誉更新失败({attempt}/{REPUTATION_UPDATE_ATTEMPTS}): {str(e)}")
+            if attempt < REPUTATION_UPDATE_ATTEMPTS:
+                await asyncio.sleep(2 ** (attempt - 1))
+    logger.error(f"审查 {review_id} 已完成，但作者 {author} 的信誉更新失败: event={event}, delta={delta_reputation}")
+    return False
+
+
+async def commit_review_outcome(
+    ai_service,
+    review_id: str,
+    author: str,
+    pr_number: str,
+    ai_result: Dict[str, Any],
+    diff_text: str,
+    pr_title: str,
+    pr_body: str,
+    started_at: datetime
+) -> Dict[str, Any]:
+    """
+    提交一次审查的全部结果并返回解析出的问题
+
+    审查记录（状态、agent输出、最终结果、系统聊天消息）在同一次更新中写入，
+    开发者信誉更新与之放在同一个可选事务中（MONGO_USE_TRANSACTIONS）。
+    未启用事务时审查结果先行提交，之后的信誉更新失败不会影响审查的完成状态。
+    """
+    if ai_result.get("status") == "error":
+        raise RuntimeError(ai_result.get("error") or ai_result.get("reason") or "AI代码审查失败")
+
+    # 获取AI审查结果
+    final_ai_output = ai_result.get("final_result", "")
+
+    # 解析AI输出
+    issues, summary, defect_types = parse_ai_output(final_ai_output)
+
+    # 计算信誉值变化
+    delta_reputation = calculate_reputation_delta(summary)
+    event = build_event_description(summary, defect_types, delta_reputation, pr_number)
+
+    ai_chat_message = build_ai_chat_message(final_ai_output, diff_text, pr_title, pr_body)
+    chat_messages = [aicopilot_service.build_chat_message(ai_chat_message, 'system')]
+
+    async with mongo_transaction() as session:
+        await ai_service.commit_result(
+            review_id, ai_result.get("agent_outputs", {}), final_ai_output,
+            started_at=started_at, chat_messages=chat_messages, session=session
+        )
+        if session is not None:
+            # 事务中失败时审查结果一起回滚，由调用方标记审查失败
+            await reputation_service.update_programmer_reputation(
+                author, event, delta_reputation=delta_reputation, session=session, event_key=f"review:{review_id}"
+            )
+            return issues
+
+    # 审查已标记为完成，信誉更新只重试和记录，不再抛出
+    await apply_reputation_update(review_id, author, event, delta_reputation)
+    return issues
 
-def save_task_store():
-    """保存任务存储到文件"""
-    global task_store
+async def send_review_callback(task_id: str, review_id: Optional[str] = None) -> None:
+    """
+    任务结束后登记回调投递，未登记回调时直接返回
+
+    只写入投递队列，实际发送和重试由 webhook_service 的投递循环完成，不占用审查的并发名额。
+    """
+    task = await task_store.get_task(task_id)
+    callback = (task or {}).get("callback")
+    if not callback or task["status"] not in FINISHED_STATUSES:
+        return
+
+    payload = {
+        "event": f"review.{task['status']}",
+        "task_id": task_id,
+        "review_id": review_id,
+        "status": task["status"],
+        "result": task.get("result"),
+        "error": task.get("error"),
+        "updated_at": task.get("updated_at")
+    }
     try:
-        with open(TASK_STORE_FILE, "wb") as f:
-            # 获取独占锁（写入时使用）
-            lock_file(f, exclusive=True)
-            try:
-                pickle.dump(task_store, f)
-            finally:
-                # 释放锁
-                unlock_file(f)
+        await webhook_service.enqueue(task_id, callback["url"], callback.get("secret"), payload["event"], payload)
     except Exception as e:
-        logger.error(f"Failed to save task store to file: {str(e)}")
+        logger.error(f"任务 {task_id} 登记回调投递失败: {str(e)}")
+
+async def finish_resumed_task(task_id: str, review: Dict[str, Any]) -> None:
+    """重新执行的任务对应的审查已经结束（上次执行在提交后退出），按审查结果结束任务"""
+    if review.get("status") == "completed":
+        final_result = review.get("final_result")
+        issues = parse_ai_output(json.dumps(final_result, ensure_ascii=False))[0] if final_result else {}
+        await task_store.update_task(task_id, {
+            "status": "completed",
+            "result": {"issues": issues},
+            "updated_at": datetime.utcnow()
+        })
+    else:
+        await task_store.update_task(task_id, {
+            "status": "failed",
+            "error": review.get("error") or "代码审查失败",
+            "updated_at": datetime.utcnow()
+        })
 
-# 程序启动时加载任务存储
-load_task_store()
 
 async def run_async_review_task(task_id: str, payload: CodeReviewPayload, username: str, code_review_service: AICodeReviewDatabaseService):
-    """异步运行代码审查任务"""
+    """
+    异步运行代码审查任务
+
+    审查ID在创建审查记录之前分配并记录在任务上。任务被重新领取（上次执行的进程退出）时
+    沿用同一审查记录：审查已结束则直接按其结果结束任务，否则重新运行审查，
+    不会产生重复的审查记录，信誉变化也只按该审查计算一次。
+    """
+    review_id = None
     try:
+        task = await task_store.get_task(task_id) or {}
+        review_id = task.get("review_id")
+        review = await code_review_service.get_review_state(review_id) if review_id else None
+        if review and review.get("status") in FINISHED_STATUSES:
+            logger.info(f"任务 {task_id} 的审查 {review_id} 已结束，直接结束任务")
+            await finish_resumed_task(task_id, review)
+            await send_review_callback(task_id, review_id)
+            return
+        if not review_id:
+            review_id = str(ObjectId())
+            await task_store.update_task(task_id, {"review_id": review_id})
+
         # 更新任务状态为处理中
-        with task_store_lock:
-            task_store[task_id]["status"] = "processing"
-            task_store[task_id]["updated_at"] = datetime.utcnow()
-            save_task_store()
+        await task_store.update_task(task_id, {
+            "status": "processing",
+            "updated_at": datetime.utcnow()
+        })
         
         # 使用payload中的author作为PR作者
         author = payload.author or "unknown"
@@ -219,7 +311,15 @@ async def run_async_review_task(task_id: str, payload: CodeReviewPayload, userna
             chat_history=[]
         )
         
-        review_id = await code_review_service.create_review(review_data, user_id)
+        if review is None:
+            await code_review_service.create_review(review_data, user_id, review_id=review_id)
+            await task_store.append_event(task_id, "review_created", {"review_id": review_id})
+        else:
+            logger.info(f"任务 {task_id} 续接未完成的审查 {review_id}")
+
+        # 审查过程中的agent开始/结束事件写入任务存储，供 /stream 与 /events 推送
+        async def publish_event(event_type: str, data: Dict[str, Any]) -> None:
+            await task_store.append_event(task_id, event_type, data)
 
         # 导入AI代码审查服务
         
@@ -245,36 +345,41 @@ async def run_async_review_task(task_id: str, payload: CodeReviewPayload, userna
         }
         
         # 运行AI代码审查
-        ai_result = await ai_service.run_ai_code_review(review_data)
-        
-        # 获取AI审查结果
-        final_ai_output = ai_result.get("final_result", "")
+        started_at = datetime.utcnow()
+        ai_result = await ai_service.run_ai_code_review(review_data, event_sink=publish_event, persist=False)
         
-        # 解析AI输出
-        issues, summary, defect_types = parse_ai_output(final_ai_output)
-        
-        # 计算信誉值变化
-        delta_reputation = calculate_reputation_delta(summary)
-        event = build_event_description(summary, defect_types, delta_reputation, payload.pr_number)
-        await reputation_service.update_programmer_reputation(author, event, delta_reputation=delta_reputation)
-
-        ai_chat_message = build_ai_chat_message(final_ai_output,diff_text,pr_title,pr_body)
-        await aicopilot_service.add_chat_message(review_id, ai_chat_message,'system')
+        # 审查结果、信誉变化与聊天记录一起提交
+        issues = await commit_review_outcome(
+            ai_service, review_id, author, payload.pr_number, ai_result,
+            diff_text, pr_title, pr_body, started_at
+        )
 
         # 更新任务结果为完成
-        with task_store_lock:
-            task_store[task_id]["status"] = "completed"
-            task_store[task_id]["result"] = {"issues": issues}
-            task_store[task_id]["updated_at"] = datetime.utcnow()
-            save_task_store()
+        await task_store.update_task(task_id, {
+            "status": "completed",
+            "result": {"issues": issues},
+            "updated_at": datetime.utcnow()
+        })
         
     except Exception as e:
         logger.error(f"Async task {task_id} failed: {str(e)}")
-        with task_store_lock:
-            task_store[task_id]["status"] = "failed"
-            task_store[task_id]["error"] = str(e)
-            task_store[task_id]["updated_at"] = datetime.utcnow()
-            save_task_store()
+        if review_id:
+            await code_review_service.mark_review_failed(review_id, str(e))
+        await task_store.update_task(task_id, {
+            "status": "failed",
+            "error": str(e),
+            "updated_at": datetime.utcnow()
+        })
+
+    # 任务状态已落库，客户端轮询可立即看到结果；回调在此之后登记投递
+    await send_review_callback(task_id, review_id)
+
+async def run_bounded_review_task(task_id: str, payload: CodeReviewPayload, username: str, code_review_service: AICodeReviewDatabaseService):
+    """在进程内并发上限下运行审查任务（inline模式）"""
+    # 等待并发名额期间（pending）同样刷新租约，API进程退出后任务由 expire_stale_tasks 标记为失败
+    async with task_store.lease(task_id):
+        async with inline_review_semaphore:
+            await run_async_review_task(task_id, payload, username, code_review_service)
 
 # ==============================
 # ⭐ 异步任务API端点
@@ -288,45 +393,75 @@ async def submit_review_task(
     code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service)
 ):
     """提交异步代码审查任务"""
+    # 积压过多时拒绝新任务，由客户端稍后重试
+    pending = await task_store.count_pending()
+    if pending >= REVIEW_QUEUE_MAX_BACKLOG and await task_store.expire_stale_tasks():
+        # 积压中可能有已退出进程遗留的任务，清理后重新计数
+        pending = await task_store.count_pending()
+    if pending >= REVIEW_QUEUE_MAX_BACKLOG:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"审查任务队列已满（{pending}个任务排队中），请稍后重试",
+            headers={"Retry-After": "60"}
+        )
+
+    if payload.callback_url:
+        # 解析回调地址，拒绝指向内网的地址
+        try:
+            await resolve_callback_target(payload.callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
     # 生成唯一任务ID
     task_id = str(uuid.uuid4())
     
     # 初始化任务状态
-    with task_store_lock:
-        task_store[task_id] = {
-            "status": "pending",
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow(),
-            "username": username
+    task = {
+        "status": "pending",
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "username": username
+    }
+    if payload.callback_url:
+        # 回调密钥加密保存，不随payload明文落库
+        task["callback"] = {
+            "url": payload.callback_url,
+            "secret": token_encryption.encrypt_token(payload.callback_secret or "")
         }
-        save_task_store()
+    if REVIEW_EXECUTION_MODE == "worker":
+        # 由独立worker进程领取执行，payload随任务一起持久化
+        task["payload"] = payload.dict(exclude={"callback_secret"})
+    else:
+        # 由当前进程执行，创建时即持有租约，进程退出后任务不会一直停留在排队中
+        task["worker_id"] = INLINE_WORKER_ID
+        task["claimed_at"] = task["created_at"]
+    await task_store.create_task(task_id, task)
     
-    # 在后台启动异步任务
-    background_tasks.add_task(
-        run_async_review_task, 
-        task_id, payload, username, code_review_service
-    )
+    if REVIEW_EXECUTION_MODE != "worker":
+        # 在后台启动异步任务（受进程内并发上限约束）
+        background_tasks.add_task(
+            run_bounded_review_task, 
+            task_id, payload, username, code_review_service
+        )
     
     return AsyncTaskResponse(
         task_id=task_id,
         status="pending",
-        message="代码审查任务已提交，正在后台处理中"
+        message="代码审查任务已提交，正在后台处理中",
+        queue_position=pending + 1
     )
 
 @router.get("/status/{task_id}", response_model=TaskStatusResponse)
 async def get_task_status(task_id: str):
     """查询异步任务状态"""
-    with task_store_lock:
-        # 先加载最新的任务存储
-        load_task_store()
-        if task_id not in task_store:
-            raise HTTPException(status_code=404, detail="任务未找到")
-        
-        task = task_store[task_id]
+    task = await task_store.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务未找到")
     
     return TaskStatusResponse(
         task_id=task_id,
         status=task["status"],
+        queue_position=await task_store.get_queue_position(task),
         error=task.get("error"),
         result=task.get("result"),
         created_at=task["created_at"],
@@ -336,19 +471,188 @@ async def get_task_status(task_id: str):
 @router.get("/result/{task_id}")
 async def get_task_result(task_id: str):
     """获取异步任务结果"""
-    with task_store_lock:
-        # 先加载最新的任务存储
-        load_task_store()
-        if task_id not in task_store:
-            raise HTTPException(status_code=404, detail="任务未找到")
-        
-        task = task_store[task_id]
+    task = await task_store.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务未找到")
     
     if task["status"] != "completed":
         raise HTTPException(status_code=400, detail="任务尚未完成")
     
     return task["result"]
 
+
+@router.get("/callbacks/{task_id}")
+async def get_task_callbacks(task_id: str, username: str = Depends(require_api_key)):
+    """查询任务的回调投递记录"""
+    task = await task_store.get_task(task_id)
+    if not task or task.get("username") != username:
+        raise HTTPException(status_code=404, detail="任务未找到")
+    return {"task_id": task_id, "deliveries": await webhook_service.list_deliveries(task_id)}
+
+
+# 单次读取的事件数量上限
+EVENTS_PAGE_SIZE = 100
+# SSE保活注释的间隔（秒），避免连接被代理断开
+SSE_KEEPALIVE_SECONDS = 15
+
+
+def _serialize_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    created_at = event.get("created_at")
+    return {
+        "seq": event["seq"],
+        "type": event["type"],
+        "data": event.get("data") or {},
+        "created_at": created_at.isoformat() if isinstance(created_at, datetime) else created_at
+    }
+
+
+def _format_sse(event: Dict[str, Any]) -> str:
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def _final_status(events: List[Dict[str, Any]]) -> Optional[str]:
+    """返回事件中的结束状态（completed/failed），没有时返回None"""
+    for event in reversed(events):
+        status = (event.get("data") or {}).get("status")
+        if event["type"] == "status" and status in FINISHED_STATUSES:
+            return status
+    return None
+
+
+async def _wait_notified(notified: asyncio.Event, timeout: float) -> bool:
+    """等待任务的新事件通知，超时返回False"""
+    try:
+        await asyncio.wait_for(notified.wait(), timeout=max(timeout, 0.0))
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+@router.get("/stream/{task_id}")
+async def stream_task_events(
+    task_id: str,
+    request: Request,
+    after: int = Query(0, ge=0, description="只推送序号大于该值的事件"),
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    以SSE推送任务进度（状态变更、agent开始/结束）
+
+    事件来自共享的任务存储，由任意API进程提供均可。有新事件时由任务存储的通知唤醒，
+    否则按 REVIEW_EVENTS_POLL_INTERVAL 回退轮询。断线重连时浏览器会携带
+    Last-Event-ID，从断点继续推送。推送完结束状态事件后发送 end 事件并关闭连接。
+    """
+    task = await task_store.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务未找到")
+
+    if last_event_id and last_event_id.isdigit():
+        after = max(after, int(last_event_id))
+
+    async def event_stream():
+        cursor = after
+        final_status = None
+        started = time.monotonic()
+        last_sent = started
+        with task_store.hub.subscribe(task_id) as notified:
+            while True:
+                if await request.is_disconnected():
+                    return
+
+                # 先清除通知再读取，读取之后写入的事件会重新唤醒等待
+                notified.clear()
+                events = await task_store.get_events(task_id, after=cursor, limit=EVENTS_PAGE_SIZE)
+                for event in events:
+                    cursor = event["seq"]
+                    yield _format_sse(_serialize_event(event))
+                if events:
+                    final_status = _final_status(events) or final_status
+                    last_sent = time.monotonic()
+                    continue
+
+                if final_status:
+                    yield f"event: end\ndata: {json.dumps({'status': final_status}, ensure_ascii=False)}\n\n"
+                    return
+
+                now = time.monotonic()
+                if now - started >= REVIEW_STREAM_MAX_SECONDS:
+                    return
+                if now - last_sent >= SSE_KEEPALIVE_SECONDS:
+                    yield ": keepalive\n\n"
+                    last_sent = now
+                if await _wait_notified(notified, min(REVIEW_EVENTS_POLL_INTERVAL, SSE_KEEPALIVE_SECONDS)):
+                    continue
+
+                # 没有收到通知（事件由其他进程写入且没有change stream）时检查任务状态
+                current = await task_store.get_task(task_id)
+                if current is None:
+                    yield f"event: end\ndata: {json.dumps({'status': 'expired'}, ensure_ascii=False)}\n\n"
+                    return
+                if current["status"] in FINISHED_STATUSES:
+                    # 任务状态先于状态事件写入，稍等后再读取一次事件，避免漏掉结束前的最后几条
+                    await _wait_notified(notified, REVIEW_EVENTS_FINAL_GRACE)
+                    final_status = current["status"]
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/events/{task_id}")
+async def poll_task_events(
+    task_id: str,
+    after: int = Query(0, ge=0, description="只返回序号大于该值的事件"),
+    timeout: float = Query(25, ge=0, le=60, description="没有新事件时最长等待秒数")
+):
+    """
+    长轮询获取任务进度（不支持SSE的客户端使用）
+
+    有新事件或任务结束时立即返回，否则最多等待timeout秒。
+    客户端用返回的 next_after 作为下一次请求的 after 参数。
+    """
+    task = await task_store.get_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务未找到")
+
+    def respond(status: str, events: List[Dict[str, Any]], finished: bool) -> Dict[str, Any]:
+        return {
+            "task_id": task_id,
+            "status": status,
+            "finished": finished,
+            "events": [_serialize_event(event) for event in events],
+            "next_after": events[-1]["seq"] if events else after
+        }
+
+    status = task["status"]
+    deadline = time.monotonic() + timeout
+    with task_store.hub.subscribe(task_id) as notified:
+        while True:
+            notified.clear()
+            events = await task_store.get_events(task_id, after=after, limit=EVENTS_PAGE_SIZE)
+            if events:
+                final_status = _final_status(events)
+                # 读到结束状态事件且事件已全部取完时才告知客户端结束
+                finished = final_status is not None and len(events) < EVENTS_PAGE_SIZE
+                return respond(final_status or status, events, finished)
+
+            if status in FINISHED_STATUSES:
+                # 任务状态先于状态事件写入，稍等后再读取一次事件
+                await _wait_notified(notified, REVIEW_EVENTS_FINAL_GRACE)
+                events = await task_store.get_events(task_id, after=after, limit=EVENTS_PAGE_SIZE)
+                return respond(status, events, len(events) < EVENTS_PAGE_SIZE)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return respond(status, [], False)
+            if not await _wait_notified(notified, min(REVIEW_EVENTS_POLL_INTERVAL, remaining)):
+                # 没有收到通知时回退检查任务状态
+                task = await task_store.get_task(task_id)
+                if not task:
+                    raise HTTPException(status_code=404, detail="任务未找到")
+                status = task["status"]
+
 # ==============================
 # ⭐ 代码审查路由（同步版本，保持向后兼容）
 # ==============================
@@ -367,7 +671,7 @@ async def review(
     # 使用新的信誉服务获取用户信誉信息
     reputation = await reputation_service.get_programmer_reputation(author)
     reputation_score = reputation["score"]
-    reputation_history = reputation["history"]
+    reputation_history = reputation["history"][-5:]
 
     # 使用解码后的字段
     diff_text = payload.diff_content
@@ -424,21 +728,19 @@ async def review(
     }
     
     # 运行AI代码审查
-    ai_result = await ai_service.run_ai_code_review(review_data)
-    
-    # 获取AI审查结果
-    final_ai_output = ai_result.get("final_result", "")
-    
-    # 解析AI输出
-    issues, summary, defect_types = parse_ai_output(final_ai_output)
-    
-    # 计算信誉值变化
-    delta_reputation = calculate_reputation_delta(summary)
-    event = build_event_description(summary, defect_types, delta_reputation, payload.pr_number)
-    await reputation_service.update_programmer_reputation(author, event, delta_reputation=delta_reputation)
+    started_at = datetime.utcnow()
+    ai_result = await ai_service.run_ai_code_review(review_data, persist=False)
 
-    ai_chat_message = build_ai_chat_message(final_ai_output,diff_text,pr_title,pr_body)
-    await aicopilot_service.add_chat_message(review_id, ai_chat_message,'system')
+    # 审查结果、信誉变化与聊天记录一起提交
+    try:
+        issues = await commit_review_outcome(
+            ai_service, review_id, author, payload.pr_number, ai_result,
+            diff_text, pr_title, pr_body, started_at
+        )
+    except Exception as e:
+        logger.error(f"Review {review_id} failed: {str(e)}")
+        await code_review_service.mark_review_failed(review_id, str(e))
+        raise HTTPException(status_code=500, detail=f"代码审查失败: {str(e)}")
 
     return { 
         "issues": issues,
@@ -473,7 +775,7 @@ async def get_review_base_by_id(
     code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service)
 ):
     """根据审查记录ID获取基础信息（不包含大字段）"""  
-    review = await code_review_service.get_review_by_id(review_id)
+    review = await code_review_service.get_review_by_id(review_id, view="base")
     if not review:
         raise HTTPException(status_code=404, detail="审查记录未找到")
     
@@ -522,7 +824,7 @@ async def get_review_base_by_github_action_id(
     code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service)
 ):
     """根据GitHub Action ID获取审查记录基础信息"""
-    review = await code_review_service.get_review_by_github_action_id(github_action_id, username)
+    review = await code_review_service.get_review_by_github_action_id(github_action_id, username, view="base")
     if not review:
         raise HTTPException(status_code=404, detail="GitHub Action对应的审查记录未找到")
     
@@ -569,16 +871,34 @@ async def list_reviews(
     username: str = Depends(require_bearer),
     code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service),
     page: int = Query(1, ge=1, description="页码"),
-    size: int = Query(10, ge=1, le=100, description="每页数量")
+    size: int = Query(10, ge=1, le=100, description="每页数量"),
+    cursor: Optional[str] = Query(None, description="上一页返回的next_cursor，传入后按游标翻页")
 ):
     """获取代码审查记录列表"""
     skip = (page - 1) * size
     
-    return await code_review_service.list_reviews(
-        username=username,
-        skip=skip,
-        limit=size
-    )
+    try:
+        return await code_review_service.list_reviews(
+            username=username,
+            skip=skip,
+            limit=size,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# ==============================
+# ⭐ 获取当前用户的审查统计
+# ==============================
+@router.get("/stats", response_model=CodeReviewStats)
+async def get_review_stats(
+    username: str = Depends(require_bearer),
+    code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service),
+    days: Optional[int] = Query(None, ge=1, le=3650, description="只统计最近N天的审查")
+):
+    """获取当前用户的审查统计（状态、仓库、作者、问题类型等）"""
+    return await code_review_service.get_review_stats(username=username, days=days)
 
 
 
@@ -605,7 +925,8 @@ async def get_latest_review_base_by_current_user(
     try:
         # 获取当前用户的最近一条审查记录（使用用户名查询）
         latest_review = await code_review_service.get_latest_review_by_username(
-            username=username
+            username=username,
+            view="base"
         )
         
         if not latest_review:
@@ -736,8 +1057,8 @@ async def mark_issue(
     code_review_service: AICodeReviewDatabaseService = Depends(get_code_review_service)
 ):
     """标记或取消标记问题项"""
-    # 获取当前审查记录
-    review = await code_review_service.get_review_by_id(review_id)
+    # 获取当前审查记录（只需要marked_issues，读取基础视图即可）
+    review = await code_review_service.get_review_by_id(review_id, view="base")
     if not review:
         raise HTTPException(status_code=404, detail="审查记录未找到")
     
@@ -808,4 +1129,8 @@ async def sync_issue_to_jira(
 # ==============================
 @router.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "principal_cache": principal_cache.stats(),
+        "copilot_context_cache": copilot_context_manager.stats()
+    }
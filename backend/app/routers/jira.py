@@ -15,7 +15,7 @@ from app.services.jira import (
 )
 from app.utils.userauth import require_bearer
 from app.utils.database import users_collection
-import httpx
+from app.utils.jiraclient import jira_client
 from fastapi.responses import RedirectResponse
 import os
 import datetime
@@ -167,8 +167,6 @@ async def refresh_jira_oauth_token(
 ):
     """刷新Jira OAuth访问令牌"""
     try:
-        import httpx
-        
         # 获取当前用户
         user = await users_collection.find_one({"username": username})
         if not user:
@@ -198,20 +196,19 @@ async def refresh_jira_oauth_token(
         import base64
         auth_header = "Basic " + base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                token_url,
-                data={
-                    "grant_type": "refresh_token",
-                    "refresh_token": refresh_token,
-                    "client_id": client_id,
-                    "client_secret": client_secret
-                },
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Authorization": auth_header
-                }
-            )
+        response = await jira_client.post(
+            token_url,
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": client_id,
+                "client_secret": client_secret
+            },
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Authorization": auth_header
+            }
+        )
         
         if response.status_code == 200:
             token_data = response.json()
@@ -266,16 +263,15 @@ async def revoke_jira_oauth_token(
         # 注意：这只是一个示例实现，实际的撤销令牌流程可能有所不同
         revoke_url = "https://auth.atlassian.com/oauth/revoke"
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                revoke_url,
-                data={
-                    "token": token,
-                    "client_id": client_id,
-                    "client_secret": client_secret
-                },
-                headers={"Content-Type": "application/x-www-form-urlencoded"}
-            )
+        response = await jira_client.post(
+            revoke_url,
+            data={
+                "token": token,
+                "client_id": client_id,
+                "client_secret": client_secret
+            },
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
             
         if response.status_code == 200:
             return {"message": "令牌已成功撤销"}
@@ -312,14 +308,13 @@ async def exchange_jira_oauth_token(
             "redirect_uri": redirect_uri
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                token_url,
-                json=token_request_data,
-                headers={
-                    "Content-Type": "application/json"
-                }
-            )
+        response = await jira_client.post(
+            token_url,
+            json=token_request_data,
+            headers={
+                "Content-Type": "application/json"
+            }
+        )
                         
         if response.status_code == 200:
             token_data = response.json()
@@ -330,14 +325,13 @@ async def exchange_jira_oauth_token(
                 # 获取可访问资源信息
                 userinfo_url = "https://api.atlassian.com/oauth/token/accessible-resources"
                 
-                async with httpx.AsyncClient() as client:
-                    userinfo_response = await client.get(
-                        userinfo_url,
-                        headers={
-                            "Authorization": f"Bearer {access_token}",
-                            "Accept": "application/json"
-                        }
-                    )
+                userinfo_response = await jira_client.get(
+                    userinfo_url,
+                    headers={
+                        "Authorization": f"Bearer {access_token}",
+                        "Accept": "application/json"
+                    }
+                )
                                         
                 if userinfo_response.status_code == 200:
                     accessible_resources = userinfo_response.json()
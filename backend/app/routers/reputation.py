@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from typing import Dict, Optional
 from app.services.reputation import reputation_service
 from app.models.user import UserResponse
@@ -6,3 +6,19 @@ from app.utils.userauth import require_bearer
 
 router = APIRouter(prefix="/reputation")
 
+
+# ==============================
+# ⭐ 分页查询信誉事件
+# ==============================
+@router.get("/{author}/events")
+async def list_reputation_events(
+    author: str,
+    before: Optional[str] = Query(None, description="上一页返回的next_before"),
+    limit: int = Query(20, ge=1, le=100, description="每页数量"),
+    username: str = Depends(require_bearer)
+):
+    """获取程序员的完整信誉事件历史（最新在前）"""
+    try:
+        return await reputation_service.list_reputation_events(author, before=before, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -5,15 +5,44 @@ import secrets
 import logging
 import os
 import json
-from bson import ObjectId
 
-from app.utils.database import codereviews_collection
+from app.services.chatstore import chat_message_store
+from app.utils.modelclient import model_client_registry
 
 from autogen_core.models import CreateResult, UserMessage, AssistantMessage, SystemMessage, ModelFamily
 from autogen_ext.models.openai import OpenAIChatCompletionClient 
    
 
+# 智能助手模型能力描述
+COPILOT_MODEL_INFO = {
+    "vision": False,
+    "function_calling": True,
+    "json_output": False,
+    "family": "openai",
+    "structured_output": False,
+}
+
+
 class AICopilotService:
+    @staticmethod
+    def get_model_client() -> OpenAIChatCompletionClient:
+        """
+        获取智能助手的模型客户端（进程内复用，共享连接池）
+
+        Raises:
+            Exception: 未配置AI_API_KEY
+        """
+        api_key = os.getenv("AI_API_KEY")
+        if not api_key:
+            raise Exception("OpenAI API key not configured. Please set AI_API_KEY environment variable.")
+        return model_client_registry.get(
+            model=os.getenv("AI_MODEL", "gpt-3.5-turbo"),
+            base_url=os.getenv("AI_API_URL", "https://api.openai.com/v1"),
+            api_key=api_key,
+            model_info=COPILOT_MODEL_INFO,
+            max_retries=2,
+        )
+
     @staticmethod
     async def get_chat_history(review_id: str) -> Optional[List]:
         """
@@ -25,11 +54,22 @@ class AICopilotService:
         Returns:
             Optional[List]: 聊天记录列表
         """
-        chat_history = await codereviews_collection.find_one({"_id": ObjectId(review_id)})
-        if not chat_history:
-            return None
+        return await chat_message_store.list_messages(review_id)
+
+    @staticmethod
+    async def get_chat_page(review_id: str, before: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """
+        从最新消息开始分页获取聊天记录
         
-        return chat_history.get("chat_history", [])
+        Args:
+            review_id: 代码审查ID
+            before: 上一页返回的 next_before
+            limit: 每页数量
+            
+        Returns:
+            Dict[str, Any]: {"messages": 消息列表, "next_before": 更早一页的游标}
+        """
+        return await chat_message_store.page(review_id, before=before, limit=limit)
 
     @staticmethod
     async def update_chat_history(review_id: str, chat_history: List[Dict[str, Any]]) -> bool:
@@ -44,15 +84,23 @@ class AICopilotService:
             bool: 更新是否成功
         """
         try:
-            result = await codereviews_collection.update_one(
-                {"_id": ObjectId(review_id)},
-                {"$set": {"chat_history": chat_history}}
-            )
-            return result.modified_count > 0
+            await chat_message_store.replace(review_id, chat_history)
+            return True
         except Exception as e:
             logging.error(f"Failed to update chat history: {e}")
             return False
 
+    @staticmethod
+    def build_chat_message(message_content: str, role: str) -> Dict[str, Any]:
+        """构建可直接写入chat_history的消息字典"""
+        # 创建可序列化的消息字典，避免MongoDB序列化问题
+        return {
+            "content": message_content,
+            "role": role,
+            "source": role,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
     @staticmethod
     async def add_chat_message(review_id: str, message_content: str, role: str) -> bool:
         """
@@ -66,23 +114,10 @@ class AICopilotService:
         Returns:
             bool: 添加是否成功
         """
-        # 创建可序列化的消息字典，避免MongoDB序列化问题
-        message_dict = {
-            "content": message_content,
-            "role": role,
-            "source": role,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+        message_dict = AICopilotService.build_chat_message(message_content, role)
 
         try:
-            result = await codereviews_collection.update_one(
-                {"_id": ObjectId(review_id)},
-                {
-                    "$push": {"chat_history": message_dict},
-                    "$set": {"updated_at": datetime.utcnow()}
-                }
-            )
-            return result.modified_count > 0
+            return await chat_message_store.append(review_id, [message_dict]) is not None
         except Exception as e:
             logging.error(f"Failed to add chat message: {e}")
             return False
@@ -100,27 +135,7 @@ class AICopilotService:
             Dict[str, Any]: 完整的AI响应消息
         """
         try:
-            # 获取OpenAI配置，使用默认值
-            model = os.getenv("AI_MODEL", "gpt-3.5-turbo")
-            api_key = os.getenv("AI_API_KEY")
-            api_base = os.getenv("AI_API_URL", "https://api.openai.com/v1")
-            
-            if not api_key:
-                raise Exception("OpenAI API key not configured. Please set AI_API_KEY environment variable.")
-            
-            model_client = OpenAIChatCompletionClient(
-                model=model,
-                api_key=api_key,
-                api_base=api_base,
-                model_info={
-                    "vision": False,
-                    "function_calling": True,
-                    "json_output": False,
-                    "family": "openai",  # 修复family字段类型
-                    "structured_output": False,
-                },
-                max_retries=2,
-            )
+            model_client = AICopilotService.get_model_client()
             
             # 转换消息格式为 autogen 消息对象（仅用于API调用）
             autogen_messages = []
@@ -178,28 +193,11 @@ class AICopilotService:
             流式响应数据
         """
         try:
-            # 获取OpenAI配置，使用默认值
-            model = os.getenv("AI_MODEL", "gpt-3.5-turbo")
-            api_key = os.getenv("AI_API_KEY")
-            base_url = os.getenv("AI_API_URL", "https://api.openai.com/v1")
-            
-            if not api_key:
+            if not os.getenv("AI_API_KEY"):
                 yield f"data: {json.dumps({'type': 'error', 'content': 'OpenAI API key not configured'})}\n\n"
                 return
             
-            model_client = OpenAIChatCompletionClient(
-                model=model,
-                api_key=api_key,
-                base_url=base_url,
-                model_info={
-                    "vision": False,
-                    "function_calling": True,
-                    "json_output": False,
-                    "family": "openai",
-                    "structured_output": False,
-                },
-                max_retries=2,
-            )
+            model_client = AICopilotService.get_model_client()
             
             # 转换消息格式为 autogen 消息对象（仅用于API调用）
             autogen_messages = []
@@ -1,33 +1,94 @@
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 import secrets
+import hmac
+import hashlib
 import logging
+import os
+import re
+import asyncio
 from bson import ObjectId
 
 from app.utils.database import apikeys_collection, users_collection
+from app.utils.cache import principal_cache
 from app.models.apikey import ApiKeyInDB, ApiKeyResponse, ApiKeyGenerated, ApiKeyStatus
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# API密钥哈希上下文
+# API密钥哈希上下文（仅用于验证旧版密钥）
 apikey_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# 计算API密钥HMAC使用的服务端pepper
+API_KEY_PEPPER = os.getenv("API_KEY_PEPPER") or os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+
+# 新版API密钥前缀，完整格式为 ak_<key_id>_<secret>
+API_KEY_PREFIX = "ak"
+
+# 是否接受旧版（无key_id）密钥，默认接受并在首次验证成功时透明升级为HMAC验证。
+# 所有旧版密钥迁移完成后可关闭，此时非 ak_<key_id>_<secret> 格式的密钥直接拒绝，不做任何bcrypt验证
+API_KEY_LEGACY_ENABLED = os.getenv("API_KEY_LEGACY_ENABLED", "true").lower() in ("1", "true", "yes")
+# 可选的旧版密钥迁移截止时间（ISO格式，如 2026-12-31），默认不设置。设置后过了该时间不再接受旧版密钥，
+# 启动时也会将未迁移的旧版密钥的过期时间设为该时间
+API_KEY_LEGACY_DEADLINE = os.getenv("API_KEY_LEGACY_DEADLINE", "")
+# 同时进行的旧版密钥bcrypt扫描数量，限制无效密钥占用的CPU
+API_KEY_LEGACY_CONCURRENCY = int(os.getenv("API_KEY_LEGACY_CONCURRENCY", "1"))
+
+# 旧版密钥为 secrets.token_urlsafe(32) 生成的43位字符串
+LEGACY_API_KEY_PATTERN = re.compile(r"[A-Za-z0-9_-]{43}")
+
+legacy_deadline = datetime.fromisoformat(API_KEY_LEGACY_DEADLINE) if API_KEY_LEGACY_DEADLINE else None
+legacy_scan_semaphore = asyncio.Semaphore(API_KEY_LEGACY_CONCURRENCY)
+
 class ApiKeyService:
     """API密钥服务类，用于处理API密钥的生成、验证和管理"""
     
     @staticmethod
-    def generate_api_key() -> str:
+    def generate_api_key() -> Tuple[str, str]:
         """
         生成安全的API密钥
         
         Returns:
-            str: 生成的API密钥
+            Tuple[str, str]: (完整API密钥, 公开的key_id)
+        """
+        # key_id用于索引查找，secret部分使用secrets模块生成安全的随机密钥
+        key_id = secrets.token_hex(8)
+        return f"{API_KEY_PREFIX}_{key_id}_{secrets.token_urlsafe(32)}", key_id
+
+    @staticmethod
+    def parse_key_id(api_key: str) -> Optional[str]:
+        """
+        从新版API密钥中解析key_id
+        
+        Args:
+            api_key: API密钥明文
+            
+        Returns:
+            Optional[str]: key_id，旧版密钥返回None
         """
-        # 使用secrets模块生成安全的随机密钥
-        return secrets.token_urlsafe(32)
+        parts = api_key.split("_", 2)
+        if len(parts) != 3 or parts[0] != API_KEY_PREFIX or len(parts[1]) != 16:
+            return None
+        try:
+            int(parts[1], 16)
+        except ValueError:
+            return None
+        return parts[1]
+
+    @staticmethod
+    def get_api_key_hmac(api_key: str) -> str:
+        """
+        计算API密钥的HMAC-SHA256摘要
+        
+        Args:
+            api_key: API密钥明文
+            
+        Returns:
+            str: 十六进制摘要
+        """
+        return hmac.new(API_KEY_PEPPER.encode("utf-8"), api_key.encode("utf-8"), hashlib.sha256).hexdigest()
     
     @staticmethod
     def get_api_key_hash(api_key: str) -> str:
@@ -89,8 +150,8 @@ class ApiKeyService:
             ApiKeyGenerated: 包含生成的API密钥的响应对象
         """
         # 生成API密钥
-        api_key = ApiKeyService.generate_api_key()
-        api_key_hash = ApiKeyService.get_api_key_hash(api_key)
+        api_key, key_id = ApiKeyService.generate_api_key()
+        api_key_hmac = ApiKeyService.get_api_key_hmac(api_key)
         key_preview = ApiKeyService.generate_key_preview(api_key)
         
         # 计算过期时间
@@ -102,7 +163,8 @@ class ApiKeyService:
         apikey_doc = {
             "username": username,
             "name": name,
-            "api_key_hash": api_key_hash,
+            "key_id": key_id,
+            "api_key_hmac": api_key_hmac,
             "key_preview": key_preview,
             "status": ApiKeyStatus.ACTIVE.value,
             "permissions": {},
@@ -189,6 +251,9 @@ class ApiKeyService:
             {"$set": {"status": status.value}}
         )
         
+        # 状态变更后立即使本进程内缓存的认证结果失效
+        principal_cache.invalidate_tag(f"apikey:{apikey_id}")
+
         if result.modified_count == 0:
             return None
         
@@ -212,6 +277,7 @@ class ApiKeyService:
         )
         
         if result.deleted_count > 0:
+            principal_cache.invalidate_tag(f"apikey:{apikey_id}")
             logger.info(f"用户 {username} 删除了API密钥: {apikey_id}")
             return True
         
@@ -242,6 +308,69 @@ class ApiKeyService:
             logger.error(f"增加API密钥使用次数失败: {str(e)}")
             return False
 
+    @staticmethod
+    def legacy_keys_accepted() -> bool:
+        """是否仍接受旧版密钥（已开启且未过迁移截止时间）"""
+        if not API_KEY_LEGACY_ENABLED:
+            return False
+        return legacy_deadline is None or datetime.utcnow() < legacy_deadline
+
+    @staticmethod
+    async def expire_legacy_api_keys() -> int:
+        """
+        为未迁移的旧版密钥设置过期时间（迁移截止时间），促使用户更换为新版密钥
+        
+        只在显式设置了 API_KEY_LEGACY_DEADLINE 时生效，默认不修改任何密钥。
+        
+        Returns:
+            int: 更新的密钥数量
+        """
+        if legacy_deadline is None:
+            return 0
+        result = await apikeys_collection.update_many(
+            {
+                "key_id": {"$exists": False},
+                "status": ApiKeyStatus.ACTIVE.value,
+                "$or": [{"expires_at": None}, {"expires_at": {"$gt": legacy_deadline}}]
+            },
+            {"$set": {"expires_at": legacy_deadline}}
+        )
+        if result.modified_count:
+            logger.info(f"{result.modified_count} 个旧版API密钥将于 {legacy_deadline.isoformat()} 过期")
+        return result.modified_count
+
+    @staticmethod
+    async def _find_legacy_api_key(api_key: str, api_key_hmac: str) -> Optional[Dict[str, Any]]:
+        """
+        在尚未升级的旧版bcrypt密钥中查找匹配项，匹配成功后写入HMAC摘要完成升级
+        
+        bcrypt验证在线程池中执行，且同时进行的扫描数量受 API_KEY_LEGACY_CONCURRENCY 限制，
+        不阻塞事件循环。
+        
+        Args:
+            api_key: API密钥明文
+            api_key_hmac: API密钥的HMAC摘要
+            
+        Returns:
+            Optional[Dict[str, Any]]: 匹配的密钥文档
+        """
+        legacy_query = {"status": ApiKeyStatus.ACTIVE.value, "api_key_hmac": {"$exists": False}}
+        async with legacy_scan_semaphore:
+            async for apikey_doc in apikeys_collection.find(legacy_query):
+                matched = await asyncio.to_thread(
+                    ApiKeyService.verify_api_key, api_key, apikey_doc.get("api_key_hash", "")
+                )
+                if not matched:
+                    continue
+                await apikeys_collection.update_one(
+                    {"_id": apikey_doc["_id"]},
+                    {"$set": {"api_key_hmac": api_key_hmac}}
+                )
+                logger.info(f"API密钥 {apikey_doc['_id']} 已升级为HMAC验证")
+                apikey_doc["api_key_hmac"] = api_key_hmac
+                return apikey_doc
+        return None
+
     @staticmethod
     async def validate_api_key(api_key: str) -> str:
         """
@@ -251,23 +380,54 @@ class ApiKeyService:
             api_key: API密钥
             
         Returns:
-            Optional[Dict[str, Any]]: 包含用户名和密钥信息的字典，如果验证失败则返回None
-        """
-        # 遍历所有API密钥进行验证（在实际应用中，可能需要优化查询方式）
-        async for apikey_doc in apikeys_collection.find({"status": ApiKeyStatus.ACTIVE.value}):
-            if ApiKeyService.verify_api_key(api_key, apikey_doc.get("api_key_hash", "")):
-                # 检查是否过期
-                if apikey_doc.get("expires_at") and apikey_doc["expires_at"] < datetime.utcnow():
-                    # 更新状态为已过期
-                    await apikeys_collection.update_one(
-                        {"_id": apikey_doc["_id"]},
-                        {"$set": {"status": ApiKeyStatus.REVOKED.value}}
-                    )
-                    return None
-                
-                return apikey_doc["username"]
+            Optional[str]: 密钥所属用户名，如果验证失败则返回None
+        """
+        apikey_doc = await ApiKeyService.authenticate_api_key(api_key)
+        return apikey_doc["username"] if apikey_doc else None
+
+    @staticmethod
+    async def authenticate_api_key(api_key: str) -> Optional[Dict[str, Any]]:
+        """
+        验证API密钥并返回密钥文档
         
-        return None
+        新版密钥通过key_id索引查找，旧版密钥在首次验证成功后通过HMAC摘要索引查找，
+        验证耗时与密钥总数无关。未开启 API_KEY_LEGACY_ENABLED（或已过迁移截止时间）时，
+        非新版格式的密钥直接拒绝。
+        
+        Args:
+            api_key: API密钥
+            
+        Returns:
+            Optional[Dict[str, Any]]: 验证通过的密钥文档，如果验证失败则返回None
+        """
+        api_key_hmac = ApiKeyService.get_api_key_hmac(api_key)
+        key_id = ApiKeyService.parse_key_id(api_key)
+
+        if key_id:
+            apikey_doc = await apikeys_collection.find_one({"key_id": key_id})
+        elif not ApiKeyService.legacy_keys_accepted() or not LEGACY_API_KEY_PATTERN.fullmatch(api_key):
+            return None
+        else:
+            apikey_doc = await apikeys_collection.find_one({"api_key_hmac": api_key_hmac})
+            if not apikey_doc:
+                apikey_doc = await ApiKeyService._find_legacy_api_key(api_key, api_key_hmac)
+
+        if not apikey_doc or not hmac.compare_digest(apikey_doc.get("api_key_hmac") or "", api_key_hmac):
+            return None
+
+        if apikey_doc.get("status") != ApiKeyStatus.ACTIVE.value:
+            return None
+
+        # 检查是否过期
+        if apikey_doc.get("expires_at") and apikey_doc["expires_at"] < datetime.utcnow():
+            # 更新状态为已过期
+            await apikeys_collection.update_one(
+                {"_id": apikey_doc["_id"]},
+                {"$set": {"status": ApiKeyStatus.REVOKED.value}}
+            )
+            return None
+        
+        return apikey_doc
 
 # 创建全局实例
 apikey_service = ApiKeyService()
\ No newline at end of file
@@ -0,0 +1,176 @@
+"""
+审查大字段存储模块
+
+diff、README、agent输出和大段聊天消息不再内嵌在 codereviews 文档中，
+而是压缩后写入按内容寻址的 review_blobs 集合（_id 为原文的SHA-256），
+相同的diff/README在多次审查之间只存一份。审查文档只保存 blob_refs 引用，
+详情视图读取时再批量取回并解压。
+
+压缩算法优先使用zstd（需安装zstandard），未安装时使用gzip。
+"""
+
+import os
+import gzip
+import json
+import asyncio
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from bson import Binary
+from pymongo.errors import DuplicateKeyError
+
+from app.utils.database import get_collection
+
+try:
+    import zstandard
+except ImportError:  # zstandard为可选依赖
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 压缩算法：zstd | gzip
+REVIEW_BLOB_CODEC = os.getenv("REVIEW_BLOB_CODEC", "zstd" if zstandard else "gzip").lower()
+# 小于该字节数的字段仍然内嵌存储
+REVIEW_BLOB_MIN_BYTES = int(os.getenv("REVIEW_BLOB_MIN_BYTES", "4096"))
+# 超过该字节数时在线程池中压缩/解压，避免阻塞事件循环
+REVIEW_BLOB_THREAD_BYTES = 256 * 1024
+
+
+def _compress(codec: str, raw: bytes) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=6).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("读取zstd压缩的数据需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ReviewBlobStore:
+    """按内容寻址的压缩文本存储"""
+
+    def __init__(self, collection, codec: str = REVIEW_BLOB_CODEC, min_bytes: int = REVIEW_BLOB_MIN_BYTES):
+        if codec == "zstd" and zstandard is None:
+            logger.warning("未安装zstandard，审查大字段改用gzip压缩")
+            codec = "gzip"
+        self.collection = collection
+        self.codec = codec
+        self.min_bytes = min_bytes
+
+    async def put(self, text: str) -> str:
+        """写入文本并返回引用（内容相同的文本只存一份）"""
+        raw = text.encode("utf-8")
+        ref = hashlib.sha256(raw).hexdigest()
+
+        # 已存在时跳过压缩
+        if await self.collection.find_one({"_id": ref}, {"_id": 1}):
+            return ref
+
+        if len(raw) >= REVIEW_BLOB_THREAD_BYTES:
+            data = await asyncio.to_thread(_compress, self.codec, raw)
+        else:
+            data = _compress(self.codec, raw)
+        try:
+            await self.collection.update_one(
+                {"_id": ref},
+                {"$setOnInsert": {
+                    "codec": self.codec,
+                    "data": Binary(data),
+                    "size": len(raw),
+                    "stored_size": len(data),
+                    "created_at": datetime.utcnow()
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # 并发写入同一内容，另一方已写入
+            pass
+        return ref
+
+    async def get_many(self, refs: Iterable[str]) -> Dict[str, str]:
+        """批量读取并解压文本，返回 引用 -> 文本"""
+        refs = list({ref for ref in refs if ref})
+        if not refs:
+            return {}
+        texts: Dict[str, str] = {}
+        async for blob in self.collection.find({"_id": {"$in": refs}}):
+            data = bytes(blob["data"])
+            if blob.get("size", 0) >= REVIEW_BLOB_THREAD_BYTES:
+                raw = await asyncio.to_thread(_decompress, blob["codec"], data)
+            else:
+                raw = _decompress(blob["codec"], data)
+            texts[blob["_id"]] = raw.decode("utf-8")
+        missing = set(refs) - texts.keys()
+        if missing:
+            logger.error(f"审查大字段缺失: {sorted(missing)}")
+        return texts
+
+    async def offload(self, fields: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, str]]]:
+        """
+        将超过阈值的字段写入blob存储
+
+        Args:
+            fields: 字段名 -> 值（字符串按原文存储，其他类型按JSON存储）
+
+        Returns:
+            Tuple: (替换后的内嵌字段, blob_refs)。被外置的字段内嵌值替换为空串/空列表，
+            blob_refs 形如 {字段名: {"ref": 引用, "format": "text" | "json"}}
+        """
+        inline: Dict[str, Any] = {}
+        refs: Dict[str, Dict[str, str]] = {}
+        for name, value in fields.items():
+            is_text = isinstance(value, str)
+            serialized = value if is_text else json.dumps(value, ensure_ascii=False, default=str)
+            if value is None or len(serialized.encode("utf-8")) < self.min_bytes:
+                inline[name] = value
+                continue
+            refs[name] = {"ref": await self.put(serialized), "format": "text" if is_text else "json"}
+            inline[name] = "" if is_text else []
+        return inline, refs
+
+    async def offload_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """将大段聊天消息内容外置，消息中保留 content_ref"""
+        result = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str) and len(content.encode("utf-8")) >= self.min_bytes:
+                message = {**message, "content": "", "content_ref": await self.put(content)}
+            result.append(message)
+        return result
+
+    async def resolve_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """还原外置的聊天消息内容"""
+        texts = await self.get_many(m.get("content_ref") for m in messages if isinstance(m, dict))
+        if not texts:
+            return messages
+        resolved = []
+        for message in messages:
+            if isinstance(message, dict) and message.get("content_ref") in texts:
+                message = {**message, "content": texts[message["content_ref"]]}
+                message.pop("content_ref")
+            resolved.append(message)
+        return resolved
+
+    async def resolve(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """还原审查文档中外置的字段（只还原文档中已投影的字段）"""
+        refs: Dict[str, Dict[str, str]] = doc.pop("blob_refs", None) or {}
+        wanted = {name: spec for name, spec in refs.items() if name in doc}
+        texts = await self.get_many(spec["ref"] for spec in wanted.values())
+        for name, spec in wanted.items():
+            text = texts.get(spec["ref"])
+            if text is None:
+                continue
+            doc[name] = json.loads(text) if spec.get("format") == "json" else text
+        if isinstance(doc.get("chat_history"), list):
+            doc["chat_history"] = await self.resolve_messages(doc["chat_history"])
+        return doc
+
+
+# 创建全局实例
+review_blob_store = ReviewBlobStore(get_collection("review_blobs"))
@@ -0,0 +1,172 @@
+"""
+审查聊天记录存储模块
+
+智能助手的聊天消息不再 $push 到 codereviews.chat_history，而是逐条追加到
+chat_messages 集合，按 (review_id, seq) 建索引，读取聊天记录只是一次范围查询，
+审查文档也不再随对话增长。seq 由审查文档上的 chat_seq 计数器（$inc）分配，
+同一审查内严格递增。超过阈值的消息内容仍外置到 review_blobs。
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from app.utils.database import get_collection, codereviews_collection, mongo_transaction
+from app.services.blobstore import review_blob_store
+
+logger = logging.getLogger(__name__)
+
+# 重复键错误码
+DUPLICATE_KEY_ERROR = 11000
+
+
+class ChatMessageStore:
+    """按审查分组、只追加的聊天消息存储"""
+
+    def __init__(self, collection, reviews_collection=codereviews_collection, blob_store=review_blob_store):
+        self.collection = collection
+        self.reviews_collection = reviews_collection
+        self.blob_store = blob_store
+
+    async def insert(
+        self,
+        review_id: str,
+        first_seq: int,
+        messages: List[Dict[str, Any]],
+        session=None,
+        ordered: bool = True
+    ) -> None:
+        """
+        以已分配好的序号写入消息
+
+        Args:
+            review_id: 审查ID
+            first_seq: 第一条消息的序号
+            messages: 消息列表（build_chat_message 格式）
+            session: 可选的事务会话
+            ordered: 为False时遇到重复序号继续写入其余消息
+        """
+        if not messages:
+            return
+        messages = await self.blob_store.offload_messages(messages)
+        now = datetime.utcnow()
+        docs = [
+            {**message, "review_id": review_id, "seq": first_seq + offset, "created_at": now}
+            for offset, message in enumerate(messages)
+        ]
+        await self.collection.insert_many(docs, ordered=ordered, session=session)
+
+    async def append(self, review_id: str, messages: List[Dict[str, Any]], session=None) -> Optional[int]:
+        """
+        追加消息
+
+        Returns:
+            Optional[int]: 最后一条消息的序号，审查不存在时返回None
+        """
+        if not messages:
+            return None
+        review = await self.reviews_collection.find_one_and_update(
+            {"_id": ObjectId(review_id)},
+            {"$inc": {"chat_seq": len(messages)}, "$set": {"updated_at": datetime.utcnow()}},
+            projection={"chat_seq": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if review is None:
+            return None
+        last_seq = review["chat_seq"]
+        await self.insert(review_id, last_seq - len(messages) + 1, messages, session=session)
+        return last_seq
+
+    async def _read(self, query: Dict[str, Any], sort: int, limit: Optional[int]) -> List[Dict[str, Any]]:
+        cursor = self.collection.find(query, {"_id": 0, "review_id": 0, "created_at": 0}).sort("seq", sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        messages = await cursor.to_list(length=limit)
+        if sort < 0:
+            messages.reverse()
+        return await self.blob_store.resolve_messages(messages)
+
+    async def list_messages(self, review_id: str, after: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """按顺序读取序号大于after的消息"""
+        return await self._read({"review_id": review_id, "seq": {"$gt": after}}, 1, limit)
+
+    async def tail(self, review_id: str, limit: int) -> List[Dict[str, Any]]:
+        """读取最近的limit条消息（按时间正序返回）"""
+        return await self._read({"review_id": review_id}, -1, limit)
+
+    async def page(self, review_id: str, before: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """
+        从新到旧分页读取，供前端向上翻页
+
+        Returns:
+            Dict: {"messages": 按时间正序的消息, "next_before": 更早一页的游标（没有更多时为None）}
+        """
+        query: Dict[str, Any] = {"review_id": review_id}
+        if before:
+            query["seq"] = {"$lt": before}
+        messages = await self._read(query, -1, limit + 1)
+        has_more = len(messages) > limit
+        messages = messages[-limit:] if has_more else messages
+        return {"messages": messages, "next_before": messages[0]["seq"] if has_more and messages else None}
+
+    async def replace(self, review_id: str, messages: List[Dict[str, Any]]) -> None:
+        """
+        用新的消息列表替换审查的全部聊天记录（序号继续递增，不复用）
+
+        先写入新消息再删除序号更早的旧消息：中途失败时最多暂时保留新旧两份记录，不会丢失
+        聊天记录；启用事务（MONGO_USE_TRANSACTIONS）时两步一起提交。旧记录的滚动摘要同时清除。
+        """
+        async with mongo_transaction() as session:
+            if messages:
+                last_seq = await self.append(review_id, messages, session=session)
+                if last_seq is None:
+                    return
+                old_messages = {"review_id": review_id, "seq": {"$lt": last_seq - len(messages) + 1}}
+            else:
+                old_messages = {"review_id": review_id}
+            await self.collection.delete_many(old_messages, session=session)
+            await self.reviews_collection.update_one(
+                {"_id": ObjectId(review_id)}, {"$unset": {"copilot_summary": ""}}, session=session
+            )
+
+    async def delete(self, review_id: str, session=None) -> None:
+        """删除审查的全部聊天记录"""
+        await self.collection.delete_many({"review_id": review_id}, session=session)
+
+    async def migrate_embedded(self) -> int:
+        """
+        将审查文档中内嵌的 chat_history 迁移到 chat_messages
+
+        消息按原顺序编号为 1..n，(review_id, seq) 唯一索引保证中断后重新执行不会重复写入。
+
+        Returns:
+            int: 迁移的审查数量
+        """
+        migrated = 0
+        query = {"chat_history.0": {"$exists": True}}
+        async for review in self.reviews_collection.find(query, {"chat_history": 1}):
+            review_id = str(review["_id"])
+            history = [message for message in review["chat_history"] if isinstance(message, dict)]
+            try:
+                await self.insert(review_id, 1, history, ordered=False)
+            except BulkWriteError as e:
+                # 上次迁移中断时已写入的部分
+                if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                    raise
+            await self.reviews_collection.update_one(
+                {"_id": review["_id"]},
+                {"$max": {"chat_seq": len(history)}, "$unset": {"chat_history": ""}}
+            )
+            migrated += 1
+        if migrated:
+            logger.info(f"已将 {migrated} 个审查的聊天记录迁移到 chat_messages")
+        return migrated
+
+
+# 创建全局实例
+chat_message_store = ChatMessageStore(get_collection("chat_messages"))
@@ -7,7 +7,7 @@ review模块主入口
 from .service import AICodeReviewService
 from .models import AgentBuffer, ReviewResult, ReviewRequest
 from .factory import get_ai_code_review_service, create_ai_code_review_service
-from .flow_builder import create_default_flow
+from .flow_builder import create_default_flow, create_parallel_flow, create_review_flow
 from .utils import JSONParser, ContentAnalyzer, ResultFormatter
 from .config import logger, setup_logger, silence_autogen_console, get_system_prompt
 from .database import AICodeReviewDatabaseService
@@ -30,6 +30,8 @@ __all__ = [
     
     # GraphFlow构建
     "create_default_flow", 
+    "create_parallel_flow",
+    "create_review_flow",
     "get_flow_builder",
     
     # 工具类
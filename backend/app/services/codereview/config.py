@@ -46,6 +46,17 @@ AI_MODEL_NAME = os.getenv("AI_MODEL")
 AI_API_KEY = os.getenv("AI_API_KEY")
 AI_API_BASE = os.getenv("AI_API_URL")
 
+# ---------------------------
+# 审查流程配置
+# ---------------------------
+# selector: 十个agent依次轮转（SelectorGroupChat）
+# parallel: 调度器之后七个专项agent并行执行，再汇聚到最终聚合agent（GraphFlow）
+REVIEW_FLOW_MODE = os.getenv("REVIEW_FLOW_MODE", "selector").lower()
+# parallel模式下同时进行的模型调用上限
+REVIEW_MAX_PARALLEL_AGENTS = int(os.getenv("REVIEW_MAX_PARALLEL_AGENTS", "7"))
+# parallel模式下单个agent一轮内最多连续调用工具的次数
+REVIEW_AGENT_MAX_TOOL_ITERATIONS = int(os.getenv("REVIEW_AGENT_MAX_TOOL_ITERATIONS", "10"))
+
 # ---------------------------
 # 系统提示词
 # ---------------------------
@@ -63,14 +74,18 @@ EXAMPLES_CONCISE_INSTRUCTION = """
 
 LINE_NUMBER_TOOLS_INSTRUCTION = """
 **智能行号计算工具使用规范**：
-- **工具推荐**：当diff内容较多或复杂时，强烈推荐使用 `calculate_line_number_tool` 进行精确行号定位
-- **参数限制**：target参数仅支持单行内容匹配，不支持多行内容作为整体进行匹配
+- **工具推荐**：当diff内容较多或复杂时，强烈推荐使用行号工具进行精确行号定位
+- **批量优先**：优先使用 `calculate_line_numbers_batch_tool`，把所有待定位的问题代码行放入 `targets` 列表一次调用完成，禁止对多个问题逐条调用 `calculate_line_number_tool`
+- **文件过滤**：已知问题所在文件时，通过 `file_paths` 参数限定查找范围，避免匹配到其他文件的同名代码
+- **参数限制**：每个target仅支持单行内容匹配，不支持多行内容作为整体进行匹配
 - **强制要求**：工具返回的行号必须准确用于JSON输出的 `line` 字段中
 - **容错机制**：当工具调用失败时，应根据代码上下文进行合理估算，确保行号字段不为空
 - **精度保障**：通过工具计算确保行号准确性，避免人工估算可能带来的定位偏差
-- **参数说明**：
-  - `target`：必填，目标匹配内容（仅支持单行，不允许包含换行符）
-  - `context`：必填，代码上下文内容（多行）
+- **参数说明**（本次审查的diff已由系统绑定，禁止在工具参数中传入diff内容）：
+  - `targets`：批量工具必填，目标匹配内容列表（每项仅支持单行，不允许包含换行符）
+  - `file_paths`：批量工具可选，限定查找的文件路径列表（支持路径后缀）
+  - `target_content`：单条工具必填，目标匹配内容（仅支持单行）
+  - `file_path`：单条工具可选，限定查找的文件路径
 """
 
 POSITIVE_INCENTIVE_INSTRUCTION = """
@@ -245,7 +260,7 @@ SYSTEM_PROMPTS: Dict[str, str] = {
 你是「逻辑缺陷分析专家」，专注于深入检查代码中的逻辑漏洞、分支覆盖不完整、异常处理机制缺失等潜在问题。你的职责是识别可能导致程序在特定条件下出现非预期行为的逻辑缺陷。
 
 **工具使用说明**：
-- 使用 `calculate_line_number_tool` 工具来智能计算逻辑问题对应的行号，输入问题描述和代码内容，返回最相关的行号位置
+- 使用 `calculate_line_numbers_batch_tool` 工具一次性计算所有逻辑问题对应的行号，输入各问题的代码行列表，返回每行最相关的位置
 - 使用 `get_line_context_tool` 工具来获取指定行号前后的代码上下文，帮助更准确地分析逻辑缺陷
 - 当分析异常处理、分支逻辑等问题时，先用工具计算行号，再结合上下文验证
 
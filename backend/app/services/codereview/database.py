@@ -1,3 +1,5 @@
+import json
+import base64
 import logging
 from motor.motor_asyncio import AsyncIOMotorCollection
 from typing import List, Optional, Dict, Any
@@ -7,24 +9,91 @@ from bson import ObjectId
 from app.models.codereview import (
     CodeReviewCreate, CodeReviewUpdate, CodeReviewResponse, 
     CodeReviewStats, CodeReviewListResponse, AgentOutput,
-    ReviewStatus,SimpleCodeReviewListResponse,SimpleCodeReviewResponse
+    ReviewStatus,SimpleCodeReviewListResponse,SimpleCodeReviewResponse,
+    CodeReviewBaseResponse, CodeReviewDetailResponse
+)
+from app.services.blobstore import review_blob_store
+from app.services.chatstore import chat_message_store
+from app.utils.cache import review_count_cache
+from app.utils.database import mongo_transaction
+from app.services.codereview.stats import (
+    review_stats_rollup, live_counters, stats_label, agent_summary, REVIEW_STATS_ROLLUP
 )
 
 logger = logging.getLogger(__name__)
 
 
+def _projection_for(model) -> Dict[str, int]:
+    """根据响应模型的字段生成Mongo投影，只读取模型需要的字段"""
+    return {(field.alias or name): 1 for name, field in model.model_fields.items()}
+
+
+# 审查记录的读取视图：视图名 -> (Mongo投影, 响应模型)
+# base 不读取diff、README、agent输出和聊天记录等大字段；detail 读取详情页需要的全部字段
+REVIEW_VIEWS = {
+    "base": (_projection_for(CodeReviewBaseResponse), CodeReviewBaseResponse),
+    "detail": ({**_projection_for(CodeReviewDetailResponse), "blob_refs": 1}, CodeReviewResponse),
+}
+
+# 超过阈值时外置到 review_blobs 的大字段
+BLOB_FIELDS = ("diff_content", "readme_content")
+
+# 更新状态时读取的旧值，用于维护统计汇总和分配聊天消息序号
+STATS_PROJECTION = {"username": 1, "created_at": 1, "status": 1, "chat_seq": 1}
+
+# 列表排序：created_at 相同时按 _id 区分，保证游标翻页不重不漏
+LIST_SORT = [("created_at", -1), ("_id", -1)]
+
+
+def encode_list_cursor(doc: Dict[str, Any]) -> str:
+    """将一页最后一条记录的 (created_at, _id) 编码为不透明的游标"""
+    raw = json.dumps({"t": doc["created_at"].isoformat(), "id": str(doc["_id"])}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_list_cursor(cursor: str) -> Dict[str, Any]:
+    """
+    将游标解码为查询条件：取排在游标之后（更早）的记录
+
+    Raises:
+        ValueError: 游标格式无效
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        created_at = datetime.fromisoformat(data["t"])
+        last_id = ObjectId(data["id"])
+    except Exception as e:
+        raise ValueError(f"无效的分页游标: {cursor}") from e
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": last_id}}
+    ]}
+
+
 class AICodeReviewDatabaseService:
     """代码审查数据库服务类 - 专门处理代码审查相关的数据库操作"""
     
-    def __init__(self, collection):
+    def __init__(self, collection, blob_store=review_blob_store, stats=review_stats_rollup, chat_store=chat_message_store):
         self.collection = collection
+        self.blob_store = blob_store
+        self.stats = stats
+        self.chat_store = chat_store
+
+    async def _resolve(self, doc: Dict[str, Any], projection: Dict[str, Any]) -> Dict[str, Any]:
+        """还原外置的大字段；视图需要聊天记录时从 chat_messages 读取"""
+        doc = await self.blob_store.resolve(doc)
+        if "chat_history" in projection:
+            doc["chat_history"] = await self.chat_store.list_messages(str(doc["_id"]))
+        return doc
     
-    async def create_review(self, review_data: CodeReviewCreate, username: str) -> str:
+    async def create_review(self, review_data: CodeReviewCreate, username: str, review_id: Optional[str] = None) -> str:
         """创建新的代码审查记录
         
         Args:
             review_data: 审查数据
             username: 用户ID（有效的ObjectId字符串）
+            review_id: 预先分配的审查ID（异步任务先把ID记录在任务上，重新执行时据此续接）
             
         Returns:
             str: 创建的审查记录ID
@@ -47,33 +116,74 @@ class AICodeReviewDatabaseService:
             "agent_outputs": [],
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow(),
-            "username": review_data.username,
-            "chat_history": review_data.chat_history
+            "username": review_data.username
         }
+
+        if review_id:
+            review_doc["_id"] = ObjectId(review_id)
+
+        # 大字段压缩后外置存储，相同内容跨审查去重
+        inline_fields, blob_refs = await self.blob_store.offload(
+            {field: review_doc[field] for field in BLOB_FIELDS}
+        )
+        review_doc.update(inline_fields)
+        if blob_refs:
+            review_doc["blob_refs"] = blob_refs
         
         logger.debug("准备插入的文档内容: %s", {k: v for k, v in review_doc.items() if k not in ['diff_base64', 'pr_title_b64', 'pr_body_b64', 'readme_b64', 'comments_b64']})
         
-        result = await self.collection.insert_one(review_doc)
-        review_id = str(result.inserted_id)
+        # 聊天记录单独存放在 chat_messages，序号预先在审查文档的 chat_seq 中分配
+        chat_history = review_data.chat_history or []
+        review_doc["chat_seq"] = len(chat_history)
+
+        async with mongo_transaction() as session:
+            result = await self.collection.insert_one(review_doc, session=session)
+            review_id = str(result.inserted_id)
+            try:
+                await self.chat_store.insert(review_id, 1, chat_history, session=session)
+            except Exception:
+                if session is None:
+                    # 未启用事务时撤销已写入的审查记录，不留下缺少初始系统消息的审查
+                    logger.error("写入审查 %s 的初始聊天记录失败，撤销审查记录", review_id)
+                    await self.chat_store.delete(review_id)
+                    await self.collection.delete_one({"_id": result.inserted_id})
+                raise
+            await self.stats.record_created(review_doc, session=session)
+        review_count_cache.invalidate(review_doc["username"])
         
         logger.info("成功创建代码审查记录，审查ID: %s", review_id)
         return review_id
     
-    async def get_review_by_id(self, review_id: str) -> Optional[CodeReviewResponse]:
-        """根据ID获取代码审查记录"""
+    async def get_review_state(self, review_id: str) -> Optional[Dict[str, Any]]:
+        """读取审查的状态、最终结果和错误信息（不还原外置字段），审查不存在时返回None"""
+        return await self.collection.find_one(
+            {"_id": ObjectId(review_id)}, {"status": 1, "final_result": 1, "error": 1}
+        )
+
+    async def get_review_by_id(self, review_id: str, view: str = "detail") -> Optional[CodeReviewBaseResponse]:
+        """根据ID获取代码审查记录
+        
+        Args:
+            review_id: 审查记录ID
+            view: 读取视图，base 只读取基础字段，detail 读取完整详情
+        """
+        projection, model = REVIEW_VIEWS[view]
         try:
-            doc = await self.collection.find_one({"_id": ObjectId(review_id)})
+            doc = await self.collection.find_one({"_id": ObjectId(review_id)}, projection)
             if doc:
-                return self._convert_to_response(doc)
+                return self._convert_to_response(await self._resolve(doc, projection), model)
             return None
         except Exception:
             return None
     
-    async def get_review_by_github_action_id(self, github_action_id: str, username: str) -> Optional[CodeReviewResponse]:
+    async def get_review_by_github_action_id(
+        self, github_action_id: str, username: str, view: str = "detail"
+    ) -> Optional[CodeReviewBaseResponse]:
         """根据GitHub Action ID获取代码审查记录"""
-        doc = await self.collection.find_one({"github_action_id": github_action_id, "username": username})
+        projection, model = REVIEW_VIEWS[view]
+        doc = await self.collection.find_one({"github_action_id": github_action_id, "username": username}, projection)
         if doc:
-            return self._convert_to_response(doc)
+            return self._convert_to_response(await self._resolve(doc, projection), model)
         return None
     
     async def update_review(self, review_id: str, update_data: CodeReviewUpdate) -> bool:
@@ -86,8 +196,12 @@ class AICodeReviewDatabaseService:
         if update_data.status:
             update_doc["status"] = update_data.status
             logger.debug("更新状态为: %s", update_data.status)
+        unset_doc = {}
         if update_data.agent_outputs is not None:
             update_doc["agent_outputs"] = update_data.agent_outputs
+            update_doc["agent_summary"] = agent_summary(update_data.agent_outputs)
+            # 内嵌值覆盖之前外置的agent输出
+            unset_doc["blob_refs.agent_outputs"] = ""
             logger.debug("更新agent_outputs，数量: %d", len(update_data.agent_outputs))
         if update_data.final_result is not None:
             update_doc["final_result"] = update_data.final_result
@@ -98,13 +212,92 @@ class AICodeReviewDatabaseService:
         
         logger.debug("更新文档内容: %s", update_doc)
         
+        update = {"$set": update_doc}
+        if unset_doc:
+            update["$unset"] = unset_doc
         result = await self.collection.update_one(
             {"_id": ObjectId(review_id)},
-            {"$set": update_doc}
+            update
         )
         
             
         return result.modified_count > 0
+
+    async def commit_review_result(
+        self,
+        review_id: str,
+        agent_outputs: List[Dict[str, Any]],
+        final_result: Optional[Dict[str, Any]],
+        started_at: Optional[datetime] = None,
+        chat_messages: Optional[List[Dict[str, Any]]] = None,
+        session=None
+    ) -> bool:
+        """一次写入审查的最终结果
+        
+        状态、agent输出、最终结果与耗时在同一个 $set 中写入，读取方不会看到
+        status=completed 但结果缺失的中间状态；可同时追加聊天记录。
+        
+        Args:
+            review_id: 审查记录ID
+            agent_outputs: agent输出列表（AgentOutput.to_dict()格式）
+            final_result: 解析后的最终结果
+            started_at: 审查开始时间，用于计算耗时
+            chat_messages: 需要一并追加到聊天记录的消息
+            session: 可选的事务会话
+            
+        Returns:
+            bool: 是否写入成功
+        """
+        # agent原始输出外置存储（blob写入在结果提交之前完成）
+        inline_fields, blob_refs = await self.blob_store.offload({"agent_outputs": agent_outputs})
+
+        now = datetime.utcnow()
+        update_doc: Dict[str, Any] = {
+            "status": ReviewStatus.COMPLETED,
+            "agent_outputs": inline_fields["agent_outputs"],
+            # agent输出外置后统计聚合仍可读取每个agent的输出规模
+            "agent_summary": agent_summary(agent_outputs),
+            "final_result": final_result if final_result is not None else {},
+            "completed_at": now,
+            "updated_at": now
+        }
+        if started_at:
+            update_doc["started_at"] = started_at
+            update_doc["duration_ms"] = int((now - started_at).total_seconds() * 1000)
+
+        update: Dict[str, Any] = {"$set": update_doc}
+        if blob_refs:
+            update_doc["blob_refs.agent_outputs"] = blob_refs["agent_outputs"]
+        else:
+            update["$unset"] = {"blob_refs.agent_outputs": ""}
+        if chat_messages:
+            # 在同一次更新中为聊天消息分配序号
+            update["$inc"] = {"chat_seq": len(chat_messages)}
+
+        before = await self.collection.find_one_and_update(
+            {"_id": ObjectId(review_id)}, update, projection=STATS_PROJECTION, session=session
+        )
+        if before is None:
+            return False
+        if chat_messages:
+            await self.chat_store.insert(review_id, (before.get("chat_seq") or 0) + 1, chat_messages, session=session)
+        await self.stats.record_status_change(
+            before, ReviewStatus.COMPLETED, final_result, agent_outputs, session=session
+        )
+        return True
+
+    async def mark_review_failed(self, review_id: str, error: str, session=None) -> bool:
+        """将审查记录标记为失败"""
+        before = await self.collection.find_one_and_update(
+            {"_id": ObjectId(review_id)},
+            {"$set": {"status": ReviewStatus.FAILED, "error": error, "updated_at": datetime.utcnow()}},
+            projection=STATS_PROJECTION,
+            session=session
+        )
+        if before is None:
+            return False
+        await self.stats.record_status_change(before, ReviewStatus.FAILED, session=session)
+        return True
     
     async def add_agent_output(self, review_id: str, agent_output: AgentOutput) -> bool:
         """添加agent输出到审查记录"""
@@ -123,7 +316,9 @@ class AICodeReviewDatabaseService:
                 "$set": {
                     "updated_at": datetime.utcnow(),
                     "status": ReviewStatus.PROCESSING
-                }
+                },
+                # 统计改为按内嵌的 agent_outputs 计算
+                "$unset": {"agent_summary": ""}
             }
         )
         
@@ -139,14 +334,23 @@ class AICodeReviewDatabaseService:
         self, 
         username: Optional[str] = None,
         skip: int = 0,
-        limit: int = 20
+        limit: int = 20,
+        cursor: Optional[str] = None
     ) -> CodeReviewListResponse:
-        """获取代码审查记录列表"""
-        query = {'username': username}
+        """获取代码审查记录列表
 
-        
-        # 获取总数
-        total = await self.collection.count_documents(query)
+        传入 cursor（上一页返回的 next_cursor）时按 (created_at, _id) 做键集分页，
+        无论翻到第几页耗时都相同；否则按 skip 分页，仅为兼容按页码跳转。
+
+        Raises:
+            ValueError: 游标格式无效
+        """
+        query = {'username': username}
+        # 游标模式下skip只用于计算返回的页码
+        offset = skip
+        if cursor:
+            query.update(decode_list_cursor(cursor))
+            offset = 0
         
         # 只返回必要的字段，排除大字段如diff_content、pr_body、readme_content等
         projection = {
@@ -160,9 +364,11 @@ class AICodeReviewDatabaseService:
             'pr_body': 1
         }
         
-        # 获取记录，只包含必要字段
-        cursor = self.collection.find(query, projection).sort("created_at", -1).skip(skip).limit(limit)
-        docs = await cursor.to_list(length=limit)
+        # 多取一条用于判断是否还有下一页
+        docs = await self.collection.find(query, projection).sort(LIST_SORT).skip(offset).limit(limit + 1).to_list(length=limit + 1)
+        has_next = len(docs) > limit
+        docs = docs[:limit]
+        next_cursor = encode_list_cursor(docs[-1]) if has_next else None
         
         # 转换ObjectId并创建CodeReviewBaseResponse实例
         reviews = []
@@ -176,54 +382,64 @@ class AICodeReviewDatabaseService:
                 # 使用CodeReviewBaseResponse而不是CodeReviewResponse
                 reviews.append(SimpleCodeReviewResponse(**doc))
         
-        has_next = skip + limit < total
-        
         return SimpleCodeReviewListResponse(
             reviews=reviews,
-            total=total,
+            total=await self.count_reviews(username),
             page=skip // limit + 1,
             size=len(reviews),
-            has_next=has_next
+            has_next=has_next,
+            next_cursor=next_cursor
         )
+
+    async def count_reviews(self, username: Optional[str]) -> int:
+        """用户审查总数，短时间缓存避免每次翻页都重新计数"""
+        total = review_count_cache.get(username)
+        if total is None:
+            total = await self.collection.count_documents({'username': username})
+            review_count_cache.set(username, total)
+        return total
     
-    async def get_review_stats(self, username: Optional[str] = None) -> CodeReviewStats:
-        """获取审查统计信息"""
-        query = {}
-        if username:
-            query["created_by"] = ObjectId(username)
-        
-        # 获取各种状态的统计
-        total_reviews = await self.collection.count_documents(query)
-        completed_reviews = await self.collection.count_documents({**query, "status": ReviewStatus.COMPLETED})
-        failed_reviews = await self.collection.count_documents({**query, "status": ReviewStatus.FAILED})
-        pending_reviews = await self.collection.count_documents({**query, "status": ReviewStatus.PENDING})
-        
-        # 最活跃的仓库
-        repo_stats = await self.collection.aggregate([
-            {"$match": query},
-            {"$group": {"_id": {"repo_owner": "$repo_owner", "repo_name": "$repo_name"}, "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 1}
-        ]).to_list(length=1)
-        most_active_repo = f"{repo_stats[0]['_id']['repo_owner']}/{repo_stats[0]['_id']['repo_name']}" if repo_stats else None
-        
-        # 最活跃的用户
-        user_stats = await self.collection.aggregate([
-            {"$group": {"_id": "$author", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 1}
-        ]).to_list(length=1)
-        most_active_user = user_stats[0]["_id"] if user_stats else None
+    async def get_review_stats(self, username: Optional[str] = None, days: Optional[int] = None) -> CodeReviewStats:
+        """获取审查统计信息
+
+        默认读取按天汇总的 review_stats_daily（O(天数)），REVIEW_STATS_ROLLUP 关闭时
+        用一次 $facet 聚合实时计算（不支持 days 过滤）。
+
+        Args:
+            username: 审查所属用户，为None时统计全部用户
+            days: 只统计最近days天创建的审查
+        """
+        if REVIEW_STATS_ROLLUP:
+            counters = await self.stats.read(username, days)
+        else:
+            counters = await live_counters(self.collection, username)
+
+        def most_common(bucket: Dict[str, int]) -> Optional[str]:
+            return stats_label(max(bucket, key=bucket.get)) if bucket else None
+
+        status_counts = counters["status"]
+        top_issues = [
+            {"bug_type": stats_label(bug_type), "count": count}
+            for bug_type, count in sorted(counters["bug_type"].items(), key=lambda item: -item[1])[:10]
+        ]
+        agent_performance = {
+            stats_label(agent): {
+                "outputs": metrics.get("outputs", 0),
+                "avg_output_chars": round(metrics.get("output_chars", 0) / metrics["outputs"]) if metrics.get("outputs") else 0
+            }
+            for agent, metrics in counters["agents"].items()
+        }
         
         return CodeReviewStats(
-            total_reviews=total_reviews,
-            completed_reviews=completed_reviews,
-            failed_reviews=failed_reviews,
-            pending_reviews=pending_reviews,
-            most_active_repo=most_active_repo,
-            most_active_user=most_active_user,
-            top_issues=[],
-            agent_performance={}
+            total_reviews=counters["total"],
+            completed_reviews=status_counts.get(ReviewStatus.COMPLETED.value, 0),
+            failed_reviews=status_counts.get(ReviewStatus.FAILED.value, 0),
+            pending_reviews=status_counts.get(ReviewStatus.PENDING.value, 0),
+            most_active_repo=most_common(counters["repos"]),
+            most_active_user=most_common(counters["authors"]),
+            top_issues=top_issues,
+            severity_counts={stats_label(key): count for key, count in counters["severity"].items()},
+            agent_performance=agent_performance
         )
     
     async def add_review_report(self, review_data: Dict[str, Any]) -> bool:
@@ -318,11 +534,12 @@ class AICodeReviewDatabaseService:
             
         return result.deleted_count > 0
 
-    async def get_latest_review_by_username(self, username: str) -> Optional[CodeReviewResponse]:
+    async def get_latest_review_by_username(self, username: str, view: str = "detail") -> Optional[CodeReviewBaseResponse]:
         """根据用户名获取最近一条代码审查记录
         
         Args:
             username: 用户名（邮箱或用户名）
+            view: 读取视图，base 只读取基础字段，detail 读取完整详情
             
         Returns:
             Optional[CodeReviewResponse]: 最近一条审查记录，如果没有则返回None
@@ -330,11 +547,12 @@ class AICodeReviewDatabaseService:
         
         try:
             # 查询该用户的最新一条记录，按创建时间倒序排列
-            cursor = self.collection.find({"username": username}).sort("created_at", -1).limit(1)
+            projection, model = REVIEW_VIEWS[view]
+            cursor = self.collection.find({"username": username}, projection).sort("created_at", -1).limit(1)
             docs = await cursor.to_list(length=1)
             
             if docs:
-                review = self._convert_to_response(docs[0])
+                review = self._convert_to_response(await self._resolve(docs[0], projection), model)
                 return review
             else:
                 logger.info("用户没有代码审查记录，用户名: %s", username)
@@ -344,11 +562,11 @@ class AICodeReviewDatabaseService:
             logger.exception("查询用户最近一条代码审查记录时出错: %s", e)
             return None
     
-    def _convert_to_response(self, doc: Dict[str, Any]) -> CodeReviewResponse:
+    def _convert_to_response(self, doc: Dict[str, Any], model=CodeReviewResponse) -> CodeReviewBaseResponse:
         """将数据库文档转换为响应模型"""
         # 转换ObjectId
         doc["_id"] = str(doc["_id"])
         if "created_by" in doc and isinstance(doc["created_by"], ObjectId):
             doc["created_by"] = str(doc["created_by"])
         
-        return CodeReviewResponse(**doc)
\ No newline at end of file
+        return model(**doc)
\ No newline at end of file
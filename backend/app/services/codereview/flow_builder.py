@@ -1,84 +1,212 @@
 # codereview/flow_builder.py
 
-from typing import List, Sequence
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, List, Optional, Sequence, Union
 from autogen_agentchat.agents import AssistantAgent
-from autogen_agentchat.teams import SelectorGroupChat
-from autogen_ext.models.openai import OpenAIChatCompletionClient
-from autogen_core.models import ModelFamily
+from autogen_agentchat.teams import SelectorGroupChat, DiGraphBuilder, GraphFlow
+from autogen_core.models import ModelFamily, ChatCompletionClient, CreateResult, LLMMessage, RequestUsage, ModelInfo
 from autogen_core.tools import FunctionTool
-from autogen_agentchat.conditions import MaxMessageTermination, TextMentionTermination
+from autogen_agentchat.conditions import TextMentionTermination
 from autogen_agentchat.messages import BaseAgentEvent, BaseChatMessage
 
 try:
     # 尝试相对导入（当作为包的一部分时）
-    from .config import AI_MODEL_NAME, AI_API_KEY, AI_API_BASE, get_system_prompt
+    from .config import (
+        AI_MODEL_NAME, AI_API_KEY, AI_API_BASE, get_system_prompt,
+        REVIEW_FLOW_MODE, REVIEW_MAX_PARALLEL_AGENTS, REVIEW_AGENT_MAX_TOOL_ITERATIONS
+    )
     from .line_number_calculator import LineNumberAgent
 except ImportError:
     # 绝对导入（当直接运行脚本时）
-    from config import AI_MODEL_NAME, AI_API_KEY, AI_API_BASE, get_system_prompt
+    from config import (
+        AI_MODEL_NAME, AI_API_KEY, AI_API_BASE, get_system_prompt,
+        REVIEW_FLOW_MODE, REVIEW_MAX_PARALLEL_AGENTS, REVIEW_AGENT_MAX_TOOL_ITERATIONS
+    )
     from line_number_calculator import LineNumberAgent
 
+from app.utils.modelclient import model_client_registry
+
+logger = logging.getLogger(__name__)
+
 # 全局行号智能体实例
 line_number_agent = LineNumberAgent()
 
-def calculate_line_number_tool(diff_content: str, target_content: str) -> dict:
+
+class ReviewToolContext:
+    """
+    单次审查的行号工具上下文
+
+    持有当前审查的diff及其解析结果，行号工具直接从这里读取diff，
+    模型只需传入目标行内容，不必在每次工具调用时重新生成完整diff。
     """
-    从diff内容中直接找出目标行内容的位置
+
+    def __init__(self, review_id: str, diff_content: str):
+        self.review_id = review_id
+        self.diff = line_number_agent.calculator.parse(diff_content or "")
+
+    def locate(self, target_content: str, file_paths: Optional[List[str]] = None) -> dict:
+        """在diff中定位单个目标行，返回工具统一的结果格式"""
+        results = self.diff.find(target_content or "", file_paths=file_paths) if target_content else None
+
+        # 如果没有找到匹配的行，返回失败
+        if not results:
+            return {
+                "success": False,
+                "file_path": "",
+                "line_number": -1,
+                "context": [],
+                "error": "未找到匹配的行"
+            }
+
+        file_path = results["file_path"]
+        line_number = results["line_number"]
+
+        return {
+            "success": True,
+            "file_path": file_path,
+            "line_number": line_number,
+            # 获取上下文（前后各一行）
+            "context": self.diff.context(file_path, line_number, context_size=1),
+            "exact_match": results.get("exact_match", False),
+            "matched_content": results.get("matched_content", "")
+        }
+
+
+# 当前审查绑定的工具上下文（由 AICodeReviewService.run_ai_code_review 设置）
+_current_review_tools: ContextVar[Optional[ReviewToolContext]] = ContextVar("current_review_tools", default=None)
+
+
+@contextmanager
+def bind_review_tools(review_id: str, diff_content: str):
+    """
+    在当前上下文中为行号工具绑定审查的diff
+
+    flow在with块内启动时，agent运行时任务会继承该上下文，
+    工具调用因此能拿到本次审查的diff，不同审查之间互不影响。
+    """
+    token = _current_review_tools.set(ReviewToolContext(review_id, diff_content))
+    try:
+        yield
+    finally:
+        _current_review_tools.reset(token)
+
+
+def _unbound_result() -> dict:
+    return {
+        "success": False,
+        "file_path": "",
+        "line_number": -1,
+        "context": [],
+        "error": "当前审查未绑定diff，无法计算行号"
+    }
+
+
+async def calculate_line_number_tool(target_content: str, file_path: Optional[str] = None) -> dict:
+    """
+    从当前审查的diff中直接找出目标行内容的位置
     
     Args:
-        diff_content: PR的diff内容
         target_content: 要查找的目标行内容
+        file_path: 可选，目标所在文件（完整路径或路径后缀）
         
     Returns:
         dict: 包含行号信息的查找结果
         contexts: 包含目标行上下文三行，分别为目标行前一行、目标行和目标行后一行
 
     """
-    # 添加详细的日志记录
-    print(f"🔍 计算器工具被调用 - 目标内容: '{target_content}'")
-    print(f"📊 Diff内容长度: {len(diff_content)} 字符")
-    
-    # 使用严格的diff解析器查找目标行
-    results = line_number_agent.calculator.find_line_by_content(diff_content, target_content)
-    
-    # 如果没有找到匹配的行，返回失败
-    if not results:
-        print(f"❌ 未找到匹配的目标内容: '{target_content}'")
-        return {
-            "success": False,
-            "file_path": "",
-            "line_number": -1,
-            "context": [],
-            "error": "未找到匹配的行"
-        }
-    
-    file_path = results["file_path"]
-    line_number = results["line_number"]
-    exact_match = results.get("exact_match", False)
-    matched_content = results.get("matched_content", "")
-    
-    print(f"✅ 找到匹配 - 文件: {file_path}, 行号: {line_number}")
-    print(f"📝 匹配内容: '{matched_content}' (精确匹配: {exact_match})")
-    
-    # 获取上下文（前后各一行）
-    context = line_number_agent.calculator.get_context_lines(diff_content, file_path, line_number, context_size=1)
-    
+    tools = _current_review_tools.get()
+    if tools is None:
+        return _unbound_result()
+
+    logger.debug("行号工具被调用，审查: %s，目标内容: %r", tools.review_id, target_content)
+
+    result = tools.locate(target_content, [file_path] if file_path else None)
+    if result["success"]:
+        logger.debug(
+            "找到匹配，文件: %s，行号: %s，匹配内容: %r（精确匹配: %s）",
+            result["file_path"], result["line_number"], result["matched_content"], result["exact_match"]
+        )
+    else:
+        logger.info("审查 %s 未找到匹配的目标内容: %r", tools.review_id, target_content)
+    return result
+
+
+async def calculate_line_numbers_batch_tool(
+    targets: List[str],
+    file_paths: Optional[List[str]] = None
+) -> dict:
+    """
+    一次调用批量查找多个目标行内容在当前审查diff中的位置
+
+    Args:
+        targets: 要查找的目标行内容列表，每项只能是单行内容
+        file_paths: 可选的文件过滤（完整路径或路径后缀），只在这些文件中查找
+
+    Returns:
+        dict: success表示是否至少找到一个目标，results按targets顺序给出每个目标的查找结果
+    """
+    tools = _current_review_tools.get()
+    if tools is None:
+        return _unbound_result()
+
+    logger.debug("批量行号工具被调用，审查: %s，目标数量: %d，文件过滤: %s", tools.review_id, len(targets), file_paths or "无")
+
+    results = []
+    for target in targets:
+        result = tools.locate(target, file_paths)
+        result["target"] = target
+        results.append(result)
+
+    found = sum(1 for result in results if result["success"])
+    logger.info("审查 %s 批量查找行号完成，找到 %d/%d 个目标", tools.review_id, found, len(targets))
+
+    # success字段放在最前面，选择器据此判断上一条消息是否为工具结果
     return {
-        "success": True,
-        "file_path": file_path,
-        "line_number": line_number,
-        "context": context,
-        "exact_match": exact_match,
-        "matched_content": matched_content
+        "success": found > 0,
+        "found": found,
+        "total": len(targets),
+        "results": results
     }
-        
+
+
+# 行号工具描述：diff已在服务端绑定，只需传入目标行；优先使用批量工具
+LINE_NUMBER_BATCH_TOOL_DESCRIPTION = (
+    "从本次审查的pull request diff中一次性批量查找多个目标行的位置（推荐）。"
+    "diff已由系统绑定，无需也不要传入diff内容。"
+    "把本轮所有问题对应的代码行放进targets列表在一次调用中完成定位，不要逐条调用；"
+    "可用file_paths限定只在指定文件中查找。注意：targets中的每一项只能是单行内容。"
+)
+LINE_NUMBER_TOOL_DESCRIPTION = (
+    "从本次审查的pull request diff中查找单个目标行内容的位置，diff已由系统绑定，无需传入。"
+    "只需定位一行时使用，多个目标请使用calculate_line_numbers_batch_tool；"
+    "可用file_path限定文件。注意：target_content只能是单行内容，请输入简短的目标行。"
+)
+
+
+_line_number_tools: List[FunctionTool] = []
+
+
+def build_line_number_tools() -> List[FunctionTool]:
+    """
+    获取审查agent使用的行号工具列表
+
+    工具本身无状态（diff通过 bind_review_tools 按审查绑定），
+    因此工具及其参数schema只生成一次，由所有审查的agent共享。
+    """
+    if not _line_number_tools:
+        _line_number_tools.extend([
+            FunctionTool(calculate_line_numbers_batch_tool, description=LINE_NUMBER_BATCH_TOOL_DESCRIPTION),
+            FunctionTool(calculate_line_number_tool, description=LINE_NUMBER_TOOL_DESCRIPTION),
+        ])
+    return list(_line_number_tools)
 
 
 def build_agent(name: str, key: str) -> AssistantAgent:
     # 创建工具列表
-    tools = [
-        FunctionTool(calculate_line_number_tool, description="从pull request diff内容中直接查找目标行内容的位置，支持文件过滤。注意：target参数只能接收单行内容，不支持多行内容，请输入简短的target参数。"),
-    ]
+    tools = build_line_number_tools()
     
     # 为关键agent设置更具体的描述
     descriptions = {
@@ -97,16 +225,19 @@ def build_agent(name: str, key: str) -> AssistantAgent:
     return AssistantAgent(
         name,
         description=descriptions.get(name, f"{name}"),
-        model_client=model_client,
+        model_client=get_analysis_model_client(),
         system_message=get_system_prompt(key),
         tools=tools
     )
 
-def build_deepseek_agent(name: str, key: str) -> AssistantAgent:
+def build_deepseek_agent(
+    name: str,
+    key: str,
+    client: Optional[ChatCompletionClient] = None,
+    max_tool_iterations: int = 1
+) -> AssistantAgent:
     # 创建工具列表
-    tools = [
-        FunctionTool(calculate_line_number_tool, description="从diff内容中直接查找目标行内容的位置，支持文件过滤。注意：target参数只能接收单行内容，不支持多行内容。")
-    ]
+    tools = build_line_number_tools()
     
     # 根据agent名称设置描述
     descriptions = {
@@ -125,93 +256,136 @@ def build_deepseek_agent(name: str, key: str) -> AssistantAgent:
     return AssistantAgent(
         name,
         description=descriptions.get(name, f"{name} - specialized in code review"),
-        model_client=deepseek_model_client,
+        model_client=client or get_analysis_model_client(),
         system_message=get_system_prompt(key),
-        tools=tools
+        tools=tools,
+        max_tool_iterations=max_tool_iterations,
+        # 多轮工具调用后需要由模型给出最终结论，而不是直接返回工具结果摘要
+        reflect_on_tool_use=max_tool_iterations > 1
     )
 
 
-def build_final_agent(name: str, key: str) -> AssistantAgent:
-    # 创建工具列表
-    model_client = OpenAIChatCompletionClient(
-                    model="MiniMaxAI/MiniMax-M2",
-                    api_key=AI_API_KEY,
-                    base_url=AI_API_BASE,
-                    model_info={
-                        "vision": False,
-                        "function_calling": False,
-                        "json_output": True,
-                        "family": ModelFamily.UNKNOWN,
-                        "structured_output": True,
-                    },
-                    max_retries=5,
-                    response_format={"type": "json_object"},
-                    
-                )
+class ConcurrencyLimitedChatCompletionClient(ChatCompletionClient):
+    """
+    为模型客户端增加并发上限的包装器
+
+    parallel模式下多个专项agent同时运行，所有调用共享同一个信号量，
+    避免瞬间打满模型服务商的并发/速率限制。
+    """
+
+    def __init__(self, client: ChatCompletionClient, max_concurrency: int):
+        self._client = client
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
 
+    async def create(self, messages: Sequence[LLMMessage], **kwargs) -> CreateResult:
+        async with self._semaphore:
+            return await self._client.create(messages, **kwargs)
+
+    async def create_stream(self, messages: Sequence[LLMMessage], **kwargs) -> AsyncGenerator[Union[str, CreateResult], None]:
+        async with self._semaphore:
+            async for chunk in self._client.create_stream(messages, **kwargs):
+                yield chunk
+
+    async def close(self) -> None:
+        # 底层客户端为全局共享实例，不在此处关闭
+        return None
+
+    def actual_usage(self) -> RequestUsage:
+        return self._client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._client.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], **kwargs) -> int:
+        return self._client.count_tokens(messages, **kwargs)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], **kwargs) -> int:
+        return self._client.remaining_tokens(messages, **kwargs)
+
+    @property
+    def capabilities(self):
+        return self._client.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._client.model_info
+
+
+def build_final_agent(name: str, key: str) -> AssistantAgent:
     return AssistantAgent(
         "FinalReviewAggregatorAgent",
         description="最终审查结果聚合器，负责收集和整合所有专业审查agent的意见，生成完整的最终审查报告",
-        model_client=model_client,
+        model_client=get_final_model_client(),
         system_message=get_system_prompt(key),
     )
 
-model_client = OpenAIChatCompletionClient(
-                    model=AI_MODEL_NAME,
-                    api_key=AI_API_KEY,
-                    base_url=AI_API_BASE,
-                    model_info={
-                        "vision": False,
-                        "function_calling": True,
-                        "json_output": True,
-                        "family": ModelFamily.UNKNOWN,
-                        "structured_output": True,
-                    },
-                    max_retries=5,    
-                )
-
-# DeepSeek-V3.1-Terminus model client for analysis agents
-deepseek_model_client = OpenAIChatCompletionClient(
-    model=AI_MODEL_NAME,
-    api_key=AI_API_KEY,
-    base_url=AI_API_BASE,
-    model_info={
-        "vision": False,
-        "function_calling": True,
-        "json_output": True,
-        "family": ModelFamily.UNKNOWN,
-        "structured_output": True,
-    },
-    max_retries=5,
-)
 
-reputation_assessment_agent = build_deepseek_agent("ReputationAssessmentAgent", "reputation_assessment_agent")
-review_task_dispatcher_agent = build_deepseek_agent("ReviewTaskDispatcherAgent", "review_task_dispatcher_agent")
-static_analysis_agent = build_deepseek_agent("StaticAnalysisReviewAgent", "static_analysis_agent")
-logic_error_agent = build_deepseek_agent("LogicErrorReviewAgent", "logic_error_agent")
-memory_safety_agent = build_deepseek_agent("MemorySafetyReviewAgent", "memory_safety_agent")
-security_vulnerability_agent = build_deepseek_agent("SecurityVulnerabilityReviewAgent", "security_vulnerability_agent")
-performance_optimization_agent = build_deepseek_agent("PerformanceOptimizationReviewAgent", "performance_optimization_agent")
-maintainability_agent = build_deepseek_agent("MaintainabilityReviewAgent", "maintainability_agent")
-architecture_agent = build_deepseek_agent("ArchitectureReviewAgent", "architecture_agent")
-final_review_aggregator_agent = build_final_agent("FinalReviewAggregatorAgent", "final_review_aggregator_agent")
+# ---------------------------
+# 模型客户端与agent的惰性注册表
+# ---------------------------
+# 导入本模块时不创建任何客户端或agent。模型客户端由 model_client_registry 在第一次运行审查时
+# 创建，与智能助手共用连接池，并在应用（或worker）关闭时统一关闭；
+# agent带有会话状态，每次审查都创建新实例，只共享客户端、提示词和工具定义。
+
+
+def get_analysis_model_client() -> ChatCompletionClient:
+    """获取分析类agent与选择器共用的模型客户端（进程内共享）"""
+    return model_client_registry.get(
+        model=AI_MODEL_NAME,
+        base_url=AI_API_BASE,
+        api_key=AI_API_KEY,
+        model_info={
+            "vision": False,
+            "function_calling": True,
+            "json_output": True,
+            "family": ModelFamily.UNKNOWN,
+            "structured_output": True,
+        },
+        max_retries=5,
+    )
+
+
+def get_final_model_client() -> ChatCompletionClient:
+    """获取最终聚合agent使用的模型客户端（进程内共享）"""
+    return model_client_registry.get(
+        model="MiniMaxAI/MiniMax-M2",
+        base_url=AI_API_BASE,
+        api_key=AI_API_KEY,
+        model_info={
+            "vision": False,
+            "function_calling": False,
+            "json_output": True,
+            "family": ModelFamily.UNKNOWN,
+            "structured_output": True,
+        },
+        max_retries=5,
+        response_format={"type": "json_object"},
+    )
+
+
+# selector模式的参与者顺序：(agent名称, 提示词key)
+DEFAULT_FLOW_AGENT_KEYS = [
+    ("ReputationAssessmentAgent", "reputation_assessment_agent"),
+    ("ReviewTaskDispatcherAgent", "review_task_dispatcher_agent"),
+    ("StaticAnalysisReviewAgent", "static_analysis_agent"),
+    ("LogicErrorReviewAgent", "logic_error_agent"),
+    ("MemorySafetyReviewAgent", "memory_safety_agent"),
+    ("SecurityVulnerabilityReviewAgent", "security_vulnerability_agent"),
+    ("PerformanceOptimizationReviewAgent", "performance_optimization_agent"),
+    ("MaintainabilityReviewAgent", "maintainability_agent"),
+    ("ArchitectureReviewAgent", "architecture_agent"),
+    ("FinalReviewAggregatorAgent", "final_review_aggregator_agent"),
+]
+
 
 def create_default_flow() -> SelectorGroupChat:
     
-    # 收集所有参与者
+    # 每次创建流程都使用新的agent实例，并发审查之间不共享模型上下文
     participants = [
-        
-        reputation_assessment_agent,
-        review_task_dispatcher_agent,
-        static_analysis_agent,
-        logic_error_agent,
-        memory_safety_agent,
-        security_vulnerability_agent,
-        performance_optimization_agent,
-        maintainability_agent,
-        architecture_agent,
-        final_review_aggregator_agent,
+        build_final_agent(name, key) if name == "FinalReviewAggregatorAgent" else build_deepseek_agent(name, key)
+        for name, key in DEFAULT_FLOW_AGENT_KEYS
     ]
+    final_review_aggregator_agent = participants[-1]
     agentsname = [agent.name for agent in participants]
     def selector_func(messages: Sequence[BaseChatMessage|BaseAgentEvent]) -> str | None:
         if messages[-1].source == final_review_aggregator_agent.name:
@@ -232,13 +406,83 @@ def create_default_flow() -> SelectorGroupChat:
     flow = SelectorGroupChat(
         participants=participants,
         selector_func=selector_func,
-        model_client=model_client,
+        model_client=get_analysis_model_client(),
         termination_condition=termination,
+        # 输出 SelectSpeakerEvent，用于推送agent开始运行的进度
+        emit_team_events=True,
     )
     
     return flow
 
 
+# 调度器之后可以相互独立、同时运行的专项审查agent
+SPECIALIST_AGENT_KEYS = [
+    ("StaticAnalysisReviewAgent", "static_analysis_agent"),
+    ("LogicErrorReviewAgent", "logic_error_agent"),
+    ("MemorySafetyReviewAgent", "memory_safety_agent"),
+    ("SecurityVulnerabilityReviewAgent", "security_vulnerability_agent"),
+    ("PerformanceOptimizationReviewAgent", "performance_optimization_agent"),
+    ("MaintainabilityReviewAgent", "maintainability_agent"),
+    ("ArchitectureReviewAgent", "architecture_agent"),
+]
+
+
+def create_parallel_flow(max_concurrency: Optional[int] = None) -> GraphFlow:
+    """
+    创建并行扇出的审查流程
+
+    信誉评估 -> 任务调度 -> 七个专项agent并行 -> 最终聚合。
+    最终聚合agent需等待全部专项agent完成后才会被激活，
+    因此一次审查的耗时约为 3 + max(专项agent) 次模型往返，而不是十次串行往返。
+
+    Args:
+        max_concurrency: 同时进行的模型调用上限，默认读取 REVIEW_MAX_PARALLEL_AGENTS
+
+    Returns:
+        GraphFlow: 可直接用于 run_stream 的流程实例
+    """
+    limited_client = ConcurrencyLimitedChatCompletionClient(
+        get_analysis_model_client(),
+        max_concurrency or REVIEW_MAX_PARALLEL_AGENTS
+    )
+
+    # 每个agent在一轮内完成全部工具调用，不再依赖selector重复选中自己
+    def build(name: str, key: str) -> AssistantAgent:
+        return build_deepseek_agent(
+            name, key,
+            client=limited_client,
+            max_tool_iterations=REVIEW_AGENT_MAX_TOOL_ITERATIONS
+        )
+
+    reputation_agent = build("ReputationAssessmentAgent", "reputation_assessment_agent")
+    dispatcher_agent = build("ReviewTaskDispatcherAgent", "review_task_dispatcher_agent")
+    specialist_agents = [build(name, key) for name, key in SPECIALIST_AGENT_KEYS]
+    aggregator_agent = build_final_agent("FinalReviewAggregatorAgent", "final_review_aggregator_agent")
+
+    builder = DiGraphBuilder()
+    for agent in [reputation_agent, dispatcher_agent, *specialist_agents, aggregator_agent]:
+        builder.add_node(agent)
+
+    builder.add_edge(reputation_agent, dispatcher_agent)
+    for agent in specialist_agents:
+        builder.add_edge(dispatcher_agent, agent)
+        # 聚合节点默认 activation="all"，即等待所有专项agent完成
+        builder.add_edge(agent, aggregator_agent)
+    builder.set_entry_point(reputation_agent)
+
+    return GraphFlow(
+        participants=builder.get_participants(),
+        graph=builder.build(),
+    )
+
+
+def create_review_flow() -> Union[SelectorGroupChat, GraphFlow]:
+    """根据 REVIEW_FLOW_MODE 创建审查流程"""
+    if REVIEW_FLOW_MODE == "parallel":
+        return create_parallel_flow()
+    return create_default_flow()
+
+
 async def main():
     """
     主函数 - 运行代码审查流程并添加详细日志
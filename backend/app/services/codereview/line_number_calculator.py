@@ -1,14 +1,287 @@
 import re
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Iterable, Set
 import difflib
 
+
+def normalize_whitespace(text: str) -> str:
+    """折叠所有连续空白为单个空格"""
+    return " ".join(text.split())
+
+
+def trigrams(text: str) -> set:
+    """生成文本的三元组集合（用于模糊匹配候选筛选）"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class DiffLine:
+    """
+    diff中的单行记录（新增行或上下文行）
+    """
+    __slots__ = ("file_path", "line_number", "line_type", "content", "stripped", "hunk_index")
+
+    def __init__(self, file_path: str, line_number: int, line_type: str, content: str, hunk_index: int):
+        self.file_path = file_path
+        self.line_number = line_number
+        self.line_type = line_type
+        self.content = content
+        self.stripped = content.strip()
+        self.hunk_index = hunk_index
+
+    def prefixed(self) -> str:
+        """带diff前缀的行内容"""
+        return ("+" if self.line_type == "added" else " ") + self.content
+
+
+class ParsedDiff:
+    """
+    解析一次、多次查询的diff索引
+
+    - lines: 按出现顺序保存的所有新增行/上下文行
+    - hunk_bounds: 每个变更块在lines中的 [start, end) 区间
+    - line_index: (文件路径, 新文件行号) -> lines中的位置
+    - content_index: 去除首尾空白后的行内容 -> lines中的位置列表
+    - normalized_index: 折叠所有空白后的行内容 -> lines中的位置列表
+    - trigram_index: 三元组 -> 包含该三元组的行位置列表（首次模糊匹配时构建）
+    """
+    __slots__ = (
+        "lines", "hunk_bounds", "file_index", "line_index",
+        "content_index", "normalized_index", "trigram_index"
+    )
+
+    hunk_pattern = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@')
+
+    def __init__(self, diff_content: str):
+        self.lines: List[DiffLine] = []
+        self.hunk_bounds: List[Tuple[int, int]] = []
+        self.file_index: Dict[str, List[int]] = {}
+        self.line_index: Dict[Tuple[str, int], int] = {}
+        self.content_index: Dict[str, List[int]] = {}
+        self.normalized_index: Dict[str, List[int]] = {}
+        self.trigram_index: Optional[Dict[str, List[int]]] = None
+        self._parse(diff_content)
+
+    def _parse(self, diff_content: str) -> None:
+        current_file = ""
+        in_hunk = False
+        hunk_begin = 0
+        next_line_number = 0
+        previous = ""
+
+        def close_hunk():
+            if in_hunk and len(self.lines) > hunk_begin:
+                self.hunk_bounds.append((hunk_begin, len(self.lines)))
+
+        for line in diff_content.split('\n'):
+            # 文件头：紧跟在 "--- " 之后的 "+++ " 行
+            if line.startswith('+++ ') and previous.startswith('--- '):
+                close_hunk()
+                in_hunk = False
+                path = line[4:].split('\t', 1)[0]
+                current_file = "" if path == "/dev/null" else (path[2:] if path.startswith('b/') else path)
+            elif line.startswith('@@'):
+                close_hunk()
+                match = self.hunk_pattern.match(line)
+                in_hunk = bool(match) and bool(current_file)
+                next_line_number = int(match.group(1)) if match else 0
+                hunk_begin = len(self.lines)
+            elif in_hunk and (line.startswith('+') or line.startswith(' ')):
+                line_type = 'added' if line[0] == '+' else 'context'
+                self._add(DiffLine(current_file, next_line_number, line_type, line[1:], len(self.hunk_bounds)))
+                next_line_number += 1
+            elif line.startswith('diff --git'):
+                close_hunk()
+                in_hunk = False
+            previous = line
+
+        close_hunk()
+
+    def _add(self, record: DiffLine) -> None:
+        position = len(self.lines)
+        self.lines.append(record)
+        self.file_index.setdefault(record.file_path, []).append(position)
+        self.line_index.setdefault((record.file_path, record.line_number), position)
+        self.content_index.setdefault(record.stripped, []).append(position)
+        self.normalized_index.setdefault(normalize_whitespace(record.stripped), []).append(position)
+
+    def _build_trigram_index(self) -> Dict[str, List[int]]:
+        if self.trigram_index is None:
+            index: Dict[str, List[int]] = {}
+            for position, record in enumerate(self.lines):
+                for gram in trigrams(record.stripped):
+                    index.setdefault(gram, []).append(position)
+            self.trigram_index = index
+        return self.trigram_index
+
+    def _match_result(self, record: DiffLine, target_clean: str, similarity: float) -> Dict:
+        return {
+            'file_path': record.file_path,
+            'line_number': record.line_number,
+            'exact_match': record.stripped == target_clean,
+            'matched_content': record.stripped,
+            'similarity': round(similarity, 4)
+        }
+
+    def _first_preferring_added(self, positions: List[int]) -> int:
+        for position in positions:
+            if self.lines[position].line_type == 'added':
+                return position
+        return positions[0]
+
+    def resolve_files(self, file_paths: Optional[Iterable[str]]) -> Optional[Set[str]]:
+        """
+        将文件过滤条件解析为diff中实际存在的文件路径集合
+
+        过滤条件可以是完整路径或路径后缀（如 "utils.py" 匹配 "src/utils.py"），
+        未传入过滤条件时返回None表示不过滤。
+        """
+        if not file_paths:
+            return None
+        resolved: Set[str] = set()
+        for raw in file_paths:
+            wanted = (raw or "").strip()
+            if wanted.startswith(('a/', 'b/')):
+                wanted = wanted[2:]
+            if not wanted:
+                continue
+            for file_path in self.file_index:
+                if file_path == wanted or file_path.endswith('/' + wanted):
+                    resolved.add(file_path)
+        return resolved
+
+    def _fuzzy_candidates(self, target_clean: str, top_k: int, files: Optional[Set[str]] = None) -> List[int]:
+        """通过三元组倒排索引筛选与目标共享片段最多的前top_k行"""
+        grams = trigrams(target_clean)
+        if not grams:
+            # 目标过短无法生成三元组时退化为全量候选
+            if files is None:
+                return list(range(len(self.lines)))
+            return [position for file_path in files for position in self.file_index[file_path]]
+        index = self._build_trigram_index()
+        postings = sorted((index[gram] for gram in grams if gram in index), key=len)
+        # 出现在大量行中的高频三元组区分度低，有足够的低频三元组时跳过
+        common_limit = max(len(self.lines) // 8, top_k * 4)
+        selective = [posting for posting in postings if len(posting) <= common_limit]
+        if len(selective) >= 3:
+            postings = selective
+        counts: Dict[int, int] = {}
+        for posting in postings:
+            for position in posting:
+                if files is not None and self.lines[position].file_path not in files:
+                    continue
+                counts[position] = counts.get(position, 0) + 1
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return [position for position, _ in ranked[:top_k]]
+
+    def find(
+        self,
+        target_content: str,
+        threshold: float = 0.5,
+        top_k: int = 64,
+        file_paths: Optional[Iterable[str]] = None
+    ) -> Optional[Dict]:
+        """
+        查找与目标内容最匹配的行，新增行优先于上下文行
+
+        匹配顺序：精确匹配 -> 空白归一化匹配 -> 三元组候选 + 相似度评分。
+        结果确定：相似度最高者胜出，相同相似度取diff中靠前的行。
+
+        Args:
+            target_content: 目标内容
+            threshold: 模糊匹配的最低相似度
+            top_k: 参与完整相似度计算的候选行数量上限
+            file_paths: 只在这些文件中查找（完整路径或路径后缀），为空时查找全部文件
+
+        Returns:
+            Optional[Dict]: 匹配结果
+        """
+        target_clean = target_content.strip()
+        files = self.resolve_files(file_paths)
+        if files is not None and not files:
+            return None
+
+        for positions in (
+            self.content_index.get(target_clean),
+            self.normalized_index.get(normalize_whitespace(target_clean))
+        ):
+            if positions and files is not None:
+                positions = [p for p in positions if self.lines[p].file_path in files]
+            if positions:
+                return self._match_result(self.lines[self._first_preferring_added(positions)], target_clean, 1.0)
+
+        candidates = sorted(self._fuzzy_candidates(target_clean, top_k, files))
+        matcher = difflib.SequenceMatcher(None, autojunk=False)
+        matcher.set_seq2(target_clean)
+
+        for wanted_type in ('added', None):
+            best_position, best_score = -1, threshold
+            for position in candidates:
+                record = self.lines[position]
+                if wanted_type and record.line_type != wanted_type:
+                    continue
+                matcher.set_seq1(record.stripped)
+                # 先用廉价的上界排除不可能超过当前最佳分数的候选
+                if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+                    continue
+                score = matcher.ratio()
+                if score > best_score or (score == best_score and best_position < 0):
+                    best_position, best_score = position, score
+            if best_position >= 0:
+                return self._match_result(self.lines[best_position], target_clean, best_score)
+        return None
+
+    def context(self, file_path: str, line_number: int, context_size: int = 1) -> List[str]:
+        """获取指定行前后各context_size行（不跨越变更块）"""
+        position = self.line_index.get((file_path, line_number))
+        if position is None:
+            return []
+        start, end = self.hunk_bounds[self.lines[position].hunk_index]
+        first = max(start, position - context_size)
+        last = min(end, position + context_size + 1)
+        return [self.lines[i].prefixed() for i in range(first, last)]
+
+    def to_hunks(self) -> List[Dict]:
+        """转换为旧版 parse_diff_hunks 的字典结构"""
+        hunks = []
+        for start, end in self.hunk_bounds:
+            records = self.lines[start:end]
+            hunks.append({
+                'file_path': records[0].file_path,
+                # 删除行不占用新文件行号，因此首行行号即变更块起始行号
+                'hunk_start': records[0].line_number,
+                'lines': [
+                    {
+                        'type': record.line_type,
+                        'content': record.content,
+                        'original_line_number': record.line_number
+                    }
+                    for record in records
+                ]
+            })
+        return hunks
+
+
 class LineNumberCalculator:
     """
     严格的diff行号计算器，使用Python标准库进行准确的diff解析
+
+    计算器本身不缓存解析结果：审查期间由 ReviewToolContext 持有本次审查的 ParsedDiff，
+    多次工具调用复用同一份索引，审查结束后随上下文一起释放。
     """
-    
+
     def __init__(self):
-        self.diff_pattern = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@')
+        self.diff_pattern = ParsedDiff.hunk_pattern
+
+    def parse(self, diff_content: str) -> ParsedDiff:
+        """
+        解析diff并建立索引
+
+        Args:
+            diff_content: 完整的diff内容
+
+        Returns:
+            ParsedDiff: 解析后的diff索引
+        """
+        return ParsedDiff(diff_content)
     
     def parse_diff_hunks(self, diff_content: str) -> List[Dict]:
         """
@@ -20,66 +293,21 @@ class LineNumberCalculator:
         Returns:
             List[Dict]: 每个变更块的信息，包含文件路径、起始行号、行内容等
         """
-        hunks = []
-        lines = diff_content.split('\n')
-        current_file = ""
-        current_hunk_start = 0
-        current_hunk_lines = []
-        
-        for i, line in enumerate(lines):
-            # 检测文件头
-            if line.startswith('+++ b/'):
-                current_file = line[6:]  # 移除'+++ b/'前缀
-            # 检测hunk头
-            elif line.startswith('@@'):
-                # 保存前一个hunk
-                if current_hunk_lines and current_file:
-                    hunks.append({
-                        'file_path': current_file,
-                        'hunk_start': current_hunk_start,
-                        'lines': current_hunk_lines.copy()
-                    })
-                
-                # 解析新的hunk头
-                match = self.diff_pattern.match(line)
-                if match:
-                    current_hunk_start = int(match.group(1))
-                    current_hunk_lines = []
-                else:
-                    current_hunk_start = 0
-                    current_hunk_lines = []
-            # 检测新增的行（以+开头，但不是+++）
-            elif line.startswith('+') and not line.startswith('++'):
-                current_hunk_lines.append({
-                    'type': 'added',
-                    'content': line[1:],  # 移除+前缀
-                    'original_line_number': len(current_hunk_lines) + current_hunk_start
-                })
-            # 检测修改的行
-            elif line.startswith(' '):
-                current_hunk_lines.append({
-                    'type': 'context',
-                    'content': line[1:],
-                    'original_line_number': len(current_hunk_lines) + current_hunk_start
-                })
-        
-        # 保存最后一个hunk
-        if current_hunk_lines and current_file:
-            hunks.append({
-                'file_path': current_file,
-                'hunk_start': current_hunk_start,
-                'lines': current_hunk_lines.copy()
-            })
-        
-        return hunks
+        return self.parse(diff_content).to_hunks()
     
-    def find_line_by_content(self, diff_content: str, target_content: str) -> Optional[Dict]:
+    def find_line_by_content(
+        self,
+        diff_content: str,
+        target_content: str,
+        file_paths: Optional[Iterable[str]] = None
+    ) -> Optional[Dict]:
         """
         在diff内容中查找包含目标内容的行
         
         Args:
             diff_content: diff内容
             target_content: 要查找的目标内容
+            file_paths: 可选的文件过滤（完整路径或路径后缀）
             
         Returns:
             Optional[Dict]: 包含文件路径和行号的信息，如果没找到返回None
@@ -87,38 +315,7 @@ class LineNumberCalculator:
         if not diff_content or not target_content:
             return None
             
-        hunks = self.parse_diff_hunks(diff_content)
-        
-        # 清理目标内容（去除前后空格）
-        target_clean = target_content.strip()
-        
-        for hunk in hunks:
-            for line_info in hunk['lines']:
-                # 只搜索新增的行
-                if line_info['type'] == 'added':
-                    line_content = line_info['content'].strip()
-                    # 使用模糊匹配，允许部分匹配
-                    if self._fuzzy_match(line_content, target_clean):
-                        return {
-                            'file_path': hunk['file_path'],
-                            'line_number': line_info['original_line_number'],
-                            'exact_match': line_content == target_clean,
-                            'matched_content': line_content
-                        }
-        
-        # 如果没找到精确匹配，尝试在上下文行中查找
-        for hunk in hunks:
-            for line_info in hunk['lines']:
-                line_content = line_info['content'].strip()
-                if self._fuzzy_match(line_content, target_clean):
-                    return {
-                        'file_path': hunk['file_path'],
-                        'line_number': line_info['original_line_number'],
-                        'exact_match': line_content == target_clean,
-                        'matched_content': line_content
-                    }
-        
-        return None
+        return self.parse(diff_content).find(target_content, file_paths=file_paths)
     
     def _fuzzy_match(self, line_content: str, target_content: str, threshold: float = 0.5) -> bool:
         """
@@ -153,36 +350,7 @@ class LineNumberCalculator:
         Returns:
             List[str]: 上下文行内容列表
         """
-        hunks = self.parse_diff_hunks(diff_content)
-        
-        for hunk in hunks:
-            if hunk['file_path'] == file_path:
-                # 找到目标行
-                target_index = -1
-                for i, line_info in enumerate(hunk['lines']):
-                    if line_info['original_line_number'] == line_number:
-                        target_index = i
-                        break
-                
-                if target_index != -1:
-                    # 获取上下文行
-                    start_idx = max(0, target_index - context_size)
-                    end_idx = min(len(hunk['lines']), target_index + context_size + 1)
-                    
-                    context_lines = []
-                    for i in range(start_idx, end_idx):
-                        line_info = hunk['lines'][i]
-                        prefix = ""
-                        if line_info['type'] == 'added':
-                            prefix = "+"
-                        elif line_info['type'] == 'context':
-                            prefix = " "
-                        
-                        context_lines.append(f"{prefix}{line_info['content']}")
-                    
-                    return context_lines
-        
-        return []
+        return self.parse(diff_content).context(file_path, line_number, context_size)
     
     def find_all_matches(self, diff_content: str, target_content: str) -> List[Dict]:
         """
@@ -196,20 +364,17 @@ class LineNumberCalculator:
             List[Dict]: 所有匹配的行信息
         """
         matches = []
-        hunks = self.parse_diff_hunks(diff_content)
         target_clean = target_content.strip()
         
-        for hunk in hunks:
-            for line_info in hunk['lines']:
-                line_content = line_info['content'].strip()
-                if self._fuzzy_match(line_content, target_clean):
-                    matches.append({
-                        'file_path': hunk['file_path'],
-                        'line_number': line_info['original_line_number'],
-                        'exact_match': line_content == target_clean,
-                        'matched_content': line_content,
-                        'line_type': line_info['type']
-                    })
+        for record in self.parse(diff_content).lines:
+            if self._fuzzy_match(record.stripped, target_clean):
+                matches.append({
+                    'file_path': record.file_path,
+                    'line_number': record.line_number,
+                    'exact_match': record.stripped == target_clean,
+                    'matched_content': record.stripped,
+                    'line_type': record.line_type
+                })
         
         return matches
 
@@ -4,9 +4,11 @@
 import json5 as json
 import time
 import asyncio
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable, Awaitable, Iterable
 from autogen_agentchat.teams import GraphFlow
+from autogen_agentchat.messages import BaseChatMessage, SelectSpeakerEvent
 import re
 from .config import logger, setup_logger, silence_autogen_console
 from .models import AgentBuffer, ReviewResult, ReviewRequest
@@ -23,6 +25,48 @@ from app.services.jira import create_issue
 
 
 
+# 审查进度事件回调：(事件类型, 事件数据) -> None
+EventSink = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+class AgentProgress:
+    """
+    根据团队的调度推导agent的开始/结束
+
+    SelectorGroupChat 通过 SelectSpeakerEvent 告知选中的agent；GraphFlow 没有调度事件，
+    按依赖图推导：起始节点在运行开始时启动，节点结束后依赖已满足的后继节点随之启动。
+    """
+
+    def __init__(self, flow):
+        # GraphFlow 未公开依赖图，读取其内部的 DiGraph
+        graph = getattr(flow, "_graph", None) if isinstance(flow, GraphFlow) else None
+        self._start_nodes = sorted(graph.get_start_nodes()) if graph else []
+        self._parents = graph.get_parents() if graph else {}
+        self._edges = {name: node.edges for name, node in graph.nodes.items()} if graph else {}
+        self.running = set()
+        self.finished = set()
+
+    def start(self, agents: Iterable[str]) -> List[str]:
+        """标记agent开始运行，返回此前未在运行的agent"""
+        started = [agent for agent in agents if agent not in self.running]
+        self.running.update(started)
+        return started
+
+    def start_initial(self) -> List[str]:
+        return self.start(self._start_nodes)
+
+    def finish(self, agent: str) -> List[str]:
+        """标记agent结束，返回因此可以开始运行的后继agent"""
+        self.running.discard(agent)
+        self.finished.add(agent)
+        ready = []
+        for edge in self._edges.get(agent, ()):
+            parents = self._parents.get(edge.target, [])
+            if edge.activation_condition == "any" or all(parent in self.finished for parent in parents):
+                ready.append(edge.target)
+        return self.start(ready)
+
+
 class AICodeReviewService:
 
     def __init__(self, code_review_service: AICodeReviewDatabaseService, flow: Optional[GraphFlow] = None, silence_agent_console: bool = True):
@@ -41,12 +85,17 @@ class AICodeReviewService:
     # ---------------------------
     async def run_ai_code_review(
         self,
-        review_data: Dict[str, Any]
+        review_data: Dict[str, Any],
+        event_sink: Optional[EventSink] = None,
+        persist: bool = True
     ) -> Dict[str, Any]:
         """
         
         Args:
             review_data: 审查数据字典，包含所有必要信息
+            event_sink: 可选的进度事件回调，接收 (事件类型, 事件数据)
+            persist: 是否在审查结束后立即保存结果；为False时由调用方通过
+                commit_result 与其他写入一起提交
             
         Returns:
             Dict[str, Any]: 审查结果
@@ -55,6 +104,7 @@ class AICodeReviewService:
         
         review_id = review_data.get("review_id", "unknown-review-id")
         logger.info("开始AI代码审查流程，审查ID: %s", review_id)
+        started_at = datetime.utcnow()
 
         # 2. 构建请求对象
         request = ReviewRequest(**review_data)
@@ -71,17 +121,21 @@ class AICodeReviewService:
                 request.repository_readme
             )
 
-            # 确保flow存在
-            if self.flow is None:
+            # 未注入flow时为本次审查创建独立的flow，agent状态不与其他并发审查共享
+            flow = self.flow
+            if flow is None:
                 try:
-                    from .flow_builder import create_default_flow
-                    self.flow = create_default_flow()
+                    from .flow_builder import create_review_flow
+                    flow = create_review_flow()
                 except Exception as e:
                     logger.exception("无法创建默认GraphFlow: %s", e)
                     return {"status": "error", "reason": "no_graphflow_available"}
 
             # 4. 收集agent输出（不实时保存）
-            agent_outputs = await self.collect_agent_outputs(request.review_id, task)
+            # 行号工具从绑定的上下文中读取本次审查的diff，模型只需传入目标行
+            from .flow_builder import bind_review_tools
+            with bind_review_tools(request.review_id, request.code_diff):
+                agent_outputs = await self.collect_agent_outputs(request.review_id, task, flow, event_sink)
 
             # 5. 格式化最终结果
             final_result = agent_outputs.get("FinalReviewAggregatorAgent", "")
@@ -129,7 +183,8 @@ class AICodeReviewService:
                 final_result = '{}'
 
             # 6. 一次性保存完整结果
-            await self._save_complete_review_result(request.review_id, agent_outputs, final_result)
+            if persist:
+                await self._save_complete_review_result(request.review_id, agent_outputs, final_result, started_at)
             
             # 7. 返回结果
             return ReviewResult(
@@ -152,19 +207,54 @@ class AICodeReviewService:
     # ---------------------------
     # Agent输出收集（优化版本）
     # ---------------------------
-    async def collect_agent_outputs(self, review_id: str, task: str) -> Dict[str, str]:
-        if self.flow is None:
+    async def collect_agent_outputs(
+        self,
+        review_id: str,
+        task: str,
+        flow=None,
+        event_sink: Optional[EventSink] = None
+    ) -> Dict[str, str]:
+        flow = flow or self.flow
+        if flow is None:
             raise RuntimeError("GraphFlow 未初始化")
 
         agent_buffers: Dict[str, AgentBuffer] = {}
         agent_outputs: Dict[str, str] = {}
+        # 收到agent的对话消息（而非中间事件）即视为其本轮结束
+        progress = AgentProgress(flow)
+
+        async def emit(event_type: str, data: Dict[str, Any]) -> None:
+            if event_sink is None:
+                return
+            try:
+                await event_sink(event_type, data)
+            except Exception as e:
+                logger.warning("推送审查进度事件失败: %s", e)
+
+        for agent in progress.start_initial():
+            await emit("agent_started", {"agent": agent})
 
-        stream = self.flow.run_stream(task=task)
+        stream = flow.run_stream(task=task)
         async for message in stream:
             try:
+                if isinstance(message, SelectSpeakerEvent):
+                    # 调度事件只用于推送进度，不计入agent输出
+                    for agent in progress.start(message.content):
+                        await emit("agent_started", {"agent": agent})
+                    continue
+
                 ts = time.time()
                 agent_name = getattr(message, "source", None) or getattr(message, "agent_name", None) or "unknown_agent"
                 content = str(getattr(message, "content", "")).strip()
+
+                if agent_name not in ("user", "unknown_agent"):
+                    # 没有调度信息时（如自定义团队），以agent的第一条消息作为开始
+                    for agent in progress.start([agent_name]):
+                        await emit("agent_started", {"agent": agent})
+                    if isinstance(message, BaseChatMessage):
+                        await emit("agent_finished", {"agent": agent_name, "chars": len(content)})
+                        for agent in progress.finish(agent_name):
+                            await emit("agent_started", {"agent": agent})
                 
                 if not content:
                     continue
@@ -192,46 +282,59 @@ class AICodeReviewService:
         logger.info("AI代码审查完成，收集到 %d 个agent输出", len(agent_outputs))
         return agent_outputs
 
-    async def _save_complete_review_result(self, review_id: str, agent_outputs: Dict[str, str], final_result: str) -> bool:
-        """一次性保存完整的审查结果"""
-        try:
-            
-            
-            agent_output_list = []
-            for agent_name, content in agent_outputs.items():
-                # 解析agent类型
-                
-                # 直接存储原始内容作为JSON字符串
-                output_content = str(content)
-                
-                # 创建AgentOutput对象
-                agent_output = AgentOutput(
-                    agent_name=agent_name,
-                    output_content=output_content,
-                ).to_dict()
+    @staticmethod
+    def build_agent_output_list(agent_outputs: Dict[str, str]) -> List[Dict[str, Any]]:
+        """将agent输出转换为数据库存储格式（直接存储原始内容）"""
+        return [
+            AgentOutput(agent_name=agent_name, output_content=str(content)).to_dict()
+            for agent_name, content in agent_outputs.items()
+        ]
 
-                agent_output_list.append(agent_output)
-            
-            # 构建更新数据（直接存储原始final_result字符串）
-            update_data3 = CodeReviewUpdate(status="completed")
-            success = await self.code_review_service.update_review(review_id, update_data3)
-            
-            update_data1 = CodeReviewUpdate(agent_outputs=agent_output_list)
-            success = await self.code_review_service.update_review(review_id, update_data1)
+    async def commit_result(
+        self,
+        review_id: str,
+        agent_outputs: Dict[str, str],
+        final_result: str,
+        started_at: Optional[datetime] = None,
+        chat_messages: Optional[List[Dict[str, Any]]] = None,
+        session=None
+    ) -> bool:
+        """
+        一次写入审查的状态、agent输出、最终结果和耗时
 
-            update_data2 = CodeReviewUpdate(final_result=json.loads(final_result))
-            success = await self.code_review_service.update_review(review_id, update_data2)
+        Args:
+            review_id: 审查记录ID
+            agent_outputs: agent名称 -> 输出文本
+            final_result: 最终结果JSON字符串
+            started_at: 审查开始时间
+            chat_messages: 需要一并写入的聊天消息
+            session: 可选的事务会话
+        """
+        success = await self.code_review_service.commit_review_result(
+            review_id,
+            self.build_agent_output_list(agent_outputs),
+            json.loads(final_result) if final_result else {},
+            started_at=started_at,
+            chat_messages=chat_messages,
+            session=session
+        )
+        if success:
+            logger.info("成功保存完整审查结果，审查ID: %s", review_id)
+        else:
+            logger.error("保存完整审查结果失败，审查ID: %s", review_id)
+        return success
 
-            if success:
-                logger.info("成功保存完整审查结果，审查ID: %s", review_id)
-            else:
-                logger.error("保存完整审查结果失败，审查ID: %s", review_id)
-            
-            return success
-                
+    async def _save_complete_review_result(
+        self,
+        review_id: str,
+        agent_outputs: Dict[str, str],
+        final_result: str,
+        started_at: Optional[datetime] = None
+    ) -> bool:
+        """一次性保存完整的审查结果"""
+        try:
+            return await self.commit_result(review_id, agent_outputs, final_result, started_at)
         except Exception as e:
             logger.exception("保存完整审查结果时出错: %s", e)
-            update_data3 = CodeReviewUpdate(status="failed")
-            success = await self.code_review_service.update_review(review_id, update_data3)
+            await self.code_review_service.mark_review_failed(review_id, str(e))
             return False
-    
\ No newline at end of file
@@ -0,0 +1,400 @@
+"""
+审查统计模块
+
+review_stats_daily 集合按 (用户, 审查创建日期) 维护计数汇总，审查创建、完成和失败时
+增量更新，统计接口只需读取 O(天数) 个汇总文档。汇总文档结构：
+
+    {
+        "username": "alice", "day": "2025-01-01", "total": 3,
+        "status":   {"completed": 2, "pending": 1},
+        "repos":    {"owner/repo": 3},
+        "authors":  {"bob": 3},
+        "severity": {"严重": 1, "轻微": 4},
+        "bug_type": {"逻辑缺陷": 5},
+        "agents":   {"StaticAnalysisAgent": {"outputs": 2, "output_chars": 5321}}
+    }
+
+汇总与审查记录不一致时（例如启用汇总之前的历史数据），可用 rebuild 从 codereviews 重建；
+从未全量重建过时（review_stats_meta 中没有重建标记），启动时（lifespan）自动执行一次。
+全量重建写入暂存集合后整体替换，重建期间有变化的审查所在的汇总文档在替换后重新计算。
+live_counters 用一次 $facet 聚合直接从 codereviews 计算同样结构的计数。
+
+agent输出可能被外置到 review_blobs（审查文档中只剩空列表），因此审查完成时在文档上另存
+一份很小的 agent_summary（每个agent的输出条数和字符数），聚合统计读取它；没有该字段的
+旧记录按内嵌的 agent_outputs 计算，rebuild 前会先为外置了输出的旧记录补写 agent_summary。
+"""
+
+import os
+import logging
+from enum import Enum
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from app.utils.database import get_collection
+from app.utils.indexes import INDEX_SPECS
+from app.services.blobstore import review_blob_store
+
+logger = logging.getLogger(__name__)
+
+# 统计接口是否读取汇总集合（关闭时每次用 $facet 聚合实时计算）
+REVIEW_STATS_ROLLUP = os.getenv("REVIEW_STATS_ROLLUP", "true").lower() in ("1", "true", "yes")
+
+COUNTER_FIELDS = ("status", "repos", "authors", "severity", "bug_type")
+
+
+def stats_day(value: Optional[datetime]) -> str:
+    """汇总按UTC日期分桶"""
+    return (value or datetime.utcnow()).strftime("%Y-%m-%d")
+
+
+def stats_key(value: Any) -> str:
+    """将仓库名、作者等转换为可用作字段名的键（字段名不能包含'.'或以'$'开头）"""
+    if isinstance(value, Enum):
+        value = value.value
+    key = str(value) if value not in (None, "") else "unknown"
+    key = key.replace(".", "．")
+    return "＄" + key[1:] if key.startswith("$") else key
+
+
+def stats_label(key: str) -> str:
+    """stats_key 的逆转换，用于展示"""
+    key = key.replace("．", ".")
+    return "$" + key[1:] if key.startswith("＄") else key
+
+
+def repo_key(doc: Dict[str, Any]) -> str:
+    return f"{doc.get('repo_owner') or ''}/{doc.get('repo_name') or ''}".strip("/")
+
+
+def issue_counters(final_result: Any) -> Dict[str, Counter]:
+    """统计最终结果中各严重程度和缺陷类型的问题数"""
+    counters = {"severity": Counter(), "bug_type": Counter()}
+    if not isinstance(final_result, dict):
+        return counters
+    for bug in final_result.values():
+        if isinstance(bug, dict):
+            counters["severity"][stats_key(bug.get("severity"))] += 1
+            counters["bug_type"][stats_key(bug.get("bug_type"))] += 1
+    return counters
+
+
+def agent_summary(agent_outputs: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """每个agent的输出条数和字符数，随审查记录内嵌保存"""
+    summary: Dict[str, Dict[str, Any]] = {}
+    for output in agent_outputs or []:
+        if not isinstance(output, dict):
+            continue
+        agent = output.get("agent") or "unknown"
+        entry = summary.setdefault(agent, {"agent": agent, "outputs": 0, "output_chars": 0})
+        entry["outputs"] += 1
+        entry["output_chars"] += len(str(output.get("content") or ""))
+    return list(summary.values())
+
+
+def empty_counters() -> Dict[str, Any]:
+    return {"total": 0, "agents": {}, **{field: {} for field in COUNTER_FIELDS}}
+
+
+def merge_counters(target: Dict[str, Any], doc: Dict[str, Any]) -> Dict[str, Any]:
+    """将一个汇总文档累加到 target"""
+    target["total"] += doc.get("total", 0)
+    for field in COUNTER_FIELDS:
+        bucket = target[field]
+        for key, count in (doc.get(field) or {}).items():
+            bucket[key] = bucket.get(key, 0) + count
+    for agent, metrics in (doc.get("agents") or {}).items():
+        bucket = target["agents"].setdefault(agent, {})
+        for metric, value in metrics.items():
+            bucket[metric] = bucket.get(metric, 0) + value
+    return target
+
+
+def _group_counts(key_expr: Any, with_day: bool = False) -> List[Dict[str, Any]]:
+    group_id = {"day": "$day", "key": key_expr} if with_day else key_expr
+    return [{"$group": {"_id": group_id, "count": {"$sum": 1}}}]
+
+
+def facet_pipeline(match: Dict[str, Any], with_day: bool = False) -> List[Dict[str, Any]]:
+    """
+    一次扫描计算各维度计数的 $facet 聚合
+
+    Args:
+        match: 审查记录的过滤条件
+        with_day: 是否按创建日期分组（重建汇总时使用）
+    """
+    issues = [
+        {"$project": {"day": 1, "issue": {"$objectToArray": {
+            "$cond": [{"$eq": [{"$type": "$final_result"}, "object"]}, "$final_result", {}]
+        }}}},
+        {"$unwind": "$issue"},
+    ]
+    # 优先使用 agent_summary；旧记录没有该字段时按内嵌的 agent_outputs 逐条计算
+    inline_summary = {"$map": {
+        "input": {"$cond": [{"$isArray": "$agent_outputs"}, "$agent_outputs", []]},
+        "as": "output",
+        "in": {
+            "agent": "$$output.agent",
+            "outputs": 1,
+            "output_chars": {"$strLenCP": {"$toString": {"$ifNull": ["$$output.content", ""]}}}
+        }
+    }}
+    agents = [
+        {"$project": {"day": 1, "agents": {
+            "$cond": [{"$isArray": "$agent_summary"}, "$agent_summary", inline_summary]
+        }}},
+        {"$unwind": "$agents"},
+        {"$group": {
+            "_id": {"day": "$day", "key": "$agents.agent"} if with_day else "$agents.agent",
+            "outputs": {"$sum": "$agents.outputs"},
+            "output_chars": {"$sum": "$agents.output_chars"}
+        }},
+    ]
+    return [
+        {"$match": match},
+        {"$addFields": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}}},
+        {"$facet": {
+            "total": _group_counts(None, with_day),
+            "status": _group_counts("$status", with_day),
+            "repos": _group_counts({"$trim": {
+                "input": {"$concat": [{"$ifNull": ["$repo_owner", ""]}, "/", {"$ifNull": ["$repo_name", ""]}]},
+                "chars": "/"
+            }}, with_day),
+            "authors": _group_counts("$author", with_day),
+            "severity": issues + _group_counts("$issue.v.severity", with_day),
+            "bug_type": issues + _group_counts("$issue.v.bug_type", with_day),
+            "agents": agents,
+        }}
+    ]
+
+
+class ReviewStatsRollup:
+    """按天汇总的审查统计"""
+
+    def __init__(self, collection, meta_collection):
+        self.collection = collection
+        # 记录全量重建完成时间（{"_id": "rollup", "rebuilt_at": ...}）
+        self.meta_collection = meta_collection
+
+    async def _inc(self, username: str, day: str, inc: Dict[str, int], session=None) -> None:
+        if not inc:
+            return
+        try:
+            await self.collection.update_one(
+                {"username": username, "day": day},
+                {"$inc": inc, "$set": {"updated_at": datetime.utcnow()}},
+                upsert=True,
+                session=session
+            )
+        except Exception as e:
+            # 汇总失败不影响审查本身，可通过 rebuild 修复
+            logger.error(f"更新审查统计汇总失败: {str(e)}")
+
+    async def record_created(self, review: Dict[str, Any], session=None) -> None:
+        """审查记录创建时计入总数、状态、仓库和作者"""
+        await self._inc(review.get("username"), stats_day(review.get("created_at")), {
+            "total": 1,
+            f"status.{stats_key(review.get('status'))}": 1,
+            f"repos.{stats_key(repo_key(review))}": 1,
+            f"authors.{stats_key(review.get('author'))}": 1,
+        }, session)
+
+    async def record_status_change(
+        self,
+        before: Dict[str, Any],
+        status: str,
+        final_result: Any = None,
+        agent_outputs: Optional[List[Dict[str, Any]]] = None,
+        session=None
+    ) -> None:
+        """
+        审查状态变化时更新汇总
+
+        Args:
+            before: 更新前的审查记录（至少包含 username、created_at、status）
+            status: 新状态
+            final_result: 审查完成时的最终结果，用于统计问题
+            agent_outputs: 审查完成时的agent输出
+        """
+        old_status = before.get("status")
+        if old_status == status:
+            return
+        inc: Dict[str, int] = {f"status.{stats_key(status)}": 1}
+        if old_status:
+            inc[f"status.{stats_key(old_status)}"] = -1
+        if status == "completed":
+            for field, counter in issue_counters(final_result).items():
+                for key, count in counter.items():
+                    inc[f"{field}.{key}"] = count
+            for entry in agent_summary(agent_outputs):
+                agent = stats_key(entry["agent"])
+                inc[f"agents.{agent}.outputs"] = entry["outputs"]
+                inc[f"agents.{agent}.output_chars"] = entry["output_chars"]
+        await self._inc(before.get("username"), stats_day(before.get("created_at")), inc, session)
+
+    async def read(self, username: Optional[str], days: Optional[int] = None) -> Dict[str, Any]:
+        """汇总用户（None为全部用户）最近days天的计数"""
+        query: Dict[str, Any] = {}
+        if username:
+            query["username"] = username
+        if days:
+            query["day"] = {"$gte": stats_day(datetime.utcnow() - timedelta(days=days - 1))}
+        counters = empty_counters()
+        async for doc in self.collection.find(query, {"_id": 0, "username": 0, "day": 0, "updated_at": 0}):
+            merge_counters(counters, doc)
+        return counters
+
+    @staticmethod
+    async def _aggregate_days(reviews_collection, match: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """按创建日期计算审查记录的汇总计数：日期 -> 计数"""
+        result = await reviews_collection.aggregate(facet_pipeline(match, with_day=True)).to_list(length=1)
+        days: Dict[str, Dict[str, Any]] = {}
+        facets = result[0] if result else {}
+        for field in ("total",) + COUNTER_FIELDS:
+            for row in facets.get(field, []):
+                doc = days.setdefault(row["_id"]["day"], empty_counters())
+                if field == "total":
+                    doc["total"] = row["count"]
+                else:
+                    key = stats_key(row["_id"].get("key"))
+                    doc[field][key] = doc[field].get(key, 0) + row["count"]
+        for row in facets.get("agents", []):
+            doc = days.setdefault(row["_id"]["day"], empty_counters())
+            doc["agents"][stats_key(row["_id"].get("key"))] = {
+                "outputs": row["outputs"], "output_chars": row["output_chars"]
+            }
+        return days
+
+    async def _replace_days(self, username: str, days: Dict[str, Dict[str, Any]], prune: bool = False) -> None:
+        """逐个替换用户的汇总文档，prune 时删除该用户不在 days 中的汇总文档"""
+        now = datetime.utcnow()
+        for day, counters in days.items():
+            await self.collection.replace_one(
+                {"username": username, "day": day},
+                {"username": username, "day": day, **counters, "updated_at": now},
+                upsert=True
+            )
+        if prune:
+            await self.collection.delete_many({"username": username, "day": {"$nin": list(days)}})
+
+    async def _resync_changed(self, reviews_collection, match: Dict[str, Any], since: datetime) -> int:
+        """
+        重新计算 since 之后有变化的审查所在的汇总文档
+
+        重建期间的增量更新可能写入了被替换掉的集合，或被重建结果覆盖，替换完成后按天重新计算。
+
+        Returns:
+            int: 重新计算的汇总文档数量
+        """
+        buckets = set()
+        async for doc in reviews_collection.find({**match, "updated_at": {"$gte": since}}, {"username": 1, "created_at": 1}):
+            buckets.add((doc.get("username"), stats_day(doc.get("created_at"))))
+        for user, day in buckets:
+            start = datetime.strptime(day, "%Y-%m-%d")
+            days = await self._aggregate_days(reviews_collection, {
+                "username": user, "created_at": {"$gte": start, "$lt": start + timedelta(days=1)}
+            })
+            await self._replace_days(user, days)
+        return len(buckets)
+
+    async def rebuild(self, reviews_collection, username: Optional[str] = None) -> int:
+        """
+        从审查记录重建汇总
+
+        全量重建写入暂存集合，完成后通过 rename 整体替换汇总集合，重建期间统计接口读取的
+        始终是完整的旧汇总；单用户重建逐个替换该用户的汇总文档。
+
+        Returns:
+            int: 写入的汇总文档数量
+        """
+        started_at = datetime.utcnow()
+        match: Dict[str, Any] = {"username": username} if username else {}
+        await backfill_agent_summaries(reviews_collection, match)
+        written = 0
+        if username:
+            days = await self._aggregate_days(reviews_collection, {"username": username})
+            await self._replace_days(username, days, prune=True)
+            written = len(days)
+        else:
+            staging = self.collection.database[f"{self.collection.name}_rebuild"]
+            await staging.drop()
+            await staging.create_indexes(INDEX_SPECS[self.collection.name])
+            for user in await reviews_collection.distinct("username"):
+                days = await self._aggregate_days(reviews_collection, {"username": user})
+                now = datetime.utcnow()
+                docs = [{"username": user, "day": day, **counters, "updated_at": now} for day, counters in days.items()]
+                if docs:
+                    await staging.insert_many(docs)
+                written += len(docs)
+            await staging.rename(self.collection.name, dropTarget=True)
+
+        resynced = await self._resync_changed(reviews_collection, match, started_at)
+        if not username:
+            await self.meta_collection.update_one(
+                {"_id": "rollup"}, {"$set": {"rebuilt_at": started_at}}, upsert=True
+            )
+        logger.info(f"审查统计汇总重建完成，范围: {match or '全部用户'}，文档数: {written}，重建期间变化: {resynced}")
+        return written
+
+    async def ensure_rebuilt(self, reviews_collection) -> bool:
+        """
+        汇总从未全量重建过时（刚启用汇总，历史审查尚未计入）执行一次重建
+
+        Returns:
+            bool: 是否执行了重建
+        """
+        if not REVIEW_STATS_ROLLUP or await self.meta_collection.find_one({"_id": "rollup"}):
+            return False
+        logger.info("审查统计汇总尚未重建过，开始从审查记录重建")
+        await self.rebuild(reviews_collection)
+        return True
+
+
+async def backfill_agent_summaries(reviews_collection, match: Optional[Dict[str, Any]] = None, blob_store=review_blob_store) -> int:
+    """
+    为agent输出已外置、但缺少 agent_summary 的审查记录补写摘要
+
+    Returns:
+        int: 补写的审查数量
+    """
+    query = {**(match or {}), "agent_summary": {"$exists": False}, "blob_refs.agent_outputs": {"$exists": True}}
+    updated = 0
+    async for doc in reviews_collection.find(query, {"agent_outputs": 1, "blob_refs.agent_outputs": 1}):
+        doc = await blob_store.resolve(doc)
+        await reviews_collection.update_one(
+            {"_id": doc["_id"]}, {"$set": {"agent_summary": agent_summary(doc.get("agent_outputs"))}}
+        )
+        updated += 1
+    if updated:
+        logger.info(f"已为 {updated} 个审查记录补写 agent_summary")
+    return updated
+
+
+async def live_counters(reviews_collection, username: Optional[str]) -> Dict[str, Any]:
+    """用一次 $facet 聚合直接从审查记录计算计数"""
+    match: Dict[str, Any] = {"username": username} if username else {}
+    result = await reviews_collection.aggregate(facet_pipeline(match)).to_list(length=1)
+    facets = result[0] if result else {}
+    counters = empty_counters()
+    counters["total"] = sum(row["count"] for row in facets.get("total", []))
+    for field in COUNTER_FIELDS:
+        for row in facets.get(field, []):
+            key = stats_key(row["_id"])
+            counters[field][key] = counters[field].get(key, 0) + row["count"]
+    for row in facets.get("agents", []):
+        counters["agents"][stats_key(row["_id"])] = {"outputs": row["outputs"], "output_chars": row["output_chars"]}
+    return counters
+
+
+# 创建全局实例
+review_stats_rollup = ReviewStatsRollup(get_collection("review_stats_daily"), get_collection("review_stats_meta"))
+
+
+if __name__ == "__main__":
+    # 从审查记录重建汇总：python -m app.services.codereview.stats [username]
+    import sys
+    import asyncio
+    from app.utils.database import codereviews_collection
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(review_stats_rollup.rebuild(codereviews_collection, sys.argv[1] if len(sys.argv) > 1 else None))
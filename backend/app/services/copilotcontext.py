@@ -0,0 +1,413 @@
+"""
+智能助手上下文管理模块
+
+聊天记录中保存的系统消息内嵌了完整diff和审查结果，逐轮把全部记录发给模型会让
+成本和延迟随对话长度线性增长，直到超出上下文窗口。这里按token预算组装每一轮的上下文：
+
+- 第一条系统消息是静态前缀（角色、PR信息、变更文件概览、精简的问题列表），同一审查内容
+  不变时逐字节相同，使模型服务商的前缀缓存可以命中
+- 前缀所需的精简上下文（拆分好的变更块、问题列表等）按审查内容的摘要缓存在进程内，
+  跨轮次、跨用户复用，内容变化时摘要随之变化，不需要显式失效；缓存总量按估算的token数限制
+- 第二条系统消息按当前问题只选取相关的diff变更块，而不是整个diff
+- 保留最近 COPILOT_RECENT_TURNS 轮对话
+- 更早的对话折叠为滚动摘要，摘要及其覆盖到的消息序号缓存在审查记录的 copilot_summary
+  字段中，只有新的对话被挤出窗口时才增量更新；每轮只从 chat_messages 读取摘要之后的消息
+
+token数按字符估算（中日韩字符约1个token，其他字符约4个字符1个token），不依赖分词器。
+"""
+
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from bson import ObjectId
+from autogen_core.models import SystemMessage, UserMessage
+
+from app.utils.cache import TTLCache
+from app.utils.codereview import build_ai_chat_prefix, build_ai_chat_context
+from app.utils.database import codereviews_collection
+from app.services.blobstore import review_blob_store
+from app.services.chatstore import chat_message_store
+
+logger = logging.getLogger(__name__)
+
+# 每轮请求的上下文token预算（不含模型输出）
+COPILOT_CONTEXT_TOKEN_BUDGET = int(os.getenv("COPILOT_CONTEXT_TOKEN_BUDGET", "12000"))
+# 系统提示中diff部分的token预算
+COPILOT_DIFF_TOKEN_BUDGET = int(os.getenv("COPILOT_DIFF_TOKEN_BUDGET", "4000"))
+# 静态前缀中问题列表的token预算
+COPILOT_RESULT_TOKEN_BUDGET = int(os.getenv("COPILOT_RESULT_TOKEN_BUDGET", "2000"))
+# 原样保留的最近对话轮数（一问一答为一轮）
+COPILOT_RECENT_TURNS = int(os.getenv("COPILOT_RECENT_TURNS", "6"))
+# 窗口外积累超过该消息数时才更新摘要，避免每轮都调用模型做摘要
+COPILOT_SUMMARY_BATCH = int(os.getenv("COPILOT_SUMMARY_BATCH", "4"))
+# 摘要的token上限
+COPILOT_SUMMARY_MAX_TOKENS = int(os.getenv("COPILOT_SUMMARY_MAX_TOKENS", "800"))
+# 精简上下文缓存的容量（条目数、所有条目估算token数之和）和存活时间（秒）
+COPILOT_CONTEXT_CACHE_MAXSIZE = int(os.getenv("COPILOT_CONTEXT_CACHE_MAXSIZE", "256"))
+COPILOT_CONTEXT_CACHE_MAX_TOKENS = int(os.getenv("COPILOT_CONTEXT_CACHE_MAX_TOKENS", "2000000"))
+COPILOT_CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("COPILOT_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+NUMBER_PATTERN = re.compile(r"\b\d{1,6}\b")
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+# 问题中不参与相关性匹配的常见词
+QUESTION_STOPWORDS = {
+    "the", "and", "for", "this", "that", "what", "why", "how", "with", "code", "line", "file",
+    "pr", "diff", "bug", "issue", "can", "you", "does", "should", "please",
+}
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你负责压缩代码审查助手与开发者的对话记录。请在已有摘要的基础上合并新的对话，"
+    "保留开发者关心的问题、已经给出的结论和建议、涉及的文件/函数/行号以及尚未解决的问题，"
+    "省略寒暄和重复内容。直接输出摘要正文，不超过{max_chars}字。"
+)
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """估算文本的token数"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    return estimate_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = "\n...（内容过长已截断）") -> str:
+    """将文本截断到token预算以内（按估算值二分查找截断位置）"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + marker
+
+
+def split_hunks(diff_text: str) -> List[Dict[str, Any]]:
+    """
+    将diff拆分为变更块
+
+    Returns:
+        List[Dict]: 每个变更块包含 file、start、end（新文件行号区间）、text（含@@头的原始文本）、
+        added、removed 和 tokens
+    """
+    hunks: List[Dict[str, Any]] = []
+    current_file = ""
+    current: Optional[Dict[str, Any]] = None
+    previous = ""
+
+    def close():
+        if current is not None:
+            current["text"] = "\n".join(current.pop("lines"))
+            current["tokens"] = estimate_tokens(current["text"])
+            hunks.append(current)
+
+    for line in diff_text.split("\n"):
+        if line.startswith("diff --git"):
+            close()
+            current = None
+        elif line.startswith("+++ ") and previous.startswith("--- "):
+            close()
+            current = None
+            path = line[4:].split("\t", 1)[0]
+            current_file = path[2:] if path.startswith("b/") else path
+        elif line.startswith("@@"):
+            close()
+            match = HUNK_HEADER_PATTERN.match(line)
+            start = int(match.group(1)) if match else 0
+            length = int(match.group(2)) if match and match.group(2) is not None else 1
+            current = {
+                "file": current_file, "start": start, "end": start + max(length - 1, 0),
+                "lines": [f"# {current_file}", line], "added": 0, "removed": 0
+            }
+        elif current is not None and not line.startswith("--- "):
+            current["lines"].append(line)
+            if line.startswith("+"):
+                current["added"] += 1
+            elif line.startswith("-"):
+                current["removed"] += 1
+        previous = line
+    close()
+    return hunks
+
+
+def issue_locations(final_result: Any) -> List[Tuple[str, int]]:
+    """审查结果中各问题的 (文件, 行号)"""
+    locations = []
+    if isinstance(final_result, dict):
+        for bug in final_result.values():
+            if isinstance(bug, dict) and bug.get("file"):
+                try:
+                    locations.append((str(bug["file"]), int(str(bug.get("line", 0)).split("-")[0])))
+                except ValueError:
+                    locations.append((str(bug["file"]), 0))
+    return locations
+
+
+def score_hunk(hunk: Dict[str, Any], terms: List[str], numbers: List[int], question: str,
+               locations: List[Tuple[str, int]]) -> float:
+    """计算变更块与问题的相关度"""
+    text = hunk["text"].lower()
+    score = float(sum(1 for term in terms if term in text))
+    file_path = hunk["file"]
+    basename = file_path.rsplit("/", 1)[-1]
+    if basename and (basename in question or file_path in question):
+        score += 5
+    if any(hunk["start"] <= number <= hunk["end"] for number in numbers):
+        score += 2
+    # 审查结果指出问题的变更块作为兜底，问题中没有可匹配的标识符时优先选取
+    if any(file_path.endswith(path) or path.endswith(file_path) for path, line in locations
+           if line == 0 or hunk["start"] <= line <= hunk["end"]):
+        score += 0.5
+    return score
+
+
+def select_hunks(hunks: List[Dict[str, Any]], question: str, final_result: Any, budget: int) -> str:
+    """按问题选取相关的变更块，在预算内按原顺序拼接为diff文本"""
+    if not hunks:
+        return ""
+    question_lower = question.lower()
+    terms = [t for t in {t.lower() for t in IDENTIFIER_PATTERN.findall(question)} if t not in QUESTION_STOPWORDS]
+    numbers = [int(n) for n in NUMBER_PATTERN.findall(question)]
+    locations = issue_locations(final_result)
+
+    scored = [
+        (score_hunk(hunk, terms, numbers, question_lower, locations), -index, index)
+        for index, hunk in enumerate(hunks)
+    ]
+    chosen: List[int] = []
+    used = 0
+    for score, _, index in sorted(scored, reverse=True):
+        hunk_tokens = hunks[index]["tokens"]
+        if used + hunk_tokens <= budget:
+            chosen.append(index)
+            used += hunk_tokens
+        elif not chosen:
+            # 最相关的变更块本身超出预算时截断后放入
+            chosen.append(index)
+            used = budget
+        if used >= budget:
+            break
+
+    parts = []
+    for index in sorted(chosen):
+        text = hunks[index]["text"]
+        parts.append(truncate_to_tokens(text, budget) if hunks[index]["tokens"] > budget else text)
+
+    # 完整的变更文件概览在静态前缀中，这里只说明省略了多少
+    omitted = len(hunks) - len(chosen)
+    header = f"# 以下仅展示与当前问题相关的 {len(chosen)}/{len(hunks)} 个变更块\n" if omitted else ""
+    return header + "\n".join(parts)
+
+
+def diff_overview(hunks: List[Dict[str, Any]]) -> str:
+    """全部变更文件及其增删行数，模型可以知道未展示的部分"""
+    files: Dict[str, List[int]] = {}
+    for hunk in hunks:
+        counts = files.setdefault(hunk["file"], [0, 0])
+        counts[0] += hunk["added"]
+        counts[1] += hunk["removed"]
+    return "\n".join(f"{path} (+{added} -{removed})" for path, (added, removed) in files.items())
+
+
+def condense_issues(final_result: Any, budget: int) -> str:
+    """将审查结果精简为每个问题一行的列表（非结构化结果按原文截断）"""
+    if not isinstance(final_result, dict):
+        text = final_result if isinstance(final_result, str) else json.dumps(final_result or {}, ensure_ascii=False, indent=2)
+        return truncate_to_tokens(text, budget)
+    lines = []
+    for bug in final_result.values():
+        if not isinstance(bug, dict):
+            continue
+        line = (
+            f"- [{bug.get('severity') or '未知'}] {bug.get('file') or '?'}:{bug.get('line') or '?'} "
+            f"{bug.get('bug_type') or ''}: {truncate_to_tokens(str(bug.get('description') or ''), 80, '…')}"
+        )
+        if bug.get("suggestion"):
+            line += f"（建议：{truncate_to_tokens(str(bug['suggestion']), 60, '…')}）"
+        lines.append(line)
+    return truncate_to_tokens("\n".join(lines), budget) if lines else "未发现问题"
+
+
+def context_fingerprint(review: Dict[str, Any], diff_identity: str) -> str:
+    """构建静态前缀的全部输入的摘要，作为精简上下文缓存的键"""
+    payload = json.dumps(
+        [review.get("pr_title"), review.get("pr_body"), review.get("final_result"), diff_identity],
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CopilotContextManager:
+    """按token预算为智能助手组装每一轮的上下文"""
+
+    def __init__(
+        self,
+        collection=codereviews_collection,
+        blob_store=review_blob_store,
+        chat_store=chat_message_store,
+        token_budget: int = COPILOT_CONTEXT_TOKEN_BUDGET,
+        recent_turns: int = COPILOT_RECENT_TURNS
+    ):
+        self.collection = collection
+        self.blob_store = blob_store
+        self.chat_store = chat_store
+        self.token_budget = token_budget
+        self.recent_messages = max(1, recent_turns * 2)
+        # 内容摘要 -> 精简上下文（变更块、静态前缀及其token数）
+        self._condensed = TTLCache(
+            maxsize=COPILOT_CONTEXT_CACHE_MAXSIZE,
+            ttl=COPILOT_CONTEXT_CACHE_TTL_SECONDS,
+            maxweight=COPILOT_CONTEXT_CACHE_MAX_TOKENS
+        )
+        # 命中缓存时复用的静态前缀token数（估算）
+        self.reused_prefix_tokens = 0
+
+    async def _load_review(self, review_id: str) -> Dict[str, Any]:
+        """读取组装上下文需要的审查字段（不含diff正文）"""
+        projection = {
+            "pr_title": 1, "pr_body": 1, "final_result": 1, "copilot_summary": 1, "blob_refs.diff_content": 1
+        }
+        return await self.collection.find_one({"_id": ObjectId(review_id)}, projection) or {}
+
+    async def _condensed_context(self, review_id: str, review: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        获取审查的精简上下文，未命中缓存时才读取diff并构建
+
+        外置的diff以其内容引用参与摘要，内容相同的审查（例如同一PR重新审查）共享缓存；
+        内嵌的小diff在审查创建后不再变化，以审查ID代替。
+        """
+        diff_ref = ((review.get("blob_refs") or {}).get("diff_content") or {}).get("ref")
+        key = context_fingerprint(review, diff_ref or f"inline:{review_id}")
+        condensed = self._condensed.get(key)
+        if condensed is not None:
+            self.reused_prefix_tokens += condensed["prefix_tokens"]
+            return condensed
+
+        diff_doc = await self.collection.find_one(
+            {"_id": ObjectId(review_id)}, {"diff_content": 1, "blob_refs.diff_content": 1}
+        ) or {}
+        diff_doc = await self.blob_store.resolve(diff_doc)
+        hunks = split_hunks(diff_doc.get("diff_content") or "")
+        prefix = build_ai_chat_prefix(
+            review.get("pr_title"),
+            review.get("pr_body"),
+            diff_overview(hunks),
+            condense_issues(review.get("final_result"), COPILOT_RESULT_TOKEN_BUDGET)
+        )
+        condensed = {"hunks": hunks, "prefix": prefix, "prefix_tokens": estimate_tokens(prefix)}
+        # 按变更块和前缀的估算token数计入缓存容量，超大diff不缓存
+        self._condensed.set(key, condensed, weight=condensed["prefix_tokens"] + sum(hunk["tokens"] for hunk in hunks))
+        return condensed
+
+    def stats(self) -> Dict[str, Any]:
+        """精简上下文缓存的命中率、淘汰数和复用的前缀token数"""
+        return {**self._condensed.stats(), "reused_prefix_tokens": self.reused_prefix_tokens}
+
+    async def _summarize(self, model_client, previous: str, messages: List[Dict[str, Any]]) -> str:
+        """将被挤出窗口的对话合并进滚动摘要"""
+        transcript = "\n".join(
+            f"{'开发者' if m.get('role') == 'user' else '助手'}: {truncate_to_tokens(m.get('content', ''), 1000)}"
+            for m in messages
+        )
+        max_chars = COPILOT_SUMMARY_MAX_TOKENS
+        try:
+            result = await model_client.create([
+                SystemMessage(content=SUMMARY_SYSTEM_PROMPT.format(max_chars=max_chars)),
+                UserMessage(content=f"已有摘要：\n{previous or '（无）'}\n\n新的对话：\n{transcript}", source="user")
+            ])
+            summary = result.content if isinstance(result.content, str) else ""
+        except Exception as e:
+            logger.warning(f"生成对话摘要失败，使用截断的对话代替: {str(e)}")
+            summary = ""
+        if not summary:
+            # 模型不可用时退化为逐条截断的摘录
+            excerpt = "\n".join(
+                f"{'开发者' if m.get('role') == 'user' else '助手'}: {truncate_to_tokens(m.get('content', ''), 60, '…')}"
+                for m in messages
+            )
+            summary = f"{previous}\n{excerpt}".strip()
+        return truncate_to_tokens(summary, COPILOT_SUMMARY_MAX_TOKENS, "…")
+
+    async def build_messages(self, review_id: str, model_client) -> List[Dict[str, Any]]:
+        """
+        为本轮请求组装发送给模型的消息（调用前本轮的用户消息应已写入聊天记录）
+
+        Args:
+            review_id: 代码审查ID
+            model_client: 生成摘要使用的模型客户端
+
+        Returns:
+            List[Dict]: 静态前缀 + 动态上下文（相关变更块和对话摘要）+ 最近的对话
+        """
+        review = await self._load_review(review_id)
+        condensed = await self._condensed_context(review_id, review)
+        summary_state = review.get("copilot_summary") or {}
+        summary = summary_state.get("text", "")
+        upto_seq = summary_state.get("upto_seq", 0)
+
+        # 只读取摘要之后的消息；聊天记录中保存的系统消息内嵌了完整diff，这里按当前问题重新构建
+        history = [
+            m for m in await self.chat_store.list_messages(review_id, after=upto_seq)
+            if m.get("role") in ("user", "assistant")
+        ]
+        question = next((m.get("content", "") for m in reversed(history) if m.get("role") == "user"), "")
+
+        relevant_diff = select_hunks(condensed["hunks"], question, review.get("final_result"), COPILOT_DIFF_TOKEN_BUDGET)
+
+        available = (
+            self.token_budget - condensed["prefix_tokens"] - estimate_tokens(relevant_diff) - COPILOT_SUMMARY_MAX_TOKENS
+        )
+        if len(history) > self.recent_messages + COPILOT_SUMMARY_BATCH or sum(map(message_tokens, history)) > available:
+            keep_from = max(0, len(history) - self.recent_messages)
+            while keep_from < len(history) - 1 and sum(map(message_tokens, history[keep_from:])) > available:
+                keep_from += 1
+            if keep_from > 0:
+                summary = await self._summarize(model_client, summary, history[:keep_from])
+                upto_seq = history[keep_from - 1]["seq"]
+                history = history[keep_from:]
+                # 并发请求可能已写入覆盖更多消息的摘要，只在本次摘要更新时写入，避免回退
+                await self.collection.update_one(
+                    {"_id": ObjectId(review_id), "copilot_summary.upto_seq": {"$not": {"$gte": upto_seq}}},
+                    {"$set": {"copilot_summary": {"text": summary, "upto_seq": upto_seq}}}
+                )
+
+        recent = []
+        remaining = max(available, 0)
+        # 从最新的消息往前放，单条消息超出剩余预算时截断
+        for message in reversed(history):
+            content = message.get("content", "")
+            tokens = message_tokens(message)
+            if tokens > remaining:
+                if recent:
+                    break
+                content = truncate_to_tokens(content, max(remaining - MESSAGE_OVERHEAD_TOKENS, 0))
+                tokens = remaining
+            recent.append({"role": message["role"], "content": content})
+            remaining -= tokens
+
+        messages = [{"role": "system", "content": condensed["prefix"]}]
+        context = build_ai_chat_context(relevant_diff, summary)
+        if context:
+            messages.append({"role": "system", "content": context})
+        return messages + list(reversed(recent))
+
+
+# 创建全局实例
+copilot_context_manager = CopilotContextManager()
@@ -5,10 +5,9 @@ from app.models.jira import JiraConnection, JiraConnectionWithToken
 from app.utils.encryption import decrypt_access_token, decrypt_refresh_token
 from app.utils.encryption import encrypt_access_token, encrypt_refresh_token
 from app.utils.database import get_collection
+from app.utils.jiraclient import jira_client
 import datetime
-import requests
 import json
-from requests.auth import HTTPBasicAuth
 
 
 # 获取Jira连接集合
@@ -139,7 +138,7 @@ async def test_connection(connection_data: JiraConnectionTest) -> dict:
             api_url = f"{connection_data.jira_url}/rest/api/2/serverInfo"
         
         # 发送请求测试连接
-        response = requests.get(api_url, headers=headers, timeout=10)
+        response = await jira_client.get(api_url, headers=headers)
         
         if response.status_code == 200:
             return {"success": True, "message": "Jira连接成功!", "server_info": response.json()}
@@ -205,7 +204,7 @@ async def create_issue(connection_id, issue_data: dict) -> dict:
             jira_issue["fields"]["assignee"] = {"name": issue_data["assignee"]}
         
         # 发送请求创建Issue
-        response = requests.post(api_url, headers=headers, json=jira_issue, timeout=10)
+        response = await jira_client.post(api_url, headers=headers, json=jira_issue)
         
         if response.status_code == 201 or response.status_code == 200:
             return {"success": True, "issue": response.json()}
@@ -1,5 +1,10 @@
-from typing import Dict, List, Optional
-from app.utils.database import programmers_collection
+from typing import Dict, List, Optional, Any
+from datetime import datetime
+import os
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.utils.database import programmers_collection, get_collection
 from app.models.programmer import ProgrammerInDB
 import logging
 
@@ -7,78 +12,211 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 新程序员的初始信誉分
+REPUTATION_DEFAULT_SCORE = 60
+# 程序员文档中保留的最近信誉事件条数，完整历史在 reputation_events 集合中
+REPUTATION_HISTORY_WINDOW = int(os.getenv("REPUTATION_HISTORY_WINDOW", "20"))
+# 程序员文档中保留的最近已计分事件键数量，用于识别重试提交的同一事件
+REPUTATION_APPLIED_KEYS_WINDOW = int(os.getenv("REPUTATION_APPLIED_KEYS_WINDOW", "50"))
+
+# 信誉事件（只追加）
+reputation_events_collection = get_collection("reputation_events")
+
+
 class ReputationService:
     """信誉服务类，用于处理用户信誉分的计算和更新"""
-    
+
     @staticmethod
-    async def get_programmer_reputation(username: str) -> Dict:
+    async def get_programmer_reputation(username: str, session=None) -> Dict:
         """
         获取程序员的信誉信息
-        
+
         Args:
             username: 用户名
-            
+            session: 可选的事务会话
+
         Returns:
-            包含信誉分数和历史记录的字典
+            包含信誉分数和最近信誉事件的字典
         """
-        # 从数据库中查找程序员
-        programmer_doc = await programmers_collection.find_one({"username": username})
-        
+        # 从数据库中查找程序员，只读取信誉分和最近的事件窗口
+        programmer_doc = await programmers_collection.find_one(
+            {"username": username},
+            {"reputation_score": 1, "reputation_history": {"$slice": -REPUTATION_HISTORY_WINDOW}},
+            session=session
+        )
+
         if not programmer_doc:
             # 如果程序员不存在，返回默认信誉值
-            return {"score": 60, "history": []}
-        
+            return {"score": REPUTATION_DEFAULT_SCORE, "history": []}
+
         # 返回程序员的信誉信息
         return {
-            "score": programmer_doc.get("reputation_score", 60),
+            "score": programmer_doc.get("reputation_score", REPUTATION_DEFAULT_SCORE),
             "history": programmer_doc.get("reputation_history", [])
         }
-    
+
     @staticmethod
-    async def update_programmer_reputation(username: str, event: str = None, delta_reputation: int = None) -> Dict:
+    async def update_programmer_reputation(
+        username: str, event: str = None, delta_reputation: int = 0, session=None, event_key: Optional[str] = None
+    ) -> Dict:
         """
         根据事件或数值变化更新程序员的信誉分数
-        
+
+        分数用 $inc 原子更新，最近事件用 $push + $slice 维护固定长度的窗口，
+        并发审查同一作者时不会丢失更新；完整历史追加到 reputation_events。
+
+        先更新程序员文档再记录事件：未启用事务时中途失败最多缺少一条事件记录，不会出现
+        有事件而分数未变化的情况。传入 event_key 时同一事件重复提交（重试）只计分一次，
+        事件按键upsert，重试会补上之前缺失的事件记录。
+
         Args:
             username: 用户名
             event: 事件类型 (passed / minor_issue / severe_bug / rejected)
             delta_reputation: 信誉分数的变化值
-            
+            session: 可选的事务会话
+            event_key: 可选的事件幂等键（例如审查ID）
+
         Returns:
             更新后的信誉信息
         """
-        # 获取当前用户信誉
-        current_reputation = await ReputationService.get_programmer_reputation(username)
-        score = current_reputation["score"]
-        history = current_reputation["history"]
-        
-        score += delta_reputation
-
-        
-        history.append(event)
-        
-        # 更新数据库中的程序员信誉信息
-        await programmers_collection.update_one(
-            {"username": username},
-            {
-                "$set": {
-                    "reputation_score": score,
-                    "reputation_history": history
-                },
-                "$currentDate": {"updated_at": True}
-            },
-            upsert=True
+        delta_reputation = delta_reputation or 0
+        now = datetime.utcnow()
+
+        query: Dict[str, Any] = {"username": username}
+        update = {
+            "$inc": {"reputation_score": delta_reputation},
+            "$push": {"reputation_history": {"$each": [event], "$slice": -REPUTATION_HISTORY_WINDOW}},
+            "$set": {"updated_at": now}
+        }
+        if event_key:
+            query["applied_event_keys"] = {"$ne": event_key}
+            update["$push"]["applied_event_keys"] = {"$each": [event_key], "$slice": -REPUTATION_APPLIED_KEYS_WINDOW}
+        projection = {"reputation_score": 1, "reputation_history": 1}
+        programmer_doc = await programmers_collection.find_one_and_update(
+            query, update,
+            projection=projection, return_document=ReturnDocument.AFTER, session=session
         )
-        
+        if programmer_doc is None and not await programmers_collection.find_one(
+            {"username": username}, {"_id": 1}, session=session
+        ):
+            # 首次出现的作者：先以初始分创建文档（username唯一索引保证只创建一份），再原子更新
+            try:
+                await programmers_collection.update_one(
+                    {"username": username},
+                    {"$setOnInsert": {
+                        "reputation_score": REPUTATION_DEFAULT_SCORE,
+                        "reputation_history": [],
+                        "history_migrated": True,
+                        "created_at": now
+                    }},
+                    upsert=True,
+                    session=session
+                )
+            except DuplicateKeyError:
+                # 并发请求已创建
+                pass
+            programmer_doc = await programmers_collection.find_one_and_update(
+                query, update,
+                projection=projection, return_document=ReturnDocument.AFTER, session=session
+            )
+        if programmer_doc is None:
+            # 该事件已经计分（重试提交），只补记事件
+            logger.info(f"用户 {username} 的信誉事件 {event_key} 已计分，跳过")
+            programmer_doc = await programmers_collection.find_one({"username": username}, projection, session=session)
+
+        event_doc = {"username": username, "event": event, "delta": delta_reputation, "created_at": now}
+        if event_key:
+            try:
+                await reputation_events_collection.update_one(
+                    {"key": event_key}, {"$setOnInsert": event_doc}, upsert=True, session=session
+                )
+            except DuplicateKeyError:
+                # 并发的重试已记录
+                pass
+        else:
+            await reputation_events_collection.insert_one(event_doc, session=session)
+
+        score = programmer_doc["reputation_score"]
+        history = programmer_doc.get("reputation_history", [])
         logger.info(f"用户 {username} 的信誉分已更新: {score}, 事件: {event}, 变化值: {delta_reputation}")
-        
+
         return {
             "status": "updated",
             "author": username,
             "new_score": score,
             "history": history
         }
-    
+
+    @staticmethod
+    async def list_reputation_events(username: str, before: Optional[str] = None, limit: int = 20) -> Dict[str, Any]:
+        """
+        分页获取程序员的完整信誉事件（最新在前）
+
+        Args:
+            username: 用户名
+            before: 上一页返回的 next_before，获取更早的事件
+            limit: 每页数量
+
+        Returns:
+            Dict: {"events": 事件列表, "next_before": 下一页游标（没有更多时为None）}
+
+        Raises:
+            ValueError: 游标格式无效
+        """
+        query: Dict[str, Any] = {"username": username}
+        if before:
+            if not ObjectId.is_valid(before):
+                raise ValueError(f"无效的分页游标: {before}")
+            query["_id"] = {"$lt": ObjectId(before)}
+
+        cursor = reputation_events_collection.find(query).sort("_id", -1).limit(limit + 1)
+        docs = await cursor.to_list(length=limit + 1)
+        has_next = len(docs) > limit
+        docs = docs[:limit]
+
+        events = [
+            {
+                "id": str(doc["_id"]),
+                "event": doc.get("event"),
+                "delta": doc.get("delta"),
+                "created_at": doc.get("created_at")
+            }
+            for doc in docs
+        ]
+        return {"events": events, "next_before": events[-1]["id"] if has_next else None}
+
+    @staticmethod
+    async def migrate_history_to_events() -> int:
+        """
+        将旧版文档中完整的 reputation_history 迁移到 reputation_events，并截断为最近窗口
+
+        旧事件没有时间和分值，按原顺序写入（_id 保持先后顺序）。已迁移的文档带有
+        history_migrated 标记，重复执行不会重复写入。
+
+        Returns:
+            int: 迁移的程序员数量
+        """
+        migrated = 0
+        query = {"history_migrated": {"$ne": True}}
+        async for programmer_doc in programmers_collection.find(query, {"username": 1, "reputation_history": 1}):
+            history: List[str] = programmer_doc.get("reputation_history") or []
+            if history:
+                await reputation_events_collection.insert_many([
+                    {"username": programmer_doc["username"], "event": event, "delta": None, "legacy": True}
+                    for event in history
+                ])
+            await programmers_collection.update_one(
+                {"_id": programmer_doc["_id"]},
+                {
+                    "$set": {"history_migrated": True},
+                    "$push": {"reputation_history": {"$each": [], "$slice": -REPUTATION_HISTORY_WINDOW}}
+                }
+            )
+            migrated += 1
+        if migrated:
+            logger.info(f"已将 {migrated} 个程序员的信誉历史迁移到 reputation_events")
+        return migrated
+
 
 # 创建全局实例
-reputation_service = ReputationService()
\ No newline at end of file
+reputation_service = ReputationService()
@@ -0,0 +1,722 @@
+"""
+异步审查任务存储模块
+
+为 /api/codereview/submit 提交的异步任务提供可插拔的持久化存储，
+每次读写只涉及单个任务（按task_id索引），与历史任务总量无关。
+
+支持的后端（通过 TASK_STORE_BACKEND 环境变量选择）：
+- mongo: 使用MongoDB的 review_tasks 集合，已完成任务依赖TTL索引自动过期
+- sqlite: 使用嵌入式SQLite数据库文件，适合单机部署
+
+任务的状态变更与审查过程中的agent事件也写入同一存储（按任务递增的seq排序），
+任意API进程都可以据此向客户端推送进度，不依赖进程内存。追加事件时通过进程内的
+TaskEventHub 唤醒正在等待该任务的连接；mongo后端在副本集上还会用一个进程级的
+change stream 接收其他进程（worker）写入的事件。都不可用时等待方按
+REVIEW_EVENTS_POLL_INTERVAL 回退轮询。
+
+执行中的任务持有租约：执行方（worker或inline模式的API进程）每隔 1/3 租约时间刷新
+claimed_at。执行进程崩溃或被杀死后租约过期，带有payload的任务会被其他worker重新领取
+（最多 REVIEW_TASK_MAX_CLAIMS 次），无法重新执行的任务由 expire_stale_tasks 标记为失败。
+inline模式的任务在等待进程内并发名额时仍是pending（没有payload），创建时即持有租约，
+API进程退出后同样过期失败，不会一直计入排队数量。
+"""
+
+import os
+import json
+import pickle
+import sqlite3
+import asyncio
+import threading
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, AsyncIterator, Iterator, Set
+
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+from app.utils.database import get_collection
+
+logger = logging.getLogger(__name__)
+
+# 存储后端：mongo | sqlite
+TASK_STORE_BACKEND = os.getenv("TASK_STORE_BACKEND", "mongo").lower()
+# 已结束任务（completed/failed）的保留时间
+TASK_STORE_TTL_HOURS = float(os.getenv("TASK_STORE_TTL_HOURS", "72"))
+# SQLite后端的数据库文件
+TASK_STORE_SQLITE_PATH = os.getenv("TASK_STORE_SQLITE_PATH", "task_store.db")
+# 旧版pickle任务存储文件，启动时迁移
+LEGACY_TASK_STORE_FILE = os.getenv("LEGACY_TASK_STORE_FILE", "task_store.pkl")
+
+# 审查任务执行方式：
+# inline: 由API进程内的BackgroundTasks执行（受 REVIEW_MAX_INFLIGHT 限制）
+# worker: API只负责入队，由独立的 `python -m app.worker` 进程拉取执行
+REVIEW_EXECUTION_MODE = os.getenv("REVIEW_EXECUTION_MODE", "inline").lower()
+# 单个进程内同时执行的审查任务上限
+REVIEW_MAX_INFLIGHT = int(os.getenv("REVIEW_MAX_INFLIGHT", "2"))
+# 排队任务超过该数量时 /submit 返回429
+REVIEW_QUEUE_MAX_BACKLOG = int(os.getenv("REVIEW_QUEUE_MAX_BACKLOG", "100"))
+# 执行中任务的租约（秒），超过该时间未刷新 claimed_at 视为执行进程已退出
+REVIEW_TASK_LEASE_SECONDS = float(os.getenv("REVIEW_TASK_LEASE_SECONDS", "300"))
+# 同一任务最多被领取的次数，超过后不再重新领取（避免反复导致worker崩溃的任务无限重试）
+REVIEW_TASK_MAX_CLAIMS = int(os.getenv("REVIEW_TASK_MAX_CLAIMS", "3"))
+
+# 进度推送（/stream、/events）没有收到事件通知时的回退轮询间隔（秒）
+REVIEW_EVENTS_POLL_INTERVAL = float(os.getenv("REVIEW_EVENTS_POLL_INTERVAL", "10"))
+# 任务已结束但还没有读到结束状态事件时，再等待该事件的时间（秒）
+REVIEW_EVENTS_FINAL_GRACE = float(os.getenv("REVIEW_EVENTS_FINAL_GRACE", "1"))
+# 单个SSE连接的最长持续时间（秒），到期后客户端携带Last-Event-ID重连
+REVIEW_STREAM_MAX_SECONDS = float(os.getenv("REVIEW_STREAM_MAX_SECONDS", "900"))
+
+# 进入这些状态后任务开始计算过期时间
+FINISHED_STATUSES = ("completed", "failed")
+
+# 需要在序列化时保留为datetime的字段
+DATETIME_FIELDS = ("created_at", "updated_at", "expires_at", "claimed_at")
+
+
+class TaskEventHub:
+    """进程内的任务事件通知：追加事件时唤醒等待同一任务的连接"""
+
+    def __init__(self):
+        # task_id -> 等待方的事件集合
+        self._subscribers: Dict[str, Set[asyncio.Event]] = {}
+
+    @contextmanager
+    def subscribe(self, task_id: str) -> Iterator[asyncio.Event]:
+        """
+        订阅任务的新事件通知
+
+        读取事件前先 clear()，之后到达的通知都会使其置位，不会漏掉读取与等待之间写入的事件。
+        """
+        notified = asyncio.Event()
+        self._subscribers.setdefault(task_id, set()).add(notified)
+        try:
+            yield notified
+        finally:
+            subscribers = self._subscribers.get(task_id)
+            if subscribers is not None:
+                subscribers.discard(notified)
+                if not subscribers:
+                    del self._subscribers[task_id]
+
+    def notify(self, task_id: str) -> None:
+        for notified in self._subscribers.get(task_id, ()):
+            notified.set()
+
+    @property
+    def watched_tasks(self) -> int:
+        return len(self._subscribers)
+
+
+class BaseTaskStore:
+    """任务存储基类，定义所有后端需要实现的接口"""
+
+    def __init__(self, ttl_hours: float = TASK_STORE_TTL_HOURS, lease_seconds: float = REVIEW_TASK_LEASE_SECONDS):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.lease_duration = timedelta(seconds=lease_seconds)
+        self.hub = TaskEventHub()
+
+    def start_event_feed(self) -> None:
+        """启动跨进程的事件通知（后端不支持时为空操作）"""
+
+    async def close_event_feed(self) -> None:
+        """停止跨进程的事件通知"""
+
+    async def init(self) -> None:
+        """初始化存储（建表/建索引）"""
+        raise NotImplementedError
+
+    async def create_task(self, task_id: str, task: Dict[str, Any]) -> None:
+        """创建任务记录"""
+        raise NotImplementedError
+
+    async def update_task(self, task_id: str, fields: Dict[str, Any]) -> bool:
+        """更新任务的部分字段，返回任务是否存在"""
+        raise NotImplementedError
+
+    async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """按task_id获取任务，已过期的任务视为不存在"""
+        raise NotImplementedError
+
+    async def purge_expired(self) -> int:
+        """删除已过期任务，返回删除数量"""
+        raise NotImplementedError
+
+    async def insert_if_absent(self, task_id: str, task: Dict[str, Any]) -> bool:
+        """仅当任务不存在时写入（用于迁移），返回是否写入"""
+        raise NotImplementedError
+
+    async def claim_next_task(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """
+        原子地领取最早的待处理任务（pending -> processing），租约过期且可重新执行的
+        processing任务同样可以被领取
+
+        Returns:
+            Optional[Dict[str, Any]]: 领取到的任务（包含task_id字段），队列为空时返回None
+        """
+        raise NotImplementedError
+
+    async def heartbeat(self, task_id: str) -> None:
+        """刷新未结束任务的租约（claimed_at）"""
+        raise NotImplementedError
+
+    async def find_stale_tasks(self) -> List[str]:
+        """租约已过期、且无法重新领取的任务ID：没有payload的pending/processing任务（inline模式），或领取次数已用完的processing任务"""
+        raise NotImplementedError
+
+    async def expire_stale_tasks(self) -> int:
+        """
+        将执行进程已退出、无法重新执行的任务标记为失败
+
+        Returns:
+            int: 标记的任务数量
+        """
+        expired = 0
+        for task_id in await self.find_stale_tasks():
+            await self.update_task(task_id, {
+                "status": "failed",
+                "error": "任务执行进程已退出，租约过期",
+                "payload": None,
+                "updated_at": datetime.utcnow()
+            })
+            expired += 1
+        if expired:
+            logger.warning(f"已将 {expired} 个租约过期的任务标记为失败")
+        return expired
+
+    @asynccontextmanager
+    async def lease(self, task_id: str) -> AsyncIterator[None]:
+        """执行任务期间定期刷新租约"""
+        interval = max(self.lease_duration.total_seconds() / 3, 1)
+
+        async def beat():
+            while True:
+                try:
+                    await self.heartbeat(task_id)
+                except Exception as e:
+                    logger.warning(f"刷新任务 {task_id} 租约失败: {str(e)}")
+                await asyncio.sleep(interval)
+
+        beater = asyncio.create_task(beat())
+        try:
+            yield
+        finally:
+            beater.cancel()
+            await asyncio.gather(beater, return_exceptions=True)
+
+    def _is_stale(self, task: Dict[str, Any], now: datetime) -> bool:
+        """任务的租约是否已过期（旧任务没有claimed_at时按updated_at判断）"""
+        last_seen = task.get("claimed_at") or task.get("updated_at")
+        return isinstance(last_seen, datetime) and last_seen < now - self.lease_duration
+
+    @staticmethod
+    def _reclaimable(task: Dict[str, Any]) -> bool:
+        return (task.get("status") == "processing" and bool(task.get("payload"))
+                and task.get("claim_count", 1) < REVIEW_TASK_MAX_CLAIMS)
+
+    async def count_pending(self) -> int:
+        """统计排队中的任务数量"""
+        raise NotImplementedError
+
+    async def get_queue_position(self, task: Dict[str, Any]) -> Optional[int]:
+        """计算待处理任务的排队位置（从1开始），非pending任务返回None"""
+        raise NotImplementedError
+
+    async def append_event(self, task_id: str, event_type: str, data: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        """
+        追加任务事件
+
+        Returns:
+            Optional[int]: 事件序号（同一任务内单调递增），任务不存在时返回None
+        """
+        raise NotImplementedError
+
+    async def get_events(self, task_id: str, after: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        """按序号获取seq大于after的事件，每个事件包含 seq/type/data/created_at"""
+        raise NotImplementedError
+
+    async def _emit_status(self, task_id: str, fields: Dict[str, Any]) -> None:
+        """状态变更时记录status事件，事件写入失败不影响任务本身"""
+        if not fields.get("status"):
+            return
+        data = {"status": fields["status"]}
+        if fields.get("error"):
+            data["error"] = fields["error"]
+        try:
+            await self.append_event(task_id, "status", data)
+        except Exception as e:
+            logger.warning(f"记录任务 {task_id} 状态事件失败: {str(e)}")
+
+    def _with_expiry(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """任务进入结束状态时补充过期时间"""
+        if fields.get("status") in FINISHED_STATUSES and "expires_at" not in fields:
+            fields = {**fields, "expires_at": datetime.utcnow() + self.ttl}
+        return fields
+
+    async def migrate_from_pickle(self, path: str = LEGACY_TASK_STORE_FILE) -> int:
+        """
+        从旧版pickle文件迁移任务
+
+        迁移成功后文件被重命名为 *.migrated，多个worker同时启动时只有一个会真正执行迁移。
+
+        Returns:
+            int: 迁移的任务数量
+        """
+        migrating_path = f"{path}.migrating"
+        try:
+            os.rename(path, migrating_path)
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            logger.error(f"无法锁定旧任务存储文件 {path}: {str(e)}")
+            return 0
+
+        try:
+            with open(migrating_path, "rb") as f:
+                legacy_tasks = pickle.load(f)
+        except Exception as e:
+            logger.error(f"读取旧任务存储文件失败: {str(e)}")
+            os.rename(migrating_path, path)
+            return 0
+
+        migrated = 0
+        for task_id, task in (legacy_tasks or {}).items():
+            if await self.insert_if_absent(task_id, self._with_expiry(dict(task))):
+                migrated += 1
+
+        os.rename(migrating_path, f"{path}.migrated")
+        logger.info(f"已从 {path} 迁移 {migrated} 个任务")
+        return migrated
+
+
+class MongoTaskStore(BaseTaskStore):
+    """基于MongoDB的任务存储，_id即task_id，过期由TTL索引负责清理"""
+
+    def __init__(self, collection, events_collection, ttl_hours: float = TASK_STORE_TTL_HOURS):
+        super().__init__(ttl_hours)
+        self.collection = collection
+        self.events_collection = events_collection
+        self._feed_task: Optional[asyncio.Task] = None
+
+    def start_event_feed(self) -> None:
+        if self._feed_task is None or self._feed_task.done():
+            self._feed_task = asyncio.create_task(self._watch_events())
+
+    async def close_event_feed(self) -> None:
+        if self._feed_task is not None:
+            self._feed_task.cancel()
+            await asyncio.gather(self._feed_task, return_exceptions=True)
+            self._feed_task = None
+
+    async def _watch_events(self) -> None:
+        """用一个change stream接收所有进程写入的任务事件，只在有连接等待该任务时唤醒"""
+        pipeline = [
+            {"$match": {"operationType": "insert"}},
+            {"$project": {"fullDocument.task_id": 1}},
+        ]
+        while True:
+            try:
+                async with self.events_collection.watch(pipeline) as stream:
+                    logger.info("任务事件change stream已启动")
+                    async for change in stream:
+                        task_id = (change.get("fullDocument") or {}).get("task_id")
+                        if task_id:
+                            self.hub.notify(task_id)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # 单机MongoDB不支持change stream，只依赖进程内通知与回退轮询
+                logger.info(f"任务事件change stream不可用，使用轮询: {str(e)}")
+                return
+            except Exception as e:
+                logger.warning(f"任务事件change stream中断，稍后重连: {str(e)}")
+                await asyncio.sleep(REVIEW_EVENTS_POLL_INTERVAL)
+
+    async def init(self) -> None:
+        # expireAfterSeconds=0 表示在 expires_at 时间点过期
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        # 领取任务与计算排队位置使用的索引
+        await self.collection.create_index([("status", 1), ("created_at", 1)])
+        await self.events_collection.create_index([("task_id", 1), ("seq", 1)], unique=True)
+        await self.events_collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def create_task(self, task_id: str, task: Dict[str, Any]) -> None:
+        await self.collection.insert_one({"_id": task_id, **self._with_expiry(task)})
+        await self._emit_status(task_id, task)
+
+    async def update_task(self, task_id: str, fields: Dict[str, Any]) -> bool:
+        result = await self.collection.update_one(
+            {"_id": task_id},
+            {"$set": self._with_expiry(fields)}
+        )
+        if result.matched_count > 0:
+            await self._emit_status(task_id, fields)
+        return result.matched_count > 0
+
+    async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        doc = await self.collection.find_one({"_id": task_id})
+        if not doc:
+            return None
+        # TTL后台任务约每60秒运行一次，读取时再校验一次
+        if doc.get("expires_at") and doc["expires_at"] < datetime.utcnow():
+            return None
+        doc.pop("_id", None)
+        return doc
+
+    async def purge_expired(self) -> int:
+        now = datetime.utcnow()
+        await self.events_collection.delete_many({"expires_at": {"$lt": now}})
+        result = await self.collection.delete_many({"expires_at": {"$lt": now}})
+        return result.deleted_count
+
+    async def insert_if_absent(self, task_id: str, task: Dict[str, Any]) -> bool:
+        result = await self.collection.update_one(
+            {"_id": task_id},
+            {"$setOnInsert": task},
+            upsert=True
+        )
+        return result.upserted_id is not None
+
+    def _lease_expired_query(self, now: datetime) -> Dict[str, Any]:
+        cutoff = now - self.lease_duration
+        return {"$or": [
+            {"claimed_at": {"$lt": cutoff}},
+            {"claimed_at": {"$exists": False}, "updated_at": {"$lt": cutoff}},
+        ]}
+
+    async def claim_next_task(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        reclaimable = {
+            **self._lease_expired_query(now),
+            "status": "processing",
+            "payload": {"$ne": None},
+            "claim_count": {"$not": {"$gte": REVIEW_TASK_MAX_CLAIMS}}
+        }
+        doc = await self.collection.find_one_and_update(
+            {"$or": [{"status": "pending", "payload": {"$ne": None}}, reclaimable]},
+            {
+                "$set": {"status": "processing", "worker_id": worker_id, "claimed_at": now, "updated_at": now},
+                "$inc": {"claim_count": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return None
+        doc["task_id"] = doc.pop("_id")
+        await self._emit_status(doc["task_id"], {"status": "processing"})
+        return doc
+
+    async def heartbeat(self, task_id: str) -> None:
+        await self.collection.update_one(
+            {"_id": task_id, "status": {"$nin": list(FINISHED_STATUSES)}},
+            {"$set": {"claimed_at": datetime.utcnow()}}
+        )
+
+    async def find_stale_tasks(self) -> List[str]:
+        query = {"$and": [
+            self._lease_expired_query(datetime.utcnow()),
+            {"$or": [
+                {"status": {"$in": ["pending", "processing"]}, "payload": None},
+                {"status": "processing", "claim_count": {"$gte": REVIEW_TASK_MAX_CLAIMS}}
+            ]}
+        ]}
+        docs = await self.collection.find(query, {"_id": 1}).to_list(length=None)
+        return [doc["_id"] for doc in docs]
+
+    async def count_pending(self) -> int:
+        return await self.collection.count_documents({"status": "pending"})
+
+    async def get_queue_position(self, task: Dict[str, Any]) -> Optional[int]:
+        if task.get("status") != "pending":
+            return None
+        ahead = await self.collection.count_documents({
+            "status": "pending",
+            "created_at": {"$lt": task["created_at"]}
+        })
+        return ahead + 1
+
+    async def append_event(self, task_id: str, event_type: str, data: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        # 序号计数器保存在任务文档上，保证同一任务的事件在多个进程间有序
+        doc = await self.collection.find_one_and_update(
+            {"_id": task_id},
+            {"$inc": {"event_seq": 1}},
+            projection={"event_seq": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return None
+        now = datetime.utcnow()
+        await self.events_collection.insert_one({
+            "task_id": task_id,
+            "seq": doc["event_seq"],
+            "type": event_type,
+            "data": data or {},
+            "created_at": now,
+            "expires_at": now + self.ttl
+        })
+        self.hub.notify(task_id)
+        return doc["event_seq"]
+
+    async def get_events(self, task_id: str, after: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        cursor = self.events_collection.find(
+            {"task_id": task_id, "seq": {"$gt": after}},
+            projection={"_id": 0, "seq": 1, "type": 1, "data": 1, "created_at": 1}
+        ).sort("seq", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+
+class SQLiteTaskStore(BaseTaskStore):
+    """基于SQLite的任务存储，单行JSON + 主键索引，WAL模式支持多进程读写"""
+
+    def __init__(self, path: str = TASK_STORE_SQLITE_PATH, ttl_hours: float = TASK_STORE_TTL_HOURS):
+        super().__init__(ttl_hours)
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        """在线程池中串行执行SQLite操作，避免阻塞事件循环"""
+        def call():
+            with self._lock:
+                return fn(self._connect(), *args)
+        return await asyncio.to_thread(call)
+
+    @staticmethod
+    def _dumps(task: Dict[str, Any]) -> str:
+        data = dict(task)
+        for key in DATETIME_FIELDS:
+            if isinstance(data.get(key), datetime):
+                data[key] = data[key].isoformat()
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def _loads(raw: str) -> Dict[str, Any]:
+        data = json.loads(raw)
+        for key in DATETIME_FIELDS:
+            if isinstance(data.get(key), str):
+                data[key] = datetime.fromisoformat(data[key])
+        return data
+
+    @staticmethod
+    def _ts(task: Dict[str, Any], key: str) -> Optional[float]:
+        value = task.get(key)
+        return value.timestamp() if isinstance(value, datetime) else None
+
+    def _row(self, task_id: str, task: Dict[str, Any]) -> tuple:
+        """构造与 (task_id, status, created_at, expires_at, data) 列对应的参数"""
+        return (task_id, task.get("status"), self._ts(task, "created_at"), self._ts(task, "expires_at"), self._dumps(task))
+
+    async def init(self) -> None:
+        def create(conn):
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS review_tasks ("
+                "task_id TEXT PRIMARY KEY, status TEXT, created_at REAL, expires_at REAL, data TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_review_tasks_expires_at ON review_tasks(expires_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_review_tasks_status_created ON review_tasks(status, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS review_task_events ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL, type TEXT NOT NULL, "
+                "data TEXT, created_at REAL, expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_review_task_events_task_seq ON review_task_events(task_id, seq)")
+        await self._run(create)
+
+    async def create_task(self, task_id: str, task: Dict[str, Any]) -> None:
+        task = self._with_expiry(task)
+
+        def insert(conn):
+            conn.execute(
+                "INSERT INTO review_tasks (task_id, status, created_at, expires_at, data) VALUES (?, ?, ?, ?, ?)",
+                self._row(task_id, task)
+            )
+        await self._run(insert)
+        await self._emit_status(task_id, task)
+
+    async def update_task(self, task_id: str, fields: Dict[str, Any]) -> bool:
+        fields = self._with_expiry(fields)
+
+        def update(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT data FROM review_tasks WHERE task_id = ?", (task_id,)).fetchone()
+                if row is None:
+                    conn.execute("ROLLBACK")
+                    return False
+                task = {**self._loads(row[0]), **fields}
+                self._write(conn, task_id, task)
+                conn.execute("COMMIT")
+                return True
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        updated = await self._run(update)
+        if updated:
+            await self._emit_status(task_id, fields)
+        return updated
+
+    async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        def select(conn):
+            return conn.execute(
+                "SELECT data FROM review_tasks WHERE task_id = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (task_id, datetime.utcnow().timestamp())
+            ).fetchone()
+        row = await self._run(select)
+        return self._loads(row[0]) if row else None
+
+    async def purge_expired(self) -> int:
+        def delete(conn):
+            now = datetime.utcnow().timestamp()
+            conn.execute("DELETE FROM review_task_events WHERE expires_at < ?", (now,))
+            return conn.execute("DELETE FROM review_tasks WHERE expires_at < ?", (now,)).rowcount
+        return await self._run(delete)
+
+    async def insert_if_absent(self, task_id: str, task: Dict[str, Any]) -> bool:
+        def insert(conn):
+            return conn.execute(
+                "INSERT OR IGNORE INTO review_tasks (task_id, status, created_at, expires_at, data) VALUES (?, ?, ?, ?, ?)",
+                self._row(task_id, task)
+            ).rowcount
+        return await self._run(insert) > 0
+
+    def _write(self, conn: sqlite3.Connection, task_id: str, task: Dict[str, Any]) -> None:
+        _, status, created_at, expires_at, data = self._row(task_id, task)
+        conn.execute(
+            "UPDATE review_tasks SET status = ?, created_at = ?, expires_at = ?, data = ? WHERE task_id = ?",
+            (status, created_at, expires_at, data, task_id)
+        )
+
+    def _stale_rows(self, conn: sqlite3.Connection, now: datetime) -> List[tuple]:
+        """
+        租约已过期的任务 (task_id, 任务数据)：processing任务，以及没有payload的pending任务（inline模式），
+        这类任务数量很少，在Python中过滤
+        """
+        rows = conn.execute(
+            "SELECT task_id, data FROM review_tasks WHERE status = 'processing' "
+            "OR (status = 'pending' AND json_extract(data, '$.payload') IS NULL) ORDER BY created_at"
+        ).fetchall()
+        return [(task_id, task) for task_id, task in ((r[0], self._loads(r[1])) for r in rows) if self._is_stale(task, now)]
+
+    async def claim_next_task(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        def claim(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = datetime.utcnow()
+                row = conn.execute(
+                    "SELECT task_id, data FROM review_tasks WHERE status = 'pending' "
+                    "AND json_extract(data, '$.payload') IS NOT NULL ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    candidate = (row[0], self._loads(row[1]))
+                else:
+                    candidate = next(((task_id, task) for task_id, task in self._stale_rows(conn, now)
+                                      if self._reclaimable(task)), None)
+                if candidate is None:
+                    conn.execute("COMMIT")
+                    return None
+                task_id, task = candidate
+                task = {
+                    **task,
+                    "status": "processing", "worker_id": worker_id, "claimed_at": now, "updated_at": now,
+                    "claim_count": task.get("claim_count", 0) + 1
+                }
+                self._write(conn, task_id, task)
+                conn.execute("COMMIT")
+                return {**task, "task_id": task_id}
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        task = await self._run(claim)
+        if task:
+            await self._emit_status(task["task_id"], {"status": "processing"})
+        return task
+
+    async def heartbeat(self, task_id: str) -> None:
+        def beat(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT data FROM review_tasks WHERE task_id = ?", (task_id,)).fetchone()
+                if row is not None:
+                    task = self._loads(row[0])
+                    if task.get("status") not in FINISHED_STATUSES:
+                        self._write(conn, task_id, {**task, "claimed_at": datetime.utcnow()})
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        await self._run(beat)
+
+    async def find_stale_tasks(self) -> List[str]:
+        def select(conn):
+            return [
+                task_id for task_id, task in self._stale_rows(conn, datetime.utcnow())
+                if not self._reclaimable(task)
+            ]
+        return await self._run(select)
+
+    async def count_pending(self) -> int:
+        def count(conn):
+            return conn.execute("SELECT COUNT(*) FROM review_tasks WHERE status = 'pending'").fetchone()[0]
+        return await self._run(count)
+
+    async def get_queue_position(self, task: Dict[str, Any]) -> Optional[int]:
+        if task.get("status") != "pending":
+            return None
+
+        def count(conn):
+            return conn.execute(
+                "SELECT COUNT(*) FROM review_tasks WHERE status = 'pending' AND created_at < ?",
+                (self._ts(task, "created_at"),)
+            ).fetchone()[0]
+        return await self._run(count) + 1
+
+    async def append_event(self, task_id: str, event_type: str, data: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        def insert(conn):
+            if conn.execute("SELECT 1 FROM review_tasks WHERE task_id = ?", (task_id,)).fetchone() is None:
+                return None
+            now = datetime.utcnow()
+            return conn.execute(
+                "INSERT INTO review_task_events (task_id, type, data, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (task_id, event_type, json.dumps(data or {}, ensure_ascii=False, default=str),
+                 now.timestamp(), (now + self.ttl).timestamp())
+            ).lastrowid
+        seq = await self._run(insert)
+        if seq is not None:
+            self.hub.notify(task_id)
+        return seq
+
+    async def get_events(self, task_id: str, after: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        def select(conn):
+            return conn.execute(
+                "SELECT seq, type, data, created_at FROM review_task_events "
+                "WHERE task_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (task_id, after, limit)
+            ).fetchall()
+        rows = await self._run(select)
+        return [
+            {"seq": seq, "type": event_type, "data": json.loads(data or "{}"), "created_at": datetime.utcfromtimestamp(created_at)}
+            for seq, event_type, data, created_at in rows
+        ]
+
+
+def create_task_store(backend: str = TASK_STORE_BACKEND) -> BaseTaskStore:
+    """根据配置创建任务存储实例"""
+    if backend == "sqlite":
+        return SQLiteTaskStore()
+    if backend != "mongo":
+        logger.warning(f"未知的任务存储后端 {backend}，使用mongo")
+    return MongoTaskStore(get_collection("review_tasks"), get_collection("review_task_events"))
+
+
+# 创建全局实例
+task_store = create_task_store()
@@ -0,0 +1,402 @@
+"""
+审查完成回调（Webhook）服务模块
+
+异步审查任务结束后，向提交任务时登记的回调地址POST审查结果，
+CI无需占用runner轮询 /status。
+
+- 请求体为JSON，使用提交时提供的密钥做HMAC-SHA256签名：
+  X-CodeReview-Signature: sha256=<hex(HMAC(secret, "<timestamp>." + body))>
+  X-CodeReview-Timestamp: <unix秒>
+- 回调先写入 webhook_deliveries 队列（请求体和加密的密钥随记录保存），由API进程中的
+  投递循环异步发送，不占用审查任务的并发名额；进程重启后未完成的投递会继续
+- 网络错误、超时、5xx、408和429会按指数退避重试，其余4xx视为永久失败；
+  同一投递的每次尝试使用相同的 X-CodeReview-Delivery，接收方可据此去重
+- 回调地址解析出的IP必须全部是公网地址（拒绝回环、私有、链路本地、保留地址），
+  提交时和每次连接前各检查一次，连接直接使用检查过的IP，防止DNS重绑定
+- 投递结束的记录在 WEBHOOK_DELIVERY_RETENTION_DAYS 天后由TTL索引清理
+"""
+
+import os
+import hmac
+import json
+import uuid
+import time
+import random
+import socket
+import asyncio
+import hashlib
+import logging
+import ipaddress
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+import httpx
+from pymongo import ReturnDocument
+
+from app.utils.database import get_collection
+from app.utils.encryption import token_encryption
+
+logger = logging.getLogger(__name__)
+
+# 单次投递的最大尝试次数
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+# 退避基数与上限（秒）：第n次重试前等待 min(上限, 基数 * 2^(n-1))，并加入随机抖动
+WEBHOOK_BACKOFF_BASE_SECONDS = float(os.getenv("WEBHOOK_BACKOFF_BASE_SECONDS", "2"))
+WEBHOOK_BACKOFF_MAX_SECONDS = float(os.getenv("WEBHOOK_BACKOFF_MAX_SECONDS", "60"))
+# 单次请求超时（秒）
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "10"))
+# 投递循环同时进行的投递数量
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "8"))
+# 队列为空时的轮询间隔（秒）；同一进程内入队会立即唤醒投递循环
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))
+# 领取投递后的租约（秒），进程在投递中途退出时，租约过期后由其他进程重新领取
+WEBHOOK_LEASE_SECONDS = float(os.getenv("WEBHOOK_LEASE_SECONDS", "120"))
+# 投递结束后记录的保留天数
+WEBHOOK_DELIVERY_RETENTION_DAYS = int(os.getenv("WEBHOOK_DELIVERY_RETENTION_DAYS", "14"))
+# 是否允许回调到内网地址（仅用于本地联调）
+WEBHOOK_ALLOW_PRIVATE_TARGETS = os.getenv("WEBHOOK_ALLOW_PRIVATE_TARGETS", "false").lower() in ("1", "true", "yes")
+
+SIGNATURE_HEADER = "X-CodeReview-Signature"
+TIMESTAMP_HEADER = "X-CodeReview-Timestamp"
+DELIVERY_HEADER = "X-CodeReview-Delivery"
+EVENT_HEADER = "X-CodeReview-Event"
+
+# 这些状态码表示服务端暂时不可用，可以重试
+RETRYABLE_STATUS_CODES = {408, 429}
+
+# 不会解析到公网地址的主机名
+BLOCKED_HOSTNAMES = {"localhost", "localhost.localdomain", "metadata.google.internal"}
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    """计算回调请求签名，接收方用同样的方式校验"""
+    digest = hmac.new(secret.encode("utf-8"), timestamp.encode("ascii") + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str) -> bool:
+    """校验回调请求签名（供接收方参考使用）"""
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature or "")
+
+
+def is_public_address(address: str) -> bool:
+    """是否为可以回调的公网IP（IPv4映射的IPv6地址按IPv4判断）"""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_callback_url(url: str) -> httpx.URL:
+    """
+    不做DNS解析的回调地址检查（协议、主机名、IP字面量）
+
+    Raises:
+        ValueError: 地址不可用作回调
+    """
+    parsed = httpx.URL(url)
+    if parsed.scheme not in ("http", "https"):
+        raise ValueError("callback_url必须是http或https地址")
+    host = (parsed.host or "").rstrip(".").lower()
+    if not host:
+        raise ValueError("callback_url缺少主机名")
+    if parsed.userinfo:
+        raise ValueError("callback_url不能包含用户名或密码")
+    if WEBHOOK_ALLOW_PRIVATE_TARGETS:
+        return parsed
+    if host in BLOCKED_HOSTNAMES or host.endswith(".localhost") or host.endswith(".internal"):
+        raise ValueError("callback_url不能指向内网地址")
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        # 不是IP字面量，交给DNS解析后检查
+        return parsed
+    if not is_public_address(host):
+        raise ValueError("callback_url不能指向内网地址")
+    return parsed
+
+
+async def resolve_callback_target(url: str) -> Tuple[httpx.URL, str]:
+    """
+    解析回调地址并检查解析出的全部IP
+
+    Returns:
+        Tuple: (解析后的URL, 用于连接的IP)
+
+    Raises:
+        ValueError: 地址不可用作回调或无法解析
+    """
+    parsed = check_callback_url(url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parsed.host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"callback_url主机名无法解析: {str(e)}")
+    addresses = [info[4][0] for info in infos]
+    if not addresses:
+        raise ValueError("callback_url主机名无法解析")
+    if not WEBHOOK_ALLOW_PRIVATE_TARGETS and not all(is_public_address(address) for address in addresses):
+        raise ValueError("callback_url不能指向内网地址")
+    return parsed, addresses[0]
+
+
+class WebhookService:
+    """审查结果回调投递服务"""
+
+    def __init__(
+        self,
+        collection,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+        backoff_base: float = WEBHOOK_BACKOFF_BASE_SECONDS,
+        backoff_max: float = WEBHOOK_BACKOFF_MAX_SECONDS,
+        timeout: float = WEBHOOK_TIMEOUT_SECONDS,
+        concurrency: int = WEBHOOK_CONCURRENCY
+    ):
+        """
+        Args:
+            collection: 投递队列与日志集合
+            transport: 可注入的httpx传输层（本地联调时可替换为MockTransport）
+        """
+        self.collection = collection
+        self.transport = transport
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+    def _http_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                transport=self.transport,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency * 2, max_keepalive_connections=self.concurrency),
+                follow_redirects=False
+            )
+        return self._client
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """计算第attempt次失败后的等待时间，服务端给出Retry-After时优先使用"""
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def enqueue(
+        self,
+        task_id: str,
+        url: str,
+        encrypted_secret: Optional[str],
+        event: str,
+        payload: Dict[str, Any]
+    ) -> str:
+        """
+        登记一次回调投递，由投递循环异步发送
+
+        Args:
+            task_id: 任务ID
+            url: 回调地址
+            encrypted_secret: 加密后的HMAC签名密钥，为空时不签名
+            event: 事件名称，如 review.completed
+            payload: 回调内容
+
+        Returns:
+            str: 投递ID
+        """
+        delivery_id = str(uuid.uuid4())
+        body = json.dumps(payload, ensure_ascii=False, default=str)
+        now = datetime.utcnow()
+        await self.collection.insert_one({
+            "_id": delivery_id,
+            "task_id": task_id,
+            "url": url,
+            "event": event,
+            "status": "pending",
+            "body": body,
+            "secret": encrypted_secret or "",
+            "payload_sha256": hashlib.sha256(body.encode("utf-8")).hexdigest(),
+            "payload_size": len(body.encode("utf-8")),
+            "attempts": [],
+            "attempt_count": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now
+        })
+        self._wakeup.set()
+        return delivery_id
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        """领取一条到期的投递（包括租约已过期的投递中记录）"""
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "delivering", "lease_until": {"$lt": now}},
+            ]},
+            {"$set": {
+                "status": "delivering",
+                "lease_until": now + timedelta(seconds=WEBHOOK_LEASE_SECONDS),
+                "updated_at": now
+            }},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _post(self, url: str, body: bytes, headers: Dict[str, str]) -> httpx.Response:
+        """连接到检查过的IP发送请求，Host头和TLS的SNI/证书校验仍使用原主机名"""
+        parsed, address = await resolve_callback_target(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        host = f"[{address}]" if ":" in address else address
+        target = f"{parsed.scheme}://{host}:{port}{parsed.raw_path.decode('ascii')}"
+        headers = {**headers, "Host": parsed.host if parsed.port is None else f"{parsed.host}:{parsed.port}"}
+        extensions = {"sni_hostname": parsed.host} if parsed.scheme == "https" else {}
+        return await self._http_client().post(target, content=body, headers=headers, extensions=extensions)
+
+    async def _attempt(self, delivery: Dict[str, Any]) -> None:
+        """对一条投递进行一次尝试，并按结果结束或安排重试"""
+        delivery_id = delivery["_id"]
+        task_id = delivery.get("task_id")
+        attempt = delivery.get("attempt_count", 0) + 1
+        body = (delivery.get("body") or "").encode("utf-8")
+
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            EVENT_HEADER: delivery.get("event", ""),
+            DELIVERY_HEADER: delivery_id,
+            TIMESTAMP_HEADER: timestamp
+        }
+
+        started = time.monotonic()
+        status_code: Optional[int] = None
+        error: Optional[str] = None
+        retry_after: Optional[str] = None
+        permanent = False
+        try:
+            secret = token_encryption.decrypt_token(delivery.get("secret") or "")
+        except Exception:
+            secret = None
+            error = "回调密钥无法解密"
+            permanent = True
+        if secret is not None:
+            if secret:
+                headers[SIGNATURE_HEADER] = sign_payload(secret, timestamp, body)
+            try:
+                response = await self._post(delivery["url"], body, headers)
+                status_code = response.status_code
+                retry_after = response.headers.get("Retry-After")
+            except ValueError as e:
+                # 地址不可用（内网地址、无法解析等），重试也不会成功
+                error = str(e)
+                permanent = True
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {str(e)}"
+
+        delivered = status_code is not None and 200 <= status_code < 300
+        retryable = not delivered and not permanent and (
+            status_code is None or status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+        )
+        final = delivered or not retryable or attempt >= self.max_attempts
+
+        now = datetime.utcnow()
+        record = {
+            "attempt": attempt,
+            "status_code": status_code,
+            "error": error,
+            "duration_ms": int((time.monotonic() - started) * 1000),
+            "at": now
+        }
+        update: Dict[str, Any] = {
+            "$push": {"attempts": record},
+            "$set": {"attempt_count": attempt, "updated_at": now},
+            "$unset": {"lease_until": ""}
+        }
+        if final:
+            update["$set"]["status"] = "delivered" if delivered else "failed"
+            update["$set"]["expires_at"] = now + timedelta(days=WEBHOOK_DELIVERY_RETENTION_DAYS)
+            # 投递结束后不再需要请求体和密钥
+            update["$unset"].update({"body": "", "secret": "", "next_attempt_at": ""})
+        else:
+            delay = self._backoff(attempt, retry_after)
+            update["$set"]["status"] = "pending"
+            update["$set"]["next_attempt_at"] = now + timedelta(seconds=delay)
+            logger.warning(f"任务 {task_id} 回调第{attempt}次投递失败（status={status_code}, error={error}），{delay:.1f}秒后重试")
+        await self.collection.update_one({"_id": delivery_id}, update)
+
+        if delivered:
+            logger.info(f"任务 {task_id} 回调投递成功（第{attempt}次尝试）")
+        elif final:
+            logger.error(f"任务 {task_id} 回调投递失败: status={status_code}, error={error}")
+
+    async def _run_one(self, delivery: Dict[str, Any], semaphore: asyncio.Semaphore) -> None:
+        try:
+            await self._attempt(delivery)
+        except Exception as e:
+            # 记录未能更新时租约过期后会重新投递
+            logger.error(f"回调投递 {delivery.get('_id')} 处理异常: {str(e)}")
+        finally:
+            semaphore.release()
+
+    async def run(self) -> None:
+        """投递循环：持续领取到期的投递并发送，直到 close 被调用"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while not self._stopping.is_set():
+            await semaphore.acquire()
+            if self._stopping.is_set():
+                semaphore.release()
+                break
+            try:
+                delivery = await self._claim()
+            except Exception as e:
+                logger.error(f"领取回调投递失败: {str(e)}")
+                delivery = None
+
+            if delivery is None:
+                semaphore.release()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=WEBHOOK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job = asyncio.create_task(self._run_one(delivery, semaphore))
+            self._inflight.add(job)
+            job.add_done_callback(self._inflight.discard)
+
+    def start(self) -> None:
+        """在当前事件循环中启动投递循环（应用启动时调用）"""
+        if self._loop_task is None or self._loop_task.done():
+            self._stopping.clear()
+            self._loop_task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """停止投递循环并关闭连接池（应用关闭时调用），未完成的投递由租约机制在重启后继续"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._loop_task is not None:
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        if self._inflight:
+            await asyncio.wait(set(self._inflight), timeout=self.timeout)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def list_deliveries(self, task_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """获取任务的回调投递记录（最新在前）"""
+        cursor = self.collection.find({"task_id": task_id}, {"body": 0, "secret": 0}).sort("created_at", -1).limit(limit)
+        deliveries = await cursor.to_list(length=limit)
+        for delivery in deliveries:
+            delivery["delivery_id"] = delivery.pop("_id")
+        return deliveries
+
+
+# 创建全局实例
+webhook_service = WebhookService(get_collection("webhook_deliveries"))
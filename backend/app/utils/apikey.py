@@ -1,5 +1,8 @@
 from fastapi import Depends, HTTPException, status, Request
 from app.services.apikey import apikey_service
+from app.utils.cache import principal_cache
+from datetime import datetime
+import hashlib
 
 import logging
 
@@ -20,9 +23,16 @@ async def require_api_key(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # 优先使用缓存的认证结果，避免轮询请求重复查询数据库
+    cache_key = "apikey:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    username = principal_cache.get(cache_key)
+    if username:
+        return username
+
     # 验证API密钥
     logger.info(f"API密钥验证: 验证API密钥 - {api_key[:20]}...")
-    username = await apikey_service.validate_api_key(api_key)
+    apikey_doc = await apikey_service.authenticate_api_key(api_key)
+    username = apikey_doc["username"] if apikey_doc else None
     if not username:
         logger.error(f"API密钥验证: 无效的API密钥 - {api_key[:20]}...")
         raise HTTPException(
@@ -31,5 +41,11 @@ async def require_api_key(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # 缓存时间不超过密钥的过期时间；撤销/删除密钥时按标签失效
+    ttl = None
+    if apikey_doc.get("expires_at"):
+        ttl = (apikey_doc["expires_at"] - datetime.utcnow()).total_seconds()
+    principal_cache.set(cache_key, username, ttl=ttl, tags=[f"apikey:{apikey_doc['_id']}"])
+
     logger.info(f"API密钥验证成功: {username}")
     return username
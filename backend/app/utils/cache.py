@@ -0,0 +1,129 @@
+"""
+进程内缓存工具模块
+
+提供有容量上限的LRU + TTL缓存，支持按标签批量失效和命中率统计。
+容量可以同时按条目数和条目权重之和（如估算的字节数/token数）限制。
+缓存只在当前进程内有效，多进程部署时各进程的失效互不可见，
+因此TTL应设置为可以接受的最大数据陈旧时间。
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+
+
+class TTLCache:
+    """有容量上限的LRU + TTL缓存"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, maxweight: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # 条目权重之和的上限，None表示只按条目数限制
+        self.maxweight = maxweight
+        self.weight = 0.0
+        # key -> (过期时间戳, 值, 标签集合, 权重)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # 标签 -> key集合，用于按标签批量失效
+        self._tags: Dict[str, Set[Hashable]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """获取缓存值，未命中或已过期返回None"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(
+        self, key: Hashable, value: Any, ttl: Optional[float] = None, tags: Iterable[str] = (), weight: float = 1
+    ) -> None:
+        """
+        写入缓存
+
+        Args:
+            key: 缓存键
+            value: 缓存值
+            ttl: 该条目的存活时间（秒），不超过缓存默认TTL
+            tags: 条目所属标签，可通过 invalidate_tag 批量失效
+            weight: 条目权重，计入 maxweight；超过 maxweight 的条目不缓存
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if key in self._data:
+            self._remove(key)
+        if ttl <= 0 or (self.maxweight is not None and weight > self.maxweight):
+            return
+        tag_set = set(tags)
+        self._data[key] = (time.monotonic() + ttl, value, tag_set, weight)
+        self.weight += weight
+        for tag in tag_set:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+            oldest_key = next(iter(self._data))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """使单个条目失效"""
+        if key in self._data:
+            self._remove(key)
+
+    def invalidate_tag(self, tag: str) -> int:
+        """使某个标签下的所有条目失效，返回失效数量"""
+        keys = self._tags.pop(tag, set())
+        for key in keys:
+            if key in self._data:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._tags.clear()
+        self.weight = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        """命中率统计"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "maxweight": self.maxweight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags, weight = self._data.pop(key)
+        self.weight -= weight
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+# 已认证主体（API密钥/Bearer令牌 -> 用户名）缓存
+principal_cache = TTLCache(
+    maxsize=int(os.getenv("PRINCIPAL_CACHE_MAXSIZE", "10000")),
+    ttl=float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60")),
+)
+
+# 用户审查总数缓存（列表分页的total），新建审查时按用户失效
+review_count_cache = TTLCache(
+    maxsize=int(os.getenv("REVIEW_COUNT_CACHE_MAXSIZE", "10000")),
+    ttl=float(os.getenv("REVIEW_COUNT_CACHE_TTL_SECONDS", "300")),
+)
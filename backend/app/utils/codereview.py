@@ -363,3 +363,80 @@ def build_ai_chat_message(final_ai_output, diff_text, pr_title, pr_body) -> str:
 
 现在，请基于以上信息开始您的专业代码审查分析。
 """
+
+
+def build_ai_chat_prefix(pr_title, pr_body, diff_overview, issue_digest) -> str:
+    """
+    构建智能助手的静态系统提示
+
+    同一审查（内容不变时）每一轮对话生成的提示逐字节相同，作为第一条消息发送，
+    使模型服务商的前缀缓存可以命中。这里不能加入当前问题、时间等随轮次变化的内容，
+    这些内容由 build_ai_chat_context 生成并放在其后。
+
+    Args:
+        pr_title: Pull Request的标题
+        pr_body: Pull Request的描述内容
+        diff_overview: 变更文件概览（每个文件的增删行数）
+        issue_digest: 精简后的审查问题列表
+
+    Returns:
+        str: 静态系统提示词
+    """
+    safe_title = pr_title or "未命名Pull Request"
+    safe_body = pr_body or "无描述内容"
+    safe_overview = diff_overview or "暂无代码差异"
+    safe_issues = issue_digest or "暂无审查结果"
+
+    return f"""
+## 🎯 代码审查助手 - 系统提示
+
+### 🤖 角色定义
+你是一位专业的**高级代码审查工程师**，具备以下核心能力：
+- 精通多种编程语言和开发框架
+- 深度理解软件工程最佳实践
+- 具备丰富的安全、性能和代码质量分析经验
+- 能够提供建设性的代码改进建议
+
+### 📋 当前任务
+你正在协助审查一个Pull Request。请基于以下信息进行全面分析：
+
+### 📊 审查上下文
+**📌 PR信息**
+- **标题**: {safe_title}
+- **描述**: 
+```
+{safe_body}
+```
+
+**🗂️ 变更文件概览**
+```
+{safe_overview}
+```
+
+**📈 AI审查发现的问题**
+{safe_issues}
+"""
+
+
+def build_ai_chat_context(relevant_diff, conversation_summary) -> str:
+    """
+    构建智能助手每一轮的动态上下文（放在静态系统提示之后）
+
+    Args:
+        relevant_diff: 与当前问题相关的代码变更块
+        conversation_summary: 之前对话的滚动摘要
+
+    Returns:
+        str: 动态上下文提示词
+    """
+    parts = []
+    if relevant_diff:
+        parts.append(f"""
+**🔍 与当前问题相关的代码变更**
+```diff
+{relevant_diff}
+```
+""")
+    if conversation_summary:
+        parts.append(f"\n### 🗂️ 之前的对话摘要\n{conversation_summary}\n")
+    return "".join(parts)
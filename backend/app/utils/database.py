@@ -1,5 +1,6 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import os
 
 # 加载环境变量
@@ -8,6 +9,8 @@ load_dotenv()
 # MongoDB Atlas 连接配置
 MONGODB_URI = os.getenv("MONGODB_URI")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
+# 是否在跨集合写入时使用多文档事务（需要副本集或分片集群）
+MONGO_USE_TRANSACTIONS = os.getenv("MONGO_USE_TRANSACTIONS", "false").lower() in ("1", "true", "yes")
 
 # 创建MongoDB客户端
 client = AsyncIOMotorClient(MONGODB_URI)
@@ -33,6 +36,22 @@ async def close_mongo_connection():
     client.close()
 
 
+@asynccontextmanager
+async def mongo_transaction(enabled: bool = MONGO_USE_TRANSACTIONS):
+    """
+    可选的多文档事务上下文
+
+    启用时返回处于事务中的会话，退出时提交（异常时回滚）；
+    未启用时返回None，调用方照常传入 session=None 即为普通写入。
+    """
+    if not enabled:
+        yield None
+        return
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            yield session
+
+
 # FastAPI依赖函数
 def get_database():
     """FastAPI依赖函数：获取数据库实例"""
@@ -0,0 +1,233 @@
+"""
+MongoDB索引管理模块
+
+集中声明各集合的访问路径所需的索引，启动时（lifespan）统一创建，
+并报告数据库中缺失的和未在此声明的索引。任务存储（review_tasks、review_task_events）
+随存储后端变化，由 taskstore 自行管理索引，不在此声明。
+
+QUERY_PLANS 列出了业务代码中的查询，可通过 explain 检查是否退化为全表扫描：
+    python -m app.utils.indexes --check     # 存在COLLSCAN时返回非0
+    python -m app.utils.indexes --report    # 额外输出 $indexStats 中自启动以来未使用的索引
+tests/test_query_plans.py 在临时数据库上执行同样的检查，CI（.github/workflows/query-plans.yml）
+中随MongoDB服务容器运行。
+
+QUERY_PLANS 是手工维护的登记表，不会从业务代码中自动收集：检查只能覆盖已登记的查询，
+新增或修改查询（条件字段、排序）时请同时更新这里。
+"""
+
+import os
+import sys
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.utils.database import database
+
+logger = logging.getLogger(__name__)
+
+# 启动时是否创建索引（生产环境由DBA统一管理索引时可关闭）
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() in ("1", "true", "yes")
+
+# 集合名 -> 索引列表（不指定name，使用MongoDB默认命名，与已有的同键索引保持一致）
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "codereviews": [
+        # 审查列表（游标分页按 created_at, _id 排序）、用户最近一次审查
+        IndexModel([("username", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        # GitHub Action 按运行ID查询审查结果
+        IndexModel([("github_action_id", ASCENDING), ("username", ASCENDING)]),
+    ],
+    "users": [
+        # 登录与令牌验证按邮箱或用户名查找
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    "programmers": [
+        # 信誉更新按用户名upsert，唯一索引防止并发创建重复文档
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    "chat_messages": [
+        IndexModel([("review_id", ASCENDING), ("seq", ASCENDING)], unique=True),
+    ],
+    "reputation_events": [
+        IndexModel([("username", ASCENDING), ("_id", DESCENDING)]),
+        # 审查产生的事件按幂等键upsert
+        IndexModel([("key", ASCENDING)], unique=True, sparse=True),
+    ],
+    "apikeys": [
+        IndexModel([("username", ASCENDING)]),
+        IndexModel([("key_id", ASCENDING)], unique=True, sparse=True),
+        IndexModel([("api_key_hmac", ASCENDING)], unique=True, sparse=True),
+    ],
+    "jira_connections": [
+        IndexModel([("username", ASCENDING)]),
+    ],
+    "review_stats_daily": [
+        IndexModel([("username", ASCENDING), ("day", ASCENDING)], unique=True),
+    ],
+    "webhook_deliveries": [
+        IndexModel([("task_id", ASCENDING), ("created_at", DESCENDING)]),
+        # 投递循环领取到期的投递
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        # 投递结束的记录按 expires_at 过期清理
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+# 业务查询的访问路径：(集合名, 查询条件, 排序)
+QUERY_PLANS: List[Tuple[str, Dict[str, Any], Optional[List[Tuple[str, int]]]]] = [
+    ("codereviews", {"_id": ObjectId()}, None),
+    ("codereviews", {"github_action_id": "", "username": ""}, None),
+    ("codereviews", {"username": ""}, [("created_at", DESCENDING)]),
+    ("codereviews", {"username": ""}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("codereviews", {"username": "", "$or": [
+        {"created_at": {"$lt": datetime.utcnow()}},
+        {"created_at": datetime.utcnow(), "_id": {"$lt": ObjectId()}}
+    ]}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("users", {"$or": [{"email": ""}, {"username": ""}]}, None),
+    ("users", {"email": ""}, None),
+    ("users", {"username": ""}, None),
+    ("programmers", {"username": ""}, None),
+    ("chat_messages", {"review_id": "", "seq": {"$gt": 0}}, [("seq", ASCENDING)]),
+    ("chat_messages", {"review_id": ""}, [("seq", DESCENDING)]),
+    ("reputation_events", {"username": "", "_id": {"$lt": ObjectId()}}, [("_id", DESCENDING)]),
+    ("reputation_events", {"key": ""}, None),
+    ("apikeys", {"username": ""}, None),
+    ("apikeys", {"key_id": ""}, None),
+    ("apikeys", {"api_key_hmac": ""}, None),
+    ("jira_connections", {"username": ""}, None),
+    ("jira_connections", {"_id": ObjectId(), "username": ""}, None),
+    ("review_stats_daily", {"username": "", "day": {"$gte": ""}}, None),
+    ("review_stats_meta", {"_id": "rollup"}, None),
+    ("webhook_deliveries", {"task_id": ""}, [("created_at", DESCENDING)]),
+    ("webhook_deliveries", {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": datetime.utcnow()}},
+        {"status": "delivering", "lease_until": {"$lt": datetime.utcnow()}},
+    ]}, None),
+    ("review_blobs", {"_id": {"$in": [""]}}, None),
+]
+
+
+def _index_key(keys) -> Tuple[Tuple[str, Any], ...]:
+    return tuple((field, direction) for field, direction in keys)
+
+
+async def ensure_indexes(db=database) -> None:
+    """创建声明的索引（已存在的同键索引不会重复创建）"""
+    for name, indexes in INDEX_SPECS.items():
+        try:
+            await db[name].create_indexes(indexes)
+        except OperationFailure as e:
+            # 已有数据违反唯一约束、或同键索引选项不同，不阻塞启动
+            logger.error(f"集合 {name} 创建索引失败: {str(e)}")
+
+
+async def diff_indexes(db=database) -> Dict[str, Dict[str, List[str]]]:
+    """
+    比较声明的索引与数据库中实际存在的索引
+
+    Returns:
+        Dict: 集合名 -> {"missing": 缺失的索引, "undeclared": 未声明的索引}
+    """
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for name, indexes in INDEX_SPECS.items():
+        existing = await db[name].index_information()
+        existing_keys = {_index_key(info["key"]): index_name for index_name, info in existing.items()}
+        declared_keys = {_index_key(index.document["key"].items()) for index in indexes}
+
+        missing = [str(list(keys)) for keys in declared_keys if keys not in existing_keys]
+        undeclared = [
+            index_name for keys, index_name in existing_keys.items()
+            if index_name != "_id_" and keys not in declared_keys
+        ]
+        if missing or undeclared:
+            report[name] = {"missing": missing, "undeclared": undeclared}
+    return report
+
+
+async def unused_indexes(db=database) -> Dict[str, List[str]]:
+    """通过 $indexStats 获取自mongod启动以来从未使用过的索引"""
+    report: Dict[str, List[str]] = {}
+    for name in INDEX_SPECS:
+        try:
+            stats = await db[name].aggregate([{"$indexStats": {}}]).to_list(length=None)
+        except OperationFailure as e:
+            logger.warning(f"获取集合 {name} 的索引使用统计失败: {str(e)}")
+            continue
+        unused = [s["name"] for s in stats if s["name"] != "_id_" and s.get("accesses", {}).get("ops", 0) == 0]
+        if unused:
+            report[name] = unused
+    return report
+
+
+def _plan_stages(plan: Any) -> List[str]:
+    """递归收集执行计划中的所有stage"""
+    stages: List[str] = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+
+async def check_query_plans(db=database) -> List[Dict[str, Any]]:
+    """
+    对 QUERY_PLANS 中的每个查询执行explain，返回使用了全表扫描或内存排序的查询
+    """
+    problems: List[Dict[str, Any]] = []
+    for name, query, sort in QUERY_PLANS:
+        cursor = db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        issues = [stage for stage in ("COLLSCAN", "SORT") if stage in stages]
+        if issues:
+            problems.append({"collection": name, "query": query, "sort": sort, "stages": issues})
+    return problems
+
+
+async def ensure_and_report_indexes(db=database) -> None:
+    """启动时创建索引并记录索引差异"""
+    if not MONGO_ENSURE_INDEXES:
+        return
+    await ensure_indexes(db)
+    for name, diff in (await diff_indexes(db)).items():
+        if diff["missing"]:
+            logger.warning(f"集合 {name} 缺少索引: {diff['missing']}")
+        if diff["undeclared"]:
+            logger.info(f"集合 {name} 存在未声明的索引: {diff['undeclared']}")
+
+
+async def _main(argv: List[str]) -> int:
+    await ensure_indexes()
+    exit_code = 0
+
+    for name, diff in (await diff_indexes()).items():
+        print(f"[{name}] 缺失: {diff['missing']}  未声明: {diff['undeclared']}")
+        if diff["missing"]:
+            exit_code = 1
+
+    if "--check" in argv or "--report" in argv:
+        for problem in await check_query_plans():
+            print(f"[{problem['collection']}] {problem['stages']}: query={problem['query']} sort={problem['sort']}")
+            exit_code = 1
+
+    if "--report" in argv:
+        for name, indexes in (await unused_indexes()).items():
+            print(f"[{name}] 自启动以来未使用: {indexes}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,198 @@
+"""
+Jira HTTP客户端模块
+
+Jira / Atlassian 的所有请求（REST API 与 OAuth 令牌接口）共用长期存活的 httpx.AsyncClient：
+每个主机一个连接池（限制到同一主机的并发连接数、保持长连接），统一的连接与读取超时，
+并在限流（429）和服务端临时错误（5xx）时按 Retry-After 或带抖动的指数退避重试。
+Jira地址由用户提供，连接池按最近使用保留最多 JIRA_HTTP_MAX_HOSTS 个主机，
+淘汰的连接池在其上的请求结束后关闭。应用关闭时（lifespan）统一关闭。
+
+重试策略：
+- 429 表示请求被限流、未被处理，所有方法都重试
+- 503 只有带 Retry-After 时才确定请求未被处理，此时所有方法都重试
+- 其他 5xx 和读取超时只对幂等方法（GET/PUT/DELETE 等）重试，避免 POST 重复创建Issue
+- 连接失败（请求未发出）所有方法都重试
+"""
+
+import os
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 每个主机的连接池上限
+JIRA_HTTP_MAX_CONNECTIONS = int(os.getenv("JIRA_HTTP_MAX_CONNECTIONS", "20"))
+# 空闲长连接的保留数量与时间（秒）
+JIRA_HTTP_MAX_KEEPALIVE = int(os.getenv("JIRA_HTTP_MAX_KEEPALIVE", "10"))
+JIRA_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("JIRA_HTTP_KEEPALIVE_EXPIRY", "60"))
+# 保留连接池的主机数量上限（按最近使用淘汰）
+JIRA_HTTP_MAX_HOSTS = int(os.getenv("JIRA_HTTP_MAX_HOSTS", "16"))
+# 建立连接与读取超时（秒）
+JIRA_HTTP_CONNECT_TIMEOUT = float(os.getenv("JIRA_HTTP_CONNECT_TIMEOUT", "5"))
+JIRA_HTTP_READ_TIMEOUT = float(os.getenv("JIRA_HTTP_READ_TIMEOUT", "15"))
+# 最大重试次数与退避参数（秒）
+JIRA_HTTP_MAX_RETRIES = int(os.getenv("JIRA_HTTP_MAX_RETRIES", "3"))
+JIRA_HTTP_BACKOFF_BASE = float(os.getenv("JIRA_HTTP_BACKOFF_BASE", "0.5"))
+JIRA_HTTP_BACKOFF_MAX = float(os.getenv("JIRA_HTTP_BACKOFF_MAX", "10"))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或HTTP日期），无法解析时返回None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class JiraClient:
+    """进程内共享的Jira HTTP客户端"""
+
+    def __init__(
+        self,
+        max_connections: int = JIRA_HTTP_MAX_CONNECTIONS,
+        max_keepalive: int = JIRA_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry: float = JIRA_HTTP_KEEPALIVE_EXPIRY,
+        max_hosts: int = JIRA_HTTP_MAX_HOSTS,
+        max_retries: int = JIRA_HTTP_MAX_RETRIES,
+        backoff_base: float = JIRA_HTTP_BACKOFF_BASE,
+        backoff_max: float = JIRA_HTTP_BACKOFF_MAX
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(JIRA_HTTP_READ_TIMEOUT, connect=JIRA_HTTP_CONNECT_TIMEOUT)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_hosts = max_hosts
+        # 主机 -> 连接池，按最近使用排序
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+        # 连接池 -> 进行中的请求数
+        self._inflight: Dict[httpx.AsyncClient, int] = {}
+
+    @asynccontextmanager
+    async def _client(self, url: str) -> AsyncIterator[httpx.AsyncClient]:
+        """获取主机的连接池，超出主机上限时淘汰最久未使用的连接池"""
+        host = httpx.URL(url).host
+        client = self._clients.get(host)
+        if client is None:
+            client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            self._clients[host] = client
+            self._inflight[client] = 0
+        self._clients.move_to_end(host)
+        self._inflight[client] += 1
+
+        while len(self._clients) > self.max_hosts:
+            _, evicted = self._clients.popitem(last=False)
+            if not self._inflight.get(evicted):
+                self._inflight.pop(evicted, None)
+                await evicted.aclose()
+
+        try:
+            yield client
+        finally:
+            remaining = self._inflight.get(client, 0) - 1
+            if self._clients.get(host) is client or remaining > 0:
+                self._inflight[client] = remaining
+            else:
+                # 已被淘汰（或已关闭）的连接池在最后一个请求结束后关闭
+                self._inflight.pop(client, None)
+                await client.aclose()
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """重试等待时间：优先使用 Retry-After，否则为带完全抖动的指数退避"""
+        if response is not None:
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _should_retry_status(self, method: str, response: httpx.Response) -> bool:
+        status_code = response.status_code
+        if status_code == 429:
+            return True
+        if status_code == 503 and retry_after_seconds(response) is not None:
+            return True
+        return status_code >= 500 and method in IDEMPOTENT_METHODS
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        发送请求，限流和临时错误时自动重试
+
+        Args:
+            method: HTTP方法
+            url: 完整的请求地址
+            **kwargs: 其他 httpx 请求参数（headers、json、data、params 等）
+
+        Returns:
+            httpx.Response: 最后一次请求的响应（重试耗尽时可能仍是429/5xx）
+
+        Raises:
+            httpx.HTTPError: 重试耗尽后仍无法完成请求
+        """
+        method = method.upper()
+        attempt = 0
+        while True:
+            try:
+                async with self._client(url) as client:
+                    response = await client.request(method, url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # 请求尚未发出，任何方法都可以重试
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Jira请求连接失败，{delay:.2f}秒后重试({attempt + 1}/{self.max_retries}): {method} {url}: {str(e)}")
+            except httpx.TimeoutException as e:
+                if attempt >= self.max_retries or method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Jira请求超时，{delay:.2f}秒后重试({attempt + 1}/{self.max_retries}): {method} {url}: {str(e)}")
+            else:
+                if attempt >= self.max_retries or not self._should_retry_status(method, response):
+                    return response
+                delay = self._backoff(attempt, response)
+                await response.aclose()
+                logger.warning(
+                    f"Jira请求返回{response.status_code}，{delay:.2f}秒后重试({attempt + 1}/{self.max_retries}): {method} {url}"
+                )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self) -> None:
+        """关闭所有连接池（应用关闭时调用）"""
+        clients = list(self._inflight)
+        self._clients.clear()
+        self._inflight.clear()
+        for client in clients:
+            await client.aclose()
+
+
+# 创建全局实例
+jira_client = JiraClient()
@@ -0,0 +1,106 @@
+"""
+模型客户端注册表
+
+按 (模型, 接口地址, 密钥, 创建参数) 复用长期存活的 OpenAIChatCompletionClient，
+底层共用一个带连接池的 httpx.AsyncClient：保持长连接、省去每条消息的TLS握手，
+并限制到同一接口地址的并发连接数。应用关闭时（lifespan）统一关闭。
+"""
+
+import os
+import hashlib
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+import httpx
+from autogen_ext.models.openai import OpenAIChatCompletionClient
+
+logger = logging.getLogger(__name__)
+
+# 每个接口地址的连接池上限
+MODEL_HTTP_MAX_CONNECTIONS = int(os.getenv("MODEL_HTTP_MAX_CONNECTIONS", "50"))
+# 空闲长连接的保留数量与时间（秒）
+MODEL_HTTP_MAX_KEEPALIVE = int(os.getenv("MODEL_HTTP_MAX_KEEPALIVE", "20"))
+MODEL_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MODEL_HTTP_KEEPALIVE_EXPIRY", "120"))
+# 建立连接与读取超时（秒），流式响应两次输出之间的间隔不能超过读取超时
+MODEL_HTTP_CONNECT_TIMEOUT = float(os.getenv("MODEL_HTTP_CONNECT_TIMEOUT", "10"))
+MODEL_HTTP_READ_TIMEOUT = float(os.getenv("MODEL_HTTP_READ_TIMEOUT", "120"))
+
+
+class ModelClientRegistry:
+    """进程内共享的模型客户端"""
+
+    def __init__(
+        self,
+        max_connections: int = MODEL_HTTP_MAX_CONNECTIONS,
+        max_keepalive: int = MODEL_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry: float = MODEL_HTTP_KEEPALIVE_EXPIRY
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(MODEL_HTTP_READ_TIMEOUT, connect=MODEL_HTTP_CONNECT_TIMEOUT)
+        # (模型, 接口地址, 密钥摘要, 创建参数) -> 模型客户端
+        self._clients: Dict[Tuple[str, str, str, str], OpenAIChatCompletionClient] = {}
+        # 接口地址 -> 连接池
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _http_client(self, base_url: str) -> httpx.AsyncClient:
+        http_client = self._http_clients.get(base_url)
+        if http_client is None:
+            http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            self._http_clients[base_url] = http_client
+        return http_client
+
+    def get(
+        self, model: str, base_url: Optional[str], api_key: Optional[str], model_info: Dict[str, Any], **kwargs
+    ) -> OpenAIChatCompletionClient:
+        """
+        获取（或创建）模型客户端
+
+        Args:
+            model: 模型名称
+            base_url: OpenAI兼容接口地址
+            api_key: 接口密钥
+            model_info: autogen模型能力描述
+            **kwargs: 其他 OpenAIChatCompletionClient 参数（如 max_retries、response_format），
+                参数不同的调用方得到不同的客户端
+        """
+        key = (
+            model,
+            base_url or "",
+            hashlib.sha256((api_key or "").encode("utf-8")).hexdigest(),
+            repr(sorted(kwargs.items()))
+        )
+        client = self._clients.get(key)
+        if client is None:
+            client = OpenAIChatCompletionClient(
+                model=model,
+                api_key=api_key,
+                base_url=base_url,
+                model_info=model_info,
+                http_client=self._http_client(base_url),
+                **kwargs
+            )
+            self._clients[key] = client
+            logger.info(f"创建模型客户端: model={model}, base_url={base_url}")
+        return client
+
+    async def close(self) -> None:
+        """关闭所有模型客户端和连接池（应用关闭时调用）"""
+        clients = list(self._clients.values())
+        http_clients = list(self._http_clients.values())
+        self._clients.clear()
+        self._http_clients.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"关闭模型客户端失败: {str(e)}")
+        for http_client in http_clients:
+            await http_client.aclose()
+
+
+# 创建全局实例
+model_client_registry = ModelClientRegistry()
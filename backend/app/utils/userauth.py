@@ -7,6 +7,9 @@ from fastapi.security import OAuth2PasswordBearer, HTTPBearer, HTTPAuthorization
 import os
 from app.models.user import UserInDB, UserResponse
 from app.utils.database import users_collection
+from app.utils.cache import principal_cache
+import hashlib
+import time
 from bson import ObjectId
 import logging
 logger = logging.getLogger(__name__)
@@ -88,6 +91,12 @@ async def require_bearer(token: str = Depends(oauth2_scheme)) -> str:
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    # 已验证过的令牌直接返回缓存的用户名
+    cache_key = "bearer:" + hashlib.sha256(token.encode("utf-8")).hexdigest()
+    username = principal_cache.get(cache_key)
+    if username:
+        return username
+
     try:
         # 使用FastAPI推荐的JWT解码方式
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -109,6 +118,10 @@ async def require_bearer(token: str = Depends(oauth2_scheme)) -> str:
     if user_dict is None:
         logger.error(f"Bearer令牌验证失败: 未找到用户 (identifier: {identifier})")
         raise credentials_exception
+
+    # 缓存时间不超过令牌剩余有效期
+    ttl = payload["exp"] - time.time() if payload.get("exp") else None
+    principal_cache.set(cache_key, user_dict['username'], ttl=ttl, tags=[f"user:{user_dict['username']}"])
     return user_dict['username']
     
 
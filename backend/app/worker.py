@@ -0,0 +1,137 @@
+"""
+审查任务Worker进程
+
+从任务存储中领取 /api/codereview/submit 入队的审查任务并执行，
+与API进程分开部署、独立扩容。需配合 REVIEW_EXECUTION_MODE=worker 使用。
+
+启动方式：
+    python -m app.worker
+"""
+
+import asyncio
+import logging
+import signal
+import socket
+import os
+from datetime import datetime
+from typing import Dict, Any, Set
+
+import dotenv
+dotenv.load_dotenv()
+
+from app.utils.database import connect_to_mongo, close_mongo_connection, codereviews_collection
+from app.services.taskstore import task_store, REVIEW_MAX_INFLIGHT, REVIEW_TASK_LEASE_SECONDS
+from app.services.codereview import AICodeReviewDatabaseService
+from app.utils.modelclient import model_client_registry
+from app.routers.codereview import CodeReviewPayload, run_async_review_task
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 队列为空时的轮询间隔（秒）
+REVIEW_WORKER_POLL_INTERVAL = float(os.getenv("REVIEW_WORKER_POLL_INTERVAL", "2"))
+
+
+class ReviewWorker:
+    """审查任务Worker，进程内最多同时执行 max_inflight 个审查"""
+
+    def __init__(self, max_inflight: int = REVIEW_MAX_INFLIGHT, poll_interval: float = REVIEW_WORKER_POLL_INTERVAL):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.semaphore = asyncio.Semaphore(max(1, max_inflight))
+        self.code_review_service = AICodeReviewDatabaseService(codereviews_collection)
+        self._stopping = asyncio.Event()
+        self._inflight: Set[asyncio.Task] = set()
+        self._last_expire_check = 0.0
+
+    def stop(self) -> None:
+        """停止领取新任务，已开始的审查会继续执行完毕"""
+        logger.info(f"Worker {self.worker_id} 收到停止信号，等待 {len(self._inflight)} 个任务完成")
+        self._stopping.set()
+
+    async def run(self) -> None:
+        logger.info(f"Worker {self.worker_id} 启动")
+        while not self._stopping.is_set():
+            # 先占用并发名额再领取任务，保证领取到的任务能立即执行
+            await self.semaphore.acquire()
+            if self._stopping.is_set():
+                # 等待名额期间收到了停止信号，不再领取新任务
+                self.semaphore.release()
+                break
+            try:
+                task = await task_store.claim_next_task(self.worker_id)
+            except Exception as e:
+                logger.error(f"领取任务失败: {str(e)}")
+                task = None
+
+            if task is None:
+                self.semaphore.release()
+                await self._expire_stale_tasks()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job = asyncio.create_task(self._process(task))
+            self._inflight.add(job)
+            job.add_done_callback(self._inflight.discard)
+
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        logger.info(f"Worker {self.worker_id} 已停止")
+
+    async def _expire_stale_tasks(self) -> None:
+        """队列空闲时（每个租约周期至多一次）将无法重新执行的过期任务标记为失败"""
+        now = asyncio.get_running_loop().time()
+        if now - self._last_expire_check < REVIEW_TASK_LEASE_SECONDS:
+            return
+        self._last_expire_check = now
+        try:
+            await task_store.expire_stale_tasks()
+        except Exception as e:
+            logger.error(f"清理租约过期的任务失败: {str(e)}")
+
+    async def _process(self, task: Dict[str, Any]) -> None:
+        task_id = task["task_id"]
+        try:
+            payload = CodeReviewPayload(**task["payload"])
+            logger.info(f"Worker {self.worker_id} 开始处理任务 {task_id}（第{task.get('claim_count', 1)}次领取）")
+            # 执行期间刷新租约，worker退出后任务可被重新领取
+            async with task_store.lease(task_id):
+                await run_async_review_task(task_id, payload, task.get("username"), self.code_review_service)
+            # 任务结束后不再需要保留原始payload
+            await task_store.update_task(task_id, {"payload": None})
+        except Exception as e:
+            logger.error(f"任务 {task_id} 处理失败: {str(e)}")
+            await task_store.update_task(task_id, {
+                "status": "failed",
+                "error": str(e),
+                "updated_at": datetime.utcnow()
+            })
+        finally:
+            self.semaphore.release()
+
+
+async def main() -> None:
+    await connect_to_mongo()
+    await task_store.init()
+
+    worker = ReviewWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            # Windows不支持add_signal_handler
+            pass
+
+    try:
+        await worker.run()
+    finally:
+        await model_client_registry.close()
+        await close_mongo_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,7 +3,16 @@ import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import auth, apikey, codereview, reputation, install, aicopilot, jira
-from app.utils.database import connect_to_mongo, close_mongo_connection
+from app.utils.database import connect_to_mongo, close_mongo_connection, codereviews_collection
+from app.services.taskstore import task_store
+from app.services.reputation import reputation_service
+from app.services.chatstore import chat_message_store
+from app.services.codereview.stats import review_stats_rollup
+from app.utils.indexes import ensure_and_report_indexes
+from app.utils.modelclient import model_client_registry
+from app.utils.jiraclient import jira_client
+from app.services.webhook import webhook_service
+from app.services.apikey import apikey_service
 
 from contextlib import asynccontextmanager
 
@@ -16,7 +25,34 @@ dotenv.load_dotenv()
 async def lifespan(app: FastAPI):
     # 启动时连接数据库
     await connect_to_mongo()
+    # 创建各集合访问路径所需的索引
+    await ensure_and_report_indexes()
+    # 旧版程序员文档中的完整信誉历史迁移到 reputation_events
+    await reputation_service.migrate_history_to_events()
+    # 审查文档中内嵌的聊天记录迁移到 chat_messages
+    await chat_message_store.migrate_embedded()
+    # 统计汇总从未重建过时，从审查记录重建一次（计入启用汇总之前的历史审查）
+    await review_stats_rollup.ensure_rebuilt(codereviews_collection)
+    # 设置了 API_KEY_LEGACY_DEADLINE 时，未迁移的旧版API密钥在截止时间过期
+    await apikey_service.expire_legacy_api_keys()
+    # 初始化异步任务存储，并迁移旧版pickle任务文件
+    await task_store.init()
+    await task_store.migrate_from_pickle()
+    await task_store.purge_expired()
+    # 执行进程已退出、无法重新执行的任务标记为失败
+    await task_store.expire_stale_tasks()
+    # 接收其他进程写入的任务事件，唤醒进度推送连接
+    task_store.start_event_feed()
+    # 启动回调投递循环（继续投递重启前未完成的回调）
+    webhook_service.start()
     yield
+    # 停止回调投递循环
+    await webhook_service.close()
+    await task_store.close_event_feed()
+    # 关闭审查流程与智能助手共享的模型客户端和连接池
+    await model_client_registry.close()
+    # 关闭Jira请求的连接池
+    await jira_client.close()
     # 关闭时断开数据库连接
     await close_mongo_connection()
 
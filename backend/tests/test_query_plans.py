@@ -0,0 +1,58 @@
+"""
+QUERY_PLANS 访问路径检查
+
+需要一个可用的MongoDB（CI中为服务容器）：
+    MONGODB_TEST_URI=mongodb://localhost:27017 python -m pytest tests/test_query_plans.py
+未设置 MONGODB_TEST_URI 时跳过。每个测试在临时数据库中创建 INDEX_SPECS 声明的索引，
+结束后删除该数据库。
+"""
+
+import os
+import uuid
+import asyncio
+
+import pytest
+
+MONGODB_TEST_URI = os.getenv("MONGODB_TEST_URI")
+
+pytestmark = pytest.mark.skipif(not MONGODB_TEST_URI, reason="未设置 MONGODB_TEST_URI")
+
+if MONGODB_TEST_URI:
+    # app.utils.database 在导入时按环境变量创建客户端
+    os.environ.setdefault("MONGODB_URI", MONGODB_TEST_URI)
+    os.environ.setdefault("DATABASE_NAME", "query_plans_test")
+
+
+def run_with_test_database(check):
+    """在临时数据库上创建声明的索引后执行检查"""
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from app.utils.indexes import ensure_indexes
+
+    async def run():
+        client = AsyncIOMotorClient(MONGODB_TEST_URI)
+        db = client[f"query_plans_{uuid.uuid4().hex[:12]}"]
+        try:
+            await ensure_indexes(db)
+            return await check(db)
+        finally:
+            await client.drop_database(db.name)
+            client.close()
+
+    return asyncio.run(run())
+
+
+def test_declared_indexes_are_created():
+    from app.utils.indexes import diff_indexes
+
+    report = run_with_test_database(diff_indexes)
+    missing = {name: diff["missing"] for name, diff in report.items() if diff["missing"]}
+    assert not missing, missing
+
+
+def test_query_plans_use_indexes():
+    from app.utils.indexes import check_query_plans
+
+    problems = run_with_test_database(check_query_plans)
+    assert not problems, "\n".join(
+        f"[{p['collection']}] {p['stages']}: query={p['query']} sort={p['sort']}" for p in problems
+    )